@@ -1,9 +1,11 @@
 
 from enum import StrEnum
+from functools import partial
 import os
 from pathlib import Path
 from types import ModuleType
 from typing import Literal
+from magelang.helpers import namespaced
 from magelang.logging import error
 from magelang.util import Files, load_py_file
 from .manager import *
@@ -42,6 +44,11 @@ class Engine(StrEnum):
     OLD = 'old'
     _default = OLD
 
+class ParserBackend(StrEnum):
+    RECURSIVE = 'recursive'
+    TABLE = 'table'
+    _default = RECURSIVE
+
 type TargetLanguage = Literal['python', 'rust']
 
 def _is_functional(lang: str) -> bool:
@@ -82,7 +89,15 @@ class GenerateConfig(TypedDict, total=False):
     """
     emit_single_file: bool
     """
-    Concatenate all files into one big file.
+    Merge all generated modules into one big module.
+
+    Imports are merged and functions that are defined more than once in the
+    same way are only emitted once. The lexer tests are not generated. When
+    both the CST and the AST are enabled, the AST classes get `ast` as an
+    additional prefix, e.g. `FooAstModule` for a prefix of `foo`.
+
+    The command-line interface writes the module to `__init__.py` in the
+    output directory.
     """
     enable_cst: bool
     """
@@ -110,6 +125,14 @@ class GenerateConfig(TypedDict, total=False):
     """
     Generate a parser based on the given grammar.
     """
+    parser_backend: ParserBackend
+    """
+    How the generated parser should work.
+
+    recursive - Generate a backtracking recursive descent parser
+    table - Generate LL(1) parse tables that are run by a small interpreter.
+            Falls back to `recursive` if the grammar is not LL(1).
+    """
     enable_emitter: bool
     """
     Attempt to write an experimental emitter.
@@ -122,6 +145,16 @@ class GenerateConfig(TypedDict, total=False):
     """
     Add parent pointers to the AST.
     """
+    enable_parent_map: bool
+    """
+    Do not store a parent pointer on every node. Instead, the generated
+    `parent()` methods look up the parent in a `ParentMap` that is built on
+    first use.
+
+    This saves a slot on each node for programs that rarely navigate upwards.
+    The map is not updated by the generated rewriters and has to be
+    invalidated or built again after a rewrite.
+    """
     enable_visitor: bool
     """
     Generate in addition to an AST and/or CST functions that traverse over the tree.
@@ -130,10 +163,89 @@ class GenerateConfig(TypedDict, total=False):
     """
     Generate in addition to an AST and/or CST functions that rewrite the tree.
     """
+    enable_slots: bool
+    """
+    Generate `__slots__` for all node and token classes so that instances do
+    not need a `__dict__`. This greatly reduces the memory a CST occupies.
+    """
+    enable_shared_tokens: bool
+    """
+    Make every token without a value that is created without a span a
+    singleton of its class.
+
+    This avoids an allocation for each keyword and punctuation token. Shared
+    tokens can't be told apart by identity and don't point to a parent.
+    """
+    enable_red_green: bool
+    """
+    Generate facade classes over immutable, interned green trees next to
+    the regular node classes.
+
+    Green trees only store kinds, widths and children and can be shared
+    between documents. Parent pointers and absolute offsets are computed by
+    the facades while the tree is being traversed.
+
+    The width of a token includes the trivia in front of it, which is taken
+    from the lexer when `enable_trivia` is also set. Passing the result of
+    `<prefix>_green_builder(lexer.trivia)` as the interner of a parser
+    builds the green tree directly while parsing.
+    """
+    enable_structural_eq: bool
+    """
+    Make nodes and tokens compare equal when they have the same contents
+    instead of only when they are the same object.
+
+    Hashes of nodes are computed once and then cached, so a node must not be
+    mutated after it has been hashed. The positions of tokens are not
+    compared. The generated parsers accept a `SyntaxInterner` that
+    deduplicates equal subtrees while parsing. Shared tokens then report the
+    offsets of the first equal token that was parsed, unless the interner
+    was created with `keep_positions=True`.
+    """
+    enable_serializer: bool
+    """
+    Generate `dump()` and `load()` functions that write a tree to a compact
+    binary file and read it back without running the parser.
+    """
+    enable_lazy_ast: bool
+    """
+    Generate AST classes that wrap a CST node and only compute their fields
+    when they are first accessed.
+
+    This avoids building the entire AST when only a small part of it is
+    inspected. Requires both the CST and the AST to be enabled.
+    """
+    enable_trivia: bool
+    """
+    Make the lexer record where each token starts and ends in a
+    `TriviaTable` and generate an emitter function that uses this table to
+    copy unchanged parts of the tree verbatim from the source text.
+
+    This preserves whitespace and comments when only a few nodes of a large
+    file are rewritten.
+
+    Because tokens then have positions, CST nodes also cache their start
+    and end offsets. After changing a node in place, call
+    `clear_cached_offsets()` from the runtime to clear the cache of the node
+    and its ancestors.
+    """
+    enable_fast_import: bool
+    """
+    Generate node classes that are cheaper to import.
+
+    Every node shares a single `derive()` method instead of getting its own
+    method and `TypedDict`, annotations are not evaluated and the aliases
+    that are only needed by type checkers are placed behind
+    `TYPE_CHECKING`. This mostly benefits short-lived programs.
+    """
     enable_linecol: bool
     """
     Enable tracking of line/column numbers in the lexer/parser.
     """
+    jobs: int
+    """
+    The amount of processes that emit the generated files in parallel.
+    """
     max_named_chars: int
     """
     The maximum amount of characters to give an explicit name before falling
@@ -152,15 +264,77 @@ def default_config(lang: TargetLanguage, is_debug: bool) -> GenerateConfig:
         enable_asserts=is_debug,
         enable_lexer=YesNoAuto.AUTO,
         enable_parser=True,
+        parser_backend=ParserBackend.RECURSIVE,
         enable_emitter=True,
         enable_cst_parent_pointers=not _is_functional(lang),
         enable_ast_parent_pointers=not _is_functional(lang),
+        enable_parent_map=False,
         enable_visitor=True,
         enable_rewriter=True,
+        enable_slots=True,
+        enable_shared_tokens=False,
+        enable_red_green=False,
+        enable_structural_eq=False,
+        enable_serializer=False,
+        enable_lazy_ast=False,
+        enable_trivia=False,
+        enable_fast_import=False,
         enable_linecol=False,
+        jobs=1,
         max_named_chars=4,
     )
 
+def _get_python_passes(ctx: Context, enable_lexer: bool) -> tuple[dict[str, Pass[MageGrammar, PyModule]], dict[str, Pass[Specs, PyModule]]]:
+    """
+    Get the passes that generate each Python module, split into those that
+    start from the grammar and those that start from the specs of the tree.
+    """
+
+    enable_cst = nonnull(ctx.get_option('enable_cst'))
+    enable_ast = nonnull(ctx.get_option('enable_ast'))
+    enable_emitter = nonnull(ctx.get_option('enable_emitter'))
+    enable_parser = nonnull(ctx.get_option('enable_parser'))
+    parser_backend = nonnull(ctx.get_option('parser_backend'))
+    emit_single_file = nonnull(ctx.get_option('emit_single_file'))
+
+    # The CST and the AST have classes with the same names, so in one module the AST needs another prefix
+    ast_prefix = namespaced('ast', nonnull(ctx.get_option('prefix'))) if emit_single_file and enable_cst else ''
+
+    files = dict[str, Pass[MageGrammar, PyModule]]()
+    trees = dict[str, Pass[Specs, PyModule]]()
+    if enable_cst:
+        # TODO add local `enable_cst_parent_pointers`
+        trees['cst.py'] = treespec_to_python
+    if enable_ast:
+        # TODO add local `enable_ast_parent_pointers`
+        trees['ast.py'] = pipeline(treespec_cst_to_ast, treespec_to_python)
+        if ast_prefix:
+            trees['ast.py'] = with_options(trees['ast.py'], prefix=ast_prefix)
+        if enable_cst and nonnull(ctx.get_option('enable_lazy_ast')):
+            trees['lazy_ast.py'] = treespec_to_python_lazy_ast
+            if ast_prefix:
+                trees['lazy_ast.py'] = with_options(trees['lazy_ast.py'], ast_prefix=ast_prefix)
+    if enable_emitter:
+        files['emitter.py'] = mage_to_python_emitter
+    if enable_lexer:
+        files['lexer.py'] = pipeline(mage_flatten_grammars, mage_to_python_lexer)
+        if not emit_single_file:
+            files['test_lexer.py'] = mage_to_python_lexer_tests
+    if enable_parser:
+        files['parser.py'] = mage_to_python_table_parser if parser_backend == ParserBackend.TABLE else mage_to_python_parser
+    return files, trees
+
+def _get_python_file_passes(ctx: Context, enable_lexer: bool) -> dict[str, Pass[MageGrammar, str]]:
+    # Defined at the top level so that it can be sent to another process
+    files, trees = _get_python_passes(ctx, enable_lexer)
+    out = dict[str, Pass[MageGrammar, str]]()
+    for fname, pass_ in files.items():
+        out[fname] = pipeline(pass_, python_optimise, python_to_text)
+    for fname, pass_ in trees.items():
+        # Each file computes the specs itself, which is cheap compared to generating the file
+        out[fname] = pipeline(mage_to_treespec, pass_, python_optimise, python_to_text)
+    return out
+
 def generate_files(
     grammar: MageGrammar | Path | str,
     lang: TargetLanguage,
@@ -189,10 +363,6 @@ def generate_files(
         enable_lexer = False
 
     engine = nonnull(config.get('engine'))
-    enable_cst = nonnull(config.get('enable_cst'))
-    enable_ast = nonnull(config.get('enable_ast'))
-    enable_emitter = nonnull(config.get('enable_emitter'))
-    enable_parser = nonnull(config.get('enable_parser'))
     emit_single_file = nonnull(config.get('emit_single_file'))
     skip_checks = nonnull(config.get('skip_checks'))
     silent = nonnull(config.get('silent'))
@@ -204,25 +374,17 @@ def generate_files(
     #    pass_ = pipeline(pass_, extract_prefixes, simplify)
 
     if engine == Engine.OLD:
-        files = dict[str, Pass[MageGrammar, PyModule]]()
-        trees = dict[str, Pass[Specs, PyModule]]()
-        if enable_cst:
-            # TODO add local `enable_cst_parent_pointers`
-            trees['cst.py'] = treespec_to_python
-        if enable_ast:
-            # TODO add local `enable_ast_parent_pointers`
-            trees['ast.py'] = pipeline(treespec_cst_to_ast, treespec_to_python)
-        if enable_emitter:
-            files['emitter.py'] = mage_to_python_emitter
-        if enable_lexer:
-            files['lexer.py'] = pipeline(mage_flatten_grammars, mage_to_python_lexer)
-            files['test_lexer.py'] = mage_to_python_lexer_tests
-        if enable_parser:
-            files['parser.py'] = mage_to_python_parser
-        mage_to_target = compose(
-            merge(distribute(files), pipeline(mage_to_treespec, distribute(trees))),
-            each_value(pipeline(python_optimise, python_to_text)),
-        )
+        if emit_single_file:
+            files, trees = _get_python_passes(ctx, enable_lexer)
+            mage_to_target = pipeline(
+                # The node classes have to be defined before the code that uses them
+                merge(pipeline(mage_to_treespec, distribute(trees)), distribute(files)),
+                python_merge_modules,
+                python_optimise,
+                python_to_text,
+            )
+        else:
+            mage_to_target = distribute_parallel(partial(_get_python_file_passes, enable_lexer=enable_lexer))
     elif engine == Engine.NEW:
         if lang == 'python':
             revolv_to_target = each_value(pipeline(revolv_lift_assign_expr, revolv_to_python, python_to_text))
@@ -245,21 +407,7 @@ def generate_files(
         mage_to_target # Actual compilation
     ))
 
-    if not emit_single_file:
-        return files
-
-    out = ''
-    if enable_cst:
-        out += '\n\n' + files['cst.py']
-    if enable_ast:
-        out += '\n\n' + files['ast.py']
-    if enable_lexer:
-        out += '\n\n' + files['lexer.py']
-    if enable_parser:
-        out += '\n\n' + files['parser.py']
-    if enable_emitter:
-        out += '\n\n' + files['emitter.py']
-    return out
+    return files
 
 
 def write_files(files: Files, dest_dir: Path, force: bool = False) -> None:
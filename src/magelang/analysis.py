@@ -380,3 +380,327 @@ def get_lexer_modes(grammar: MageGrammar) -> dict[str, int]:
         next_token_rules = SeqSet[MageRule]()
 
     return modes
+
+
+@dataclass
+class LL1Conflict:
+    """
+    Describes why a rule can't be parsed by looking at just one token.
+    """
+    rule: MageRule
+    message: str
+
+
+@dataclass
+class LL1Analysis:
+    """
+    The result of `analyse_ll1()`.
+
+    Token rules are identified by their name and are the only kind of
+    terminal that is supported.
+    """
+    grammar: MageGrammar
+    rule_nullable: dict[MageRule, bool]
+    rule_first: dict[MageRule, set[str]]
+    expr_follow: dict[MageExpr, set[str]]
+    conflicts: list[LL1Conflict]
+
+    def nullable(self, expr: MageExpr) -> bool:
+        """
+        Check whether the expression may match without consuming a single token.
+        """
+        if isinstance(expr, MageRefExpr):
+            rule = lookup_ref(expr)
+            if rule is None or rule.expr is None or self.grammar.is_token_rule(rule):
+                return False
+            return self.rule_nullable.get(rule, False)
+        if isinstance(expr, MageHideExpr):
+            return self.nullable(expr.expr)
+        if isinstance(expr, MageSeqExpr):
+            return all(self.nullable(element) for element in expr.elements)
+        if isinstance(expr, MageChoiceExpr):
+            return any(self.nullable(element) for element in expr.elements)
+        if isinstance(expr, MageRepeatExpr):
+            return expr.min == 0 or self.nullable(expr.expr)
+        if isinstance(expr, MageListExpr):
+            return expr.min_count == 0 or self.nullable(expr.element)
+        if isinstance(expr, MageLookaheadExpr):
+            return True
+        if isinstance(expr, MageLitExpr):
+            return len(expr.text) == 0
+        if isinstance(expr, MageCharSetExpr):
+            return False
+        assert_never(expr)
+
+    def first(self, expr: MageExpr) -> set[str]:
+        """
+        Get the names of the token rules that may start the given expression.
+        """
+        if isinstance(expr, MageRefExpr):
+            rule = lookup_ref(expr)
+            if rule is None or rule.expr is None:
+                return set()
+            if self.grammar.is_token_rule(rule):
+                return { rule.name }
+            return self.rule_first.get(rule, set())
+        if isinstance(expr, MageHideExpr):
+            return self.first(expr.expr)
+        if isinstance(expr, MageSeqExpr):
+            out = set[str]()
+            for element in expr.elements:
+                out.update(self.first(element))
+                if not self.nullable(element):
+                    break
+            return out
+        if isinstance(expr, MageChoiceExpr):
+            out = set[str]()
+            for element in expr.elements:
+                out.update(self.first(element))
+            return out
+        if isinstance(expr, MageRepeatExpr):
+            return self.first(expr.expr) if expr.max > 0 else set()
+        if isinstance(expr, MageListExpr):
+            out = set(self.first(expr.element))
+            if self.nullable(expr.element):
+                out.update(self.first(expr.separator))
+            return out
+        if isinstance(expr, MageLookaheadExpr) \
+                or isinstance(expr, MageLitExpr) \
+                or isinstance(expr, MageCharSetExpr):
+            return set()
+        assert_never(expr)
+
+    def follow(self, expr: MageExpr) -> set[str]:
+        """
+        Get the names of the token rules that may come right after the given expression.
+
+        When an expression is part of a rule that is referenced multiple
+        times, the result combines all places where it is referenced.
+        """
+        return self.expr_follow.get(expr, set())
+
+    @property
+    def is_ll1(self) -> bool:
+        return not self.conflicts
+
+
+def analyse_ll1(grammar: MageGrammar, roots: Iterable[MageRule] | None = None) -> LL1Analysis:
+    """
+    Calculate nullability, FIRST-sets and FOLLOW-sets of the parse rules and
+    report everything that prevents a table-driven LL(1) parser from being
+    generated.
+
+    Only rules that are reachable from `roots` are checked. When `roots` is
+    not given, all parse rules are used.
+
+    This analysis only makes sense for grammars for which `is_tokenizable()`
+    returned `True`. Literals, character sets and lookaheads inside parse
+    rules are reported as conflicts.
+    """
+
+    if roots is None:
+        roots = list(rule for rule in grammar.rules if grammar.is_parse_rule(rule))
+    else:
+        roots = list(roots)
+
+    analysis = LL1Analysis(grammar, {}, {}, {}, [])
+
+    # Collect all nonterminals that are reachable from the roots
+
+    rules = SeqSet[MageRule]()
+
+    def collect_refs(expr: MageExpr) -> None:
+        if isinstance(expr, MageRefExpr):
+            rule = lookup_ref(expr)
+            if rule is not None and rule.expr is not None and not grammar.is_token_rule(rule) and rule not in rules:
+                rules.append(rule)
+                collect_refs(rule.expr)
+            return
+        for_each_direct_child_expr(expr, collect_refs)
+
+    for rule in roots:
+        if rule not in rules:
+            rules.append(rule)
+            if rule.expr is not None:
+                collect_refs(rule.expr)
+
+    # Nullability and FIRST-sets of rules are computed using a fixpoint
+
+    while True:
+        changed = False
+        for rule in rules:
+            if rule.expr is None:
+                continue
+            nullable = analysis.nullable(rule.expr)
+            if nullable != analysis.rule_nullable.get(rule, False):
+                analysis.rule_nullable[rule] = nullable
+                changed = True
+            first = analysis.first(rule.expr)
+            if first != analysis.rule_first.get(rule, set()):
+                analysis.rule_first[rule] = first
+                changed = True
+        if not changed:
+            break
+
+    # FOLLOW-sets are computed using a fixpoint as well
+
+    rule_follow = dict[MageRule, set[str]]()
+
+    def add_follow(expr: MageExpr, follow: set[str]) -> bool:
+        changed = False
+        existing = analysis.expr_follow.get(expr)
+        if existing is None:
+            existing = set[str]()
+            analysis.expr_follow[expr] = existing
+            changed = True
+        if not follow <= existing:
+            existing.update(follow)
+            changed = True
+        if isinstance(expr, MageRefExpr):
+            rule = lookup_ref(expr)
+            if rule is not None and rule.expr is not None and not grammar.is_token_rule(rule):
+                rule_existing = rule_follow.setdefault(rule, set())
+                if not follow <= rule_existing:
+                    rule_existing.update(follow)
+                    changed = True
+            return changed
+        if isinstance(expr, MageHideExpr) or isinstance(expr, MageLookaheadExpr):
+            return add_follow(expr.expr, follow) or changed
+        if isinstance(expr, MageSeqExpr):
+            for element in reversed(expr.elements):
+                changed = add_follow(element, follow) or changed
+                first = analysis.first(element)
+                follow = first | follow if analysis.nullable(element) else first
+            return changed
+        if isinstance(expr, MageChoiceExpr):
+            for element in expr.elements:
+                changed = add_follow(element, follow) or changed
+            return changed
+        if isinstance(expr, MageRepeatExpr):
+            if expr.max > 1:
+                follow = follow | analysis.first(expr.expr)
+            return add_follow(expr.expr, follow) or changed
+        if isinstance(expr, MageListExpr):
+            changed = add_follow(expr.element, follow | analysis.first(expr.separator)) or changed
+            changed = add_follow(expr.separator, analysis.first(expr.element)) or changed
+            return changed
+        if isinstance(expr, MageLitExpr) or isinstance(expr, MageCharSetExpr):
+            return changed
+        assert_never(expr)
+
+    while True:
+        changed = False
+        for rule in rules:
+            if rule.expr is not None:
+                changed = add_follow(rule.expr, rule_follow.get(rule, set())) or changed
+        if not changed:
+            break
+
+    # Finally, walk over all rules and report any decision that can't be made using one token
+
+    def format_tokens(tokens: set[str]) -> str:
+        return ', '.join(sorted(tokens))
+
+    def check(rule: MageRule, expr: MageExpr) -> None:
+
+        def report(message: str) -> None:
+            analysis.conflicts.append(LL1Conflict(rule, message))
+
+        if isinstance(expr, MageRefExpr):
+            target = lookup_ref(expr)
+            if target is None:
+                report(f"rule '{expr.name}' is undefined")
+            elif target.expr is None:
+                report(f"rule '{expr.name}' is external")
+            return
+
+        if isinstance(expr, MageLitExpr) or isinstance(expr, MageCharSetExpr):
+            report('characters can only be matched inside token rules')
+            return
+
+        if isinstance(expr, MageLookaheadExpr):
+            report('lookaheads are not supported')
+            return
+
+        if isinstance(expr, MageChoiceExpr):
+            seen = set[str]()
+            overlap = set[str]()
+            nullable_count = 0
+            for element in expr.elements:
+                first = analysis.first(element)
+                overlap.update(seen & first)
+                seen.update(first)
+                if analysis.nullable(element):
+                    nullable_count += 1
+            if overlap:
+                report(f'alternatives can start with the same tokens: {format_tokens(overlap)}')
+            if nullable_count > 1:
+                report('more than one alternative can be empty')
+            elif nullable_count == 1:
+                overlap = seen & analysis.follow(expr)
+                if overlap:
+                    report(f'an empty alternative can be followed by tokens that start another alternative: {format_tokens(overlap)}')
+
+        elif isinstance(expr, MageRepeatExpr):
+            if expr.max > expr.min:
+                if analysis.nullable(expr.expr):
+                    report('repeated expression can be empty')
+                overlap = analysis.first(expr.expr) & analysis.follow(expr)
+                if overlap:
+                    report(f'repeated expression can be followed by tokens that start it: {format_tokens(overlap)}')
+
+        elif isinstance(expr, MageListExpr):
+            if analysis.nullable(expr.element) or analysis.nullable(expr.separator):
+                report('element or separator of a list can be empty')
+            follow = analysis.follow(expr)
+            overlap = analysis.first(expr.separator) & follow
+            if expr.min_count == 0:
+                overlap.update(analysis.first(expr.element) & follow)
+            if overlap:
+                report(f'list can be followed by tokens that continue it: {format_tokens(overlap)}')
+
+        for_each_direct_child_expr(expr, lambda child: check(rule, child))
+
+    for rule in rules:
+        if rule.expr is None:
+            analysis.conflicts.append(LL1Conflict(rule, 'rule is external'))
+            continue
+        check(rule, rule.expr)
+
+    # Left-recursive rules would make the parser loop forever
+
+    def left_refs(expr: MageExpr) -> Generator[MageRule]:
+        if isinstance(expr, MageRefExpr):
+            rule = lookup_ref(expr)
+            if rule is not None and rule.expr is not None and not grammar.is_token_rule(rule):
+                yield rule
+        elif isinstance(expr, MageHideExpr) or isinstance(expr, MageRepeatExpr):
+            yield from left_refs(expr.expr)
+        elif isinstance(expr, MageSeqExpr):
+            for element in expr.elements:
+                yield from left_refs(element)
+                if not analysis.nullable(element):
+                    break
+        elif isinstance(expr, MageChoiceExpr):
+            for element in expr.elements:
+                yield from left_refs(element)
+        elif isinstance(expr, MageListExpr):
+            yield from left_refs(expr.element)
+            if analysis.nullable(expr.element):
+                yield from left_refs(expr.separator)
+
+    for rule in rules:
+        visited = set[MageRule]()
+        stack = [ nonnull(rule.expr) ] if rule.expr is not None else []
+        while stack:
+            expr = stack.pop()
+            for target in left_refs(expr):
+                if target is rule:
+                    analysis.conflicts.append(LL1Conflict(rule, 'rule is left-recursive'))
+                    stack.clear()
+                    break
+                if target not in visited:
+                    visited.add(target)
+                    stack.append(nonnull(target.expr))
+
+    return analysis
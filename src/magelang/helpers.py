@@ -431,7 +431,7 @@ def make_py_coercions(field_type: Type, *, specs: Specs, prefix: str, defs: dict
 
         coerced_type = normalize_type(UnionType(types))
 
-        id = f'{mangle_type(coerced_type)}_to_{mangle_type(ty)}'
+        id = f'{mangle_type(coerced_type, prefix)}_to_{mangle_type(ty, prefix)}'
         coerce_fn_name = f'_coerce_{id}'
 
         if id not in defs:
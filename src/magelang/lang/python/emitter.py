@@ -1,6 +1,5 @@
 
-from io import StringIO
-from typing import NewType, Sequence, assert_never
+from typing import Any, Callable, NewType, Sequence, assert_never
 from magelang.util import IndentWriter, panic
 
 from .cst import *
@@ -49,215 +48,92 @@ def _describe_infix_operator(op: PyInfixOp) -> tuple[int, _Assoc]:
     text = ' '.join(names)
     return _infix_operator_table[text]
 
-def emit_token(node: PyToken) -> str:
-
-    if isinstance(node, PyIdent):
-        return node.value
-
-    if isinstance(node, PyString):
-        return repr(node.value)
-
-    if isinstance(node, PyInteger):
-        return str(node.value)
-
-    if isinstance(node, PyFloat):
-        return str(node.value)
-
-    if isinstance(node, PyOpenBracket):
-        return '['
-
-    if isinstance(node, PyCloseBracket):
-        return ']'
-
-    if isinstance(node, PyOpenParen):
-        return '('
-
-    if isinstance(node, PyCloseParen):
-        return ')'
-
-    if isinstance(node, PyColon):
-        return ':'
-
-    if isinstance(node, PyRArrow):
-        return '->'
-
-    if isinstance(node, PyComma):
-        return ','
-
-    if isinstance(node, PyAsterisk):
-        return '*'
-
-    if isinstance(node, PyDot):
-        return '.'
-
-    if isinstance(node, PyDotDotDot):
-        return '...'
-
-    if isinstance(node, PyEquals):
-        return '='
-
-    if isinstance(node, PyBreakKeyword):
-        return 'break'
-
-    if isinstance(node, PyContinueKeyword):
-        return 'continue'
-
-    if isinstance(node, PyIfKeyword):
-        return 'if'
-
-    if isinstance(node, PyElifKeyword):
-        return 'elif'
-
-    if isinstance(node, PyElseKeyword):
-        return 'else'
-
-    if isinstance(node, PyWhileKeyword):
-        return 'while'
-
-    if isinstance(node, PyDefKeyword):
-        return 'def'
-
-    if isinstance(node, PyTryKeyword):
-        return 'try'
-
-    if isinstance(node, PyAsyncKeyword):
-        return 'async'
-
-    if isinstance(node, PyClassKeyword):
-        return 'class'
-
-    if isinstance(node, PyReturnKeyword):
-        return 'return'
-
-    if isinstance(node, PyFinallyKeyword):
-        return 'finally'
-
-    if isinstance(node, PyPassKeyword):
-        return 'pass'
-
-    if isinstance(node, PyForKeyword):
-        return 'for'
-
-    if isinstance(node, PyInKeyword):
-        return 'in'
-
-    if isinstance(node, PyExceptKeyword):
-        return 'except'
-
-    if isinstance(node, PyRaiseKeyword):
-        return 'raise'
-
-    if isinstance(node, PyFromKeyword):
-        return 'from'
-
-    if isinstance(node, PyImportKeyword):
-        return 'import'
-
-    if isinstance(node, PyHashtag):
-        return '#'
-
-    if isinstance(node, PyVerticalBar):
-        return '|'
-
-    if isinstance(node, PyTilde):
-        return '~'
-
-    if isinstance(node, PyTypeKeyword):
-        return 'type'
-
-    if isinstance(node, PyOrKeyword):
-        return 'or'
-
-    if isinstance(node, PyAndKeyword):
-        return 'and'
-
-    if isinstance(node, PyNotKeyword):
-        return 'not'
-
-    if isinstance(node, PyIsKeyword):
-        return 'is'
-
-    if isinstance(node, PyDelKeyword):
-        return 'del'
-
-    if isinstance(node, PyCaret):
-        return '^'
-
-    if isinstance(node, PyAsKeyword):
-        return 'as'
-
-    if isinstance(node, PyAtSign):
-        return '@'
-
-    if isinstance(node, PyGreaterThan):
-        return '>'
-
-    if isinstance(node, PyGreaterThanEquals):
-        return '>='
-
-    if isinstance(node, PyLessThan):
-        return '<'
-
-    if isinstance(node, PyLessThanEquals):
-        return '<='
-
-    if isinstance(node, PyGreaterThan):
-        return '>'
-
-    if isinstance(node, PyLessThanLessThan):
-        return '<<'
-
-    if isinstance(node, PyGreaterThanGreaterThan):
-        return '>>'
-
-    if isinstance(node, PyEqualsEquals):
-        return '=='
-
-    if isinstance(node, PySemicolon):
-        return ';'
-
-    if isinstance(node, PyNonlocalKeyword):
-        return 'nonlocal'
-
-    if isinstance(node, PyGlobalKeyword):
-        return 'global'
-
-    if isinstance(node, PySlash):
-        return '/'
-
-    if isinstance(node, PyPlus):
-        return '+'
-
-    if isinstance(node, PyHyphen):
-        return '-'
-
-    if isinstance(node, PyExclamationMarkEquals):
-        return '!='
-
-    if isinstance(node, PyAmpersand):
-        return '&'
-
-    if isinstance(node, PyPercent):
-        return '%'
-
-    if isinstance(node, PySlash):
-        return '/'
-
-    if isinstance(node, PyAsteriskAsterisk):
-        return '**'
+_token_texts: dict[type[PyToken], str] = {
+    PyOpenBracket: '[',
+    PyCloseBracket: ']',
+    PyOpenParen: '(',
+    PyCloseParen: ')',
+    PyColon: ':',
+    PyRArrow: '->',
+    PyComma: ',',
+    PyAsterisk: '*',
+    PyDot: '.',
+    PyDotDotDot: '...',
+    PyEquals: '=',
+    PyBreakKeyword: 'break',
+    PyContinueKeyword: 'continue',
+    PyIfKeyword: 'if',
+    PyElifKeyword: 'elif',
+    PyElseKeyword: 'else',
+    PyWhileKeyword: 'while',
+    PyDefKeyword: 'def',
+    PyTryKeyword: 'try',
+    PyAsyncKeyword: 'async',
+    PyClassKeyword: 'class',
+    PyReturnKeyword: 'return',
+    PyFinallyKeyword: 'finally',
+    PyPassKeyword: 'pass',
+    PyForKeyword: 'for',
+    PyInKeyword: 'in',
+    PyExceptKeyword: 'except',
+    PyRaiseKeyword: 'raise',
+    PyFromKeyword: 'from',
+    PyImportKeyword: 'import',
+    PyHashtag: '#',
+    PyVerticalBar: '|',
+    PyTilde: '~',
+    PyTypeKeyword: 'type',
+    PyOrKeyword: 'or',
+    PyAndKeyword: 'and',
+    PyNotKeyword: 'not',
+    PyIsKeyword: 'is',
+    PyDelKeyword: 'del',
+    PyCaret: '^',
+    PyAsKeyword: 'as',
+    PyAtSign: '@',
+    PyGreaterThan: '>',
+    PyGreaterThanEquals: '>=',
+    PyLessThan: '<',
+    PyLessThanEquals: '<=',
+    PyLessThanLessThan: '<<',
+    PyGreaterThanGreaterThan: '>>',
+    PyEqualsEquals: '==',
+    PySemicolon: ';',
+    PyNonlocalKeyword: 'nonlocal',
+    PyGlobalKeyword: 'global',
+    PySlash: '/',
+    PyPlus: '+',
+    PyHyphen: '-',
+    PyExclamationMarkEquals: '!=',
+    PyAmpersand: '&',
+    PyPercent: '%',
+    PyAsteriskAsterisk: '**',
+    PySlashSlash: '//',
+}
 
-    if isinstance(node, PySlashSlash):
-        return '//'
+_token_handlers: dict[type[PyToken], Callable[[Any], str]] = {
+    PyIdent: lambda node: node.value,
+    PyString: lambda node: repr(node.value),
+    PyInteger: lambda node: str(node.value),
+    PyFloat: lambda node: str(node.value),
+}
 
-    assert_never(node)
+def emit_token(node: PyToken) -> str:
+    text = _token_texts.get(type(node))
+    if text is not None:
+        return text
+    handler = _token_handlers.get(type(node))
+    if handler is None:
+        panic(f"Unexpected token {node}")
+    return handler(node)
 
 def is_wide(expr: PyExpr) -> bool:
     return not (isinstance(expr, PyNestExpr) or isinstance(expr, PyConstExpr) or isinstance(expr, PyNamedExpr) or isinstance(expr, PyCallExpr))
 
 def emit(node: PyNode) -> str:
 
-    string = StringIO()
-    out = IndentWriter(string, indentation='    ')
+    chunks = list[str]()
+    out = IndentWriter(chunks, indentation='    ')
 
     def visit_body(body: 'PyStmt | Sequence[PyStmt]', newline = '\n') -> None:
         if is_py_stmt(body):
@@ -433,6 +309,16 @@ def emit(node: PyNode) -> str:
             visit_token(node.close_paren)
             return
 
+        if isinstance(node, PySubscriptPattern):
+            visit_pattern(node.pattern)
+            visit_token(node.open_bracket)
+            for s, comma in node.slices:
+                visit(s)
+                if comma is not None:
+                    visit_token(comma)
+            visit_token(node.close_bracket)
+            return
+
         assert_never(node)
 
     prev_token = None
@@ -876,5 +762,5 @@ def emit(node: PyNode) -> str:
 
     visit(node)
 
-    return string.getvalue()
+    return ''.join(chunks)
 
@@ -4,7 +4,13 @@ from typing import assert_never
 from .cst import *
 
 
+_rust_token_texts = dict([(RustCloseBrace, '}'), (RustOpenBrace, '{'), (RustWhereKeyword, 'where'), (RustUseKeyword, 'use'), (RustUnsafeKeyword, 'unsafe'), (RustTrueKeyword, 'true'), (RustStructKeyword, 'struct'), (RustSelfKeyword, 'self'), (RustReturnKeyword, 'return'), (RustRefKeyword, 'ref'), (RustPubKeyword, 'pub'), (RustMutKeyword, 'mut'), (RustInKeyword, 'in'), (RustImplKeyword, 'impl'), (RustForKeyword, 'for'), (RustFnKeyword, 'fn'), (RustFalseKeyword, 'false'), (RustExternKeyword, 'extern'), (RustEnumKeyword, 'enum'), (RustDefaultKeyword, 'default'), (RustConstKeyword, 'const'), (RustAsyncKeyword, 'async'), (RustAsKeyword, 'as'), (RustCloseBracket, ']'), (RustOpenBracket, '['), (RustAtSign, '@'), (RustQuestionMark, '?'), (RustGreaterThan, '>'), (RustEquals, '='), (RustLessThan, '<'), (RustSemicolon, ';'), (RustColonColon, '::'), (RustColon, ':'), (RustDotDotDot, '...'), (RustRArrow, '->'), (RustComma, ','), (RustPlus, '+'), (RustAsterisk, '*'), (RustCloseParen, ')'), (RustOpenParen, '('), (RustSingleQuote, "'"), (RustAmpersand, '&'), (RustPercent, '%'), (RustHashtag, '#'), (RustExclamationMark, '!')])
+
+
 def rust_emit_token(token):
+    text = _rust_token_texts.get(type(token))
+    if text is not None:
+        return text
     if isinstance(token, RustIdent):
         return str(token.value)
     if isinstance(token, RustInteger):
@@ -15,96 +21,6 @@ def rust_emit_token(token):
         return str(token.value)
     if isinstance(token, RustChar):
         return str(token.value)
-    if isinstance(token, RustCloseBrace):
-        return '}'
-    if isinstance(token, RustOpenBrace):
-        return '{'
-    if isinstance(token, RustWhereKeyword):
-        return 'where'
-    if isinstance(token, RustUseKeyword):
-        return 'use'
-    if isinstance(token, RustUnsafeKeyword):
-        return 'unsafe'
-    if isinstance(token, RustTrueKeyword):
-        return 'true'
-    if isinstance(token, RustStructKeyword):
-        return 'struct'
-    if isinstance(token, RustSelfKeyword):
-        return 'self'
-    if isinstance(token, RustReturnKeyword):
-        return 'return'
-    if isinstance(token, RustRefKeyword):
-        return 'ref'
-    if isinstance(token, RustPubKeyword):
-        return 'pub'
-    if isinstance(token, RustMutKeyword):
-        return 'mut'
-    if isinstance(token, RustInKeyword):
-        return 'in'
-    if isinstance(token, RustImplKeyword):
-        return 'impl'
-    if isinstance(token, RustForKeyword):
-        return 'for'
-    if isinstance(token, RustFnKeyword):
-        return 'fn'
-    if isinstance(token, RustFalseKeyword):
-        return 'false'
-    if isinstance(token, RustExternKeyword):
-        return 'extern'
-    if isinstance(token, RustEnumKeyword):
-        return 'enum'
-    if isinstance(token, RustDefaultKeyword):
-        return 'default'
-    if isinstance(token, RustConstKeyword):
-        return 'const'
-    if isinstance(token, RustAsyncKeyword):
-        return 'async'
-    if isinstance(token, RustAsKeyword):
-        return 'as'
-    if isinstance(token, RustCloseBracket):
-        return ']'
-    if isinstance(token, RustOpenBracket):
-        return '['
-    if isinstance(token, RustAtSign):
-        return '@'
-    if isinstance(token, RustQuestionMark):
-        return '?'
-    if isinstance(token, RustGreaterThan):
-        return '>'
-    if isinstance(token, RustEquals):
-        return '='
-    if isinstance(token, RustLessThan):
-        return '<'
-    if isinstance(token, RustSemicolon):
-        return ';'
-    if isinstance(token, RustColonColon):
-        return '::'
-    if isinstance(token, RustColon):
-        return ':'
-    if isinstance(token, RustDotDotDot):
-        return '...'
-    if isinstance(token, RustRArrow):
-        return '->'
-    if isinstance(token, RustComma):
-        return ','
-    if isinstance(token, RustPlus):
-        return '+'
-    if isinstance(token, RustAsterisk):
-        return '*'
-    if isinstance(token, RustCloseParen):
-        return ')'
-    if isinstance(token, RustOpenParen):
-        return '('
-    if isinstance(token, RustSingleQuote):
-        return "'"
-    if isinstance(token, RustAmpersand):
-        return '&'
-    if isinstance(token, RustPercent):
-        return '%'
-    if isinstance(token, RustHashtag):
-        return '#'
-    if isinstance(token, RustExclamationMark):
-        return '!'
     assert_never(token)
 
 
@@ -96,16 +96,23 @@ def is_static_type(ty: Type, specs: Specs) -> bool:
     return visit(ty)
 
 
-def mangle_type(ty: Type) -> str:
+def mangle_type(ty: Type, prefix: str = '') -> str:
+    """
+    Turn `ty` into a name that can be used as part of an identifier.
+
+    `prefix` is the prefix of the generated classes. It is included in the
+    names of specs, so that types that refer to different classes never get
+    the same name.
+    """
     if isinstance(ty, SpecType):
-        return f'decl_{ty.name}'
+        return f'decl_{prefix}_{ty.name}' if prefix else f'decl_{ty.name}'
     if isinstance(ty, TupleType):
         out = f'tuple_{len(ty.element_types)}'
         for ty in ty.element_types:
-            out += '_' + mangle_type(ty)
+            out += '_' + mangle_type(ty, prefix)
         return out
     if isinstance(ty, ListType):
-        out = f'list_{mangle_type(ty.element_type)}'
+        out = f'list_{mangle_type(ty.element_type, prefix)}'
         if ty.required:
             out += '_required'
         return out
@@ -118,10 +125,10 @@ def mangle_type(ty: Type) -> str:
     if isinstance(ty, UnionType):
         out = f'union_{len(ty.types)}'
         for ty in ty.types:
-            out += '_' + mangle_type(ty)
+            out += '_' + mangle_type(ty, prefix)
         return out
     if isinstance(ty, PunctType):
-        out = f'punct_{mangle_type(ty.element_type)}_{mangle_type(ty.separator_type)}'
+        out = f'punct_{mangle_type(ty.element_type, prefix)}_{mangle_type(ty.separator_type, prefix)}'
         if ty.required:
             out += '_required'
         return out
@@ -3,13 +3,13 @@ from pathlib import Path
 from pprint import pprint
 from typing import Unpack
 
-from magelang import GenerateConfig, TargetLanguage, generate_files, load_grammar, mage_check, write_files
+from magelang import GenerateConfig, TargetLanguage, default_config, generate_files, load_grammar, mage_check, mage_prepare_grammar, write_files
 from magelang.constants import SEED_FILENAME_PREFIX
 from magelang.lang.python.cst import PyModule
 from magelang.lang.revolv.ast import Program
 from magelang.util import Files, Progress, load_py_file
 
-from .manager import Context, apply, compose, get_pass_by_name, identity
+from .manager import Context, apply, compose, get_pass_by_name, identity, pipeline
 from .logging import error, info
 from .lang.mage.ast import *
 from .lang.mage.emitter import emit as mage_emit
@@ -18,6 +18,8 @@ from .lang.mage.scanner import Scanner
 from .lang.python.emitter import emit as py_emit
 from .fuzz import fuzz_all, fuzz_grammar, generate_and_load_parser, random_grammar
 from .eval import NO_MATCH, RECMAX, SUCCESS, evaluate
+from .passes import mage_flatten_grammars, mage_to_python_lexer, mage_to_python_parser
+from .stats import collect_module_stats
 
 
 def _grammar_from_file_or_seed(filename: str) -> MageGrammar:
@@ -79,12 +81,16 @@ def generate(
     """
     grammar = _grammar_from_file_or_seed(filename)
     out_dir = Path(out_dir)
-    files = cast(Files, generate_files(
+    files = generate_files(
         grammar,
         lang,
         debug=debug,
         **opts,
-    ))
+    )
+    if files is None:
+        return 1
+    if isinstance(files, str):
+        files = { '__init__.py': files }
     write_files(files, out_dir, force)
     return 0
 
@@ -193,6 +199,28 @@ def dump(filename: str, *passes: str,  **opts: Any) -> int:
         return 1
     return 0
 
+def stats(filename: str, /, *, limit: int | None = None) -> int:
+    """
+    Show how much code is generated for each rule of a grammar
+    """
+    grammar = _grammar_from_file_or_seed(filename)
+    ctx = Context(cast(dict[str, Any], default_config('python', False)), silent=True)
+    grammar = apply(ctx, grammar, mage_prepare_grammar)
+    rows = list[tuple[str, Any]]()
+    for rule_stats in collect_module_stats(apply(ctx, grammar, mage_to_python_parser)):
+        rows.append(('parser', rule_stats))
+    if any(rule.is_lexer_token for rule in grammar.rules):
+        for rule_stats in collect_module_stats(apply(ctx, grammar, pipeline(mage_flatten_grammars, mage_to_python_lexer))):
+            rows.append(('lexer', rule_stats))
+    rows.sort(key=lambda row: row[1].stmts, reverse=True)
+    if limit is not None:
+        rows = rows[:limit]
+    width = max((len(rule_stats.name) for _, rule_stats in rows), default=4)
+    print(f"{'kind':<6}  {'name':<{width}}  {'stmts':>6}  {'depth':>5}  {'forks':>5}  {'joins':>5}  {'backtracks':>10}")
+    for kind, rule_stats in rows:
+        print(f'{kind:<6}  {rule_stats.name:<{width}}  {rule_stats.stmts:>6}  {rule_stats.max_depth:>5}  {rule_stats.forks:>5}  {rule_stats.joins:>5}  {rule_stats.backtracks:>10}')
+    return 0
+
 def fuzz(filename: str | None = None, /, *, all: bool = False, limit: int | None = None, break_on_failure: bool = False) -> int:
     progress = Progress()
     progress.start()
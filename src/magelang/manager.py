@@ -1,6 +1,7 @@
 
 import inspect
 from abc import abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any, Callable, Generic, Protocol, TypeVar, overload
 from .logging import info, warn
 
@@ -145,6 +146,31 @@ def each_value(pass_: Pass[_T, _R]) -> Pass[dict[_K, _T], dict[_K, _R]]:
 
     return _wrapper
 
+def _distribute_in_worker(args: tuple[Context, Any, Callable[[Context], dict[Any, Pass[Any, Any]]], Any]) -> Any:
+    ctx, input, get_map, key = args
+    return apply(ctx, input, get_map(ctx)[key])
+
+def distribute_parallel(get_map: Callable[[Context], dict[_K, Pass[_T, _R]]]) -> Pass[_T, dict[_K, _R]]:
+    """
+    Like `distribute()` but spreads the passes over a pool of processes.
+
+    The size of the pool is taken from the `jobs` option. Passes that are
+    built with `pipeline()` can't be sent to another process, so each
+    process creates them again with `get_map`. Only the input and the
+    results are sent between processes, so `get_map`, the input and the
+    results must be picklable.
+    """
+
+    def _wrapper(input: _T, ctx: Context, jobs: int = 1) -> dict[_K, _R]:
+        map = get_map(ctx)
+        if jobs <= 1 or len(map) <= 1:
+            return apply(ctx, input, distribute(map))
+        with ProcessPoolExecutor(max_workers=min(jobs, len(map))) as executor:
+            results = executor.map(_distribute_in_worker, ((ctx, input, get_map, key) for key in map))
+            return dict(zip(map.keys(), results))
+
+    return _wrapper
+
 def map_key(proc: Callable[[_K1], _K2]) -> Pass[dict[_K1, _T], dict[_K2, _T]]:
 
     def _wrapper(input: dict[_K1, _T]) -> dict[_K2, _T]:
@@ -160,6 +186,14 @@ def compose(a: Pass[_T, _R], b: Pass[_R, _S]) -> Pass[_T, _S]:
         return apply(ctx, apply(ctx, input, a), b)
     return _wrapper
 
+def with_options(pass_: Pass[_T, _R], **opts: Any) -> Pass[_T, _R]:
+    """
+    Run `pass_` with some of the options of the context replaced by `opts`.
+    """
+    def _wrapper(input: _T, ctx: Context) -> _R:
+        return apply(Context(ctx.opts | opts, silent=ctx.silent), input, pass_)
+    return _wrapper
+
 _T0 = TypeVar('_T0')
 _T1 = TypeVar('_T1')
 _T2 = TypeVar('_T2')
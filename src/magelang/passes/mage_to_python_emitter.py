@@ -12,15 +12,22 @@ from magelang.manager import declare_pass
 from magelang.util import unreachable
 from magelang.helpers import PyCondCase, make_py_cond, treespec_type_to_shallow_py_test, namespaced, to_py_class_name, make_py_isinstance
 
+from .mage_to_treespec import mage_to_treespec
+
 @declare_pass()
 def mage_to_python_emitter(
     grammar: MageGrammar,
     prefix: str = '',
     include_hidden: bool = False,
+    enable_trivia: bool = False,
 ) -> PyModule:
 
     skip_rule = MageRule('___', MageLitExpr(' ')) # grammar.skip_rule # FIXME
+    # Needed to test which member of a choice a field holds
+    specs = mage_to_treespec(grammar, include_hidden=include_hidden)
     emit_node_fn_name = namespaced('emit', prefix)
+    write_node_fn_name = namespaced('write', prefix)
+    write_fn_name = 'write'
     visit_fn_name = 'visit'
     emit_token_fn_name = namespaced('emit_token', prefix)
     token_param_name = 'token'
@@ -42,7 +49,7 @@ def mage_to_python_emitter(
         yield gen_write(PyCallExpr(PyNamedExpr(emit_token_fn_name), args=[ target ]))
 
     def gen_write(expr: PyExpr) -> PyStmt:
-        return PyAugAssignStmt(PyNamedPattern(out_name), PyPlus(), expr)
+        return PyExprStmt(PyCallExpr(PyNamedExpr(write_fn_name), args=[ expr ]))
 
     def gen_skip() -> Generator[PyStmt, None, None]:
         assert(skip_rule is not None and skip_rule.expr is not None)
@@ -175,6 +182,7 @@ def mage_to_python_emitter(
             else:
                 element_name = 'element'
                 separator_name = 'separator'
+                # Iterating over the pairs yields `None` for a missing final separator
                 yield PyForStmt(
                     pattern=PyTuplePattern(
                         elements=[
@@ -182,24 +190,22 @@ def mage_to_python_emitter(
                             PyNamedPattern(separator_name)
                         ],
                     ),
-                    expr=PyAttrExpr(target, 'elements'),
+                    expr=target,
                     body=[
                         *gen_emit_expr(expr.element, PyNamedExpr(element_name), skip),
-                        *gen_emit_expr(expr.separator, PyNamedExpr(separator_name), skip),
+                        PyIfStmt(first=PyIfCase(
+                            test=PyInfixExpr(PyNamedExpr(separator_name), (PyIsKeyword(), PyNotKeyword()), PyNamedExpr('None')),
+                            body=list(gen_emit_expr(expr.separator, PyNamedExpr(separator_name), skip)),
+                        )),
                     ]
                 )
-                yield PyIfStmt(first=PyIfCase(
-                    test=PyInfixExpr(PyAttrExpr(target, 'last'), (PyIsKeyword(), PyNotKeyword()), PyNamedExpr('None')),
-                    body=list(gen_emit_expr(expr.element, PyAttrExpr(target, 'last'), skip))
-                ))
         else:
             assert_never(expr)
 
+    token_texts = list[tuple[str, str]]()
     emit_token_body = []
 
-    visit_node_body: list[PyStmt] = [
-        PyNonlocalStmt([ out_name ]),
-    ]
+    visit_node_body: list[PyStmt] = []
 
     for rule in grammar.elements:
 
@@ -208,9 +214,9 @@ def mage_to_python_emitter(
                 # TODO cover this case
                 continue
             if grammar.is_static_token_rule(rule):
-                expr = PyConstExpr(static_expr_to_str(rule.expr))
-            else:
-                expr = PyCallExpr(PyNamedExpr('str'), args=[ PyAttrExpr(PyNamedExpr(token_param_name), 'value') ])
+                token_texts.append((to_py_class_name(rule.name, prefix), static_expr_to_str(rule.expr)))
+                continue
+            expr = PyCallExpr(PyNamedExpr('str'), args=[ PyAttrExpr(PyNamedExpr(token_param_name), 'value') ])
             emit_token_body.append(
                 PyIfStmt(PyIfCase(
                     test=make_py_isinstance(PyNamedExpr(token_param_name), PyNamedExpr(to_py_class_name(rule.name, prefix))),
@@ -241,6 +247,10 @@ def mage_to_python_emitter(
         elif rule == grammar.skip_rule:
             pass
 
+        elif not rule.is_public:
+            # Private rules are emitted where they are referenced
+            pass
+
         else:
             print(rule.name)
             unreachable()
@@ -249,33 +259,98 @@ def mage_to_python_emitter(
         PyExprStmt(PyCallExpr(PyNamedExpr('assert_never'), args=[ PyNamedExpr(token_param_name) ]))
     )
 
-    return PyModule(stmts=[
+    # Static tokens are looked up by their exact type, leaving only the
+    # tokens that carry a value for the isinstance-checks
+    token_texts_name = '_' + namespaced('token_texts', prefix)
+    text_name = 'text'
+    emit_token_body = [
+        PyAssignStmt(PyNamedPattern(text_name), value=PyCallExpr(
+            PyAttrExpr(PyNamedExpr(token_texts_name), 'get'),
+            args=[ PyCallExpr(PyNamedExpr('type'), args=[ PyNamedExpr(token_param_name) ]) ]
+        )),
+        PyIfStmt(first=PyIfCase(
+            test=PyInfixExpr(PyNamedExpr(text_name), (PyIsKeyword(), PyNotKeyword()), PyNamedExpr('None')),
+            body=[ PyRetStmt(expr=PyNamedExpr(text_name)) ]
+        )),
+        *emit_token_body,
+    ]
+
+    stmts: list[PyStmt] = [
         PyImportFromStmt(
             PyAbsolutePath('typing'),
-            [ PyFromAlias('assert_never') ],
+            [ PyFromAlias('TextIO'), PyFromAlias('assert_never') ],
         ),
         PyImportFromStmt(
             PyRelativePath(dots=1, name='cst'),
             [ PyFromAlias(PyAsterisk()) ],
         ),
+        PyAssignStmt(
+            PyNamedPattern(token_texts_name),
+            value=PyCallExpr(PyNamedExpr('dict'), args=[
+                PyListExpr(elements=list(PyTupleExpr(elements=[ PyNamedExpr(class_name), PyConstExpr(text) ]) for class_name, text in token_texts))
+            ])
+        ),
         PyFuncDef(
             name=emit_token_fn_name,
             params=[ PyNamedParam(PyNamedPattern(token_param_name)) ],
             body=emit_token_body,
         ),
         PyFuncDef(
-            name=emit_node_fn_name,
-            params=[ PyNamedParam(PyNamedPattern(param_name)) ],
+            name=write_node_fn_name,
+            params=[
+                PyNamedParam(PyNamedPattern(param_name)),
+                PyNamedParam(PyNamedPattern(out_name), annotation=PyConstExpr('TextIO | list[str]')),
+            ],
+            return_type=PyNamedExpr('None'),
             body=[
-                PyAssignStmt(PyNamedPattern(out_name), value=PyConstExpr('')),
+                # Bind the method once instead of looking it up for every fragment
+                PyAssignStmt(PyNamedPattern(write_fn_name), value=PyIfExpr(
+                    PyAttrExpr(PyNamedExpr(out_name), 'append'),
+                    make_py_isinstance(PyNamedExpr(out_name), PyNamedExpr('list')),
+                    PyAttrExpr(PyNamedExpr(out_name), 'write'),
+                )),
                 PyFuncDef(
                     name=visit_fn_name,
                     params=[ PyNamedParam(PyNamedPattern(param_name)) ],
                     body=visit_node_body
                 ),
                 PyExprStmt(PyCallExpr(PyNamedExpr(visit_fn_name), args=[ PyNamedExpr(param_name) ])),
-                PyRetStmt(expr=PyNamedExpr(out_name)),
             ],
         ),
-    ])
+        PyFuncDef(
+            name=emit_node_fn_name,
+            params=[ PyNamedParam(PyNamedPattern(param_name)) ],
+            return_type=PyNamedExpr('str'),
+            body=[
+                PyAssignStmt(PyNamedPattern('chunks'), value=PyListExpr()),
+                PyExprStmt(PyCallExpr(PyNamedExpr(write_node_fn_name), args=[ PyNamedExpr(param_name), PyNamedExpr('chunks') ])),
+                PyRetStmt(expr=PyCallExpr(PyAttrExpr(PyConstExpr(''), 'join'), args=[ PyNamedExpr('chunks') ])),
+            ],
+        ),
+    ]
+
+    if enable_trivia:
+        # Right after the other imports
+        stmts.insert(2, PyImportFromStmt(
+            PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')),
+            [ PyFromAlias('TriviaTable'), PyFromAlias('emit_lossless') ],
+        ))
+        stmts.append(PyFuncDef(
+            name=namespaced('emit_lossless', prefix),
+            params=[
+                PyNamedParam(PyNamedPattern(param_name)),
+                PyNamedParam(PyNamedPattern('trivia'), annotation=PyNamedExpr('TriviaTable')),
+            ],
+            return_type=PyNamedExpr('str'),
+            body=[
+                PyRetStmt(expr=PyCallExpr(PyNamedExpr('emit_lossless'), args=[
+                    PyNamedExpr(param_name),
+                    PyNamedExpr('trivia'),
+                    PyNamedExpr(emit_node_fn_name),
+                    PyNamedExpr(emit_token_fn_name),
+                ])),
+            ],
+        ))
+
+    return PyModule(stmts=stmts)
 
@@ -11,6 +11,7 @@ from magelang.helpers import make_py_cond, make_py_or, extern_type_to_py_type, t
 def mage_to_python_lexer(
     grammar: MageGrammar,
     prefix = '',
+    enable_trivia: bool = False,
 ) -> PyModule:
 
     lexer_class_name = to_py_class_name('lexer', prefix)
@@ -18,6 +19,15 @@ def mage_to_python_lexer(
 
     generate_temporary = NameGenerator()
 
+    def make_token(expr: PyExpr) -> PyExpr:
+        if not enable_trivia:
+            return expr
+        return PyCallExpr(PyAttrExpr(PyNamedExpr('self'), '_record'), args=[
+            expr,
+            PyNamedExpr('start'),
+            PyNamedExpr(char_offset_name),
+        ])
+
     keywords = []
     for rule in grammar.rules:
         if rule.is_keyword:
@@ -113,9 +123,9 @@ def mage_to_python_lexer(
                     ))
                     out.extend(make_py_cond(list((
                         PyInfixExpr(PyNamedExpr('text'), PyEqualsEquals(), PyConstExpr(kw_text)),
-                        [ PyRetStmt(expr=PyCallExpr(operator=PyNamedExpr(to_py_class_name(kw_name, prefix)))) ]
+                        [ PyRetStmt(expr=make_token(PyCallExpr(operator=PyNamedExpr(to_py_class_name(kw_name, prefix))))) ]
                     ) for kw_name, kw_text in keywords)))
-                out.append(PyRetStmt(expr=PyCallExpr(operator=PyNamedExpr(to_py_class_name(nonnull(rule).name, prefix)), args=token_args)))
+                out.append(PyRetStmt(expr=make_token(PyCallExpr(operator=PyNamedExpr(to_py_class_name(nonnull(rule).name, prefix)), args=token_args))))
                 return out
 
             success = new_success
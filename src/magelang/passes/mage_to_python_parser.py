@@ -1,10 +1,12 @@
 
-from magelang.helpers import PyCondCase, get_fields, infer_type, make_py_cond, make_py_or, make_py_union, to_py_class_name
+from magelang.helpers import PyCondCase, get_fields, infer_type, make_py_cond, make_py_or, make_py_union, to_py_class_name, treespec_type_to_py_type
 from magelang.lang.mage.ast import *
 from magelang.lang.python.cst import *
 from magelang.lang.mage.constants import string_rule_type, builtin_types
 from magelang.analysis import is_eof, is_tokenizable
 from magelang.lang.treespec.ast import ExternType, Type
+from magelang.lang.treespec.helpers import is_optional_type, is_unit_type
+from magelang.lang.mage.emitter import emit as mage_emit
 from magelang.manager import declare_pass
 from magelang.util import NameGenerator
 
@@ -16,6 +18,9 @@ type RejectFn = Callable[[], Generator[PyStmt]]
 
 MAX_LINES_DUPLICATE = 1
 
+# Expressions that occur more than once and generate more lines than this are parsed by a shared helper function
+MAX_LINES_INLINE = 20
+
 def _lift_body(body: PyStmt | list[PyStmt]) -> list[PyStmt]:
     return body if isinstance(body, list) else [ body ]
 
@@ -148,12 +153,18 @@ def mage_to_python_parser(
     prefix: str = '',
     emit_single_file: bool = False,
     silent: bool = False,
+    enable_structural_eq: bool = False,
+    enable_red_green: bool = False,
 ) -> PyModule:
 
     enable_tokens = is_tokenizable(grammar)
     buffer_name = 'buffer'
     stream_type_name = 'ParseStream' if enable_tokens else 'CharStream'
 
+    # Nodes are handed to an interner as soon as they are parsed, so that
+    # equal nodes can be shared or the tree can be built as a green tree
+    enable_interning = enable_tokens and (enable_structural_eq or enable_red_green)
+
     if not enable_tokens and not silent:
         print('Warning: grammar could not be tokenized. We will fall back to a more generic algorithm.')
 
@@ -163,6 +174,11 @@ def mage_to_python_parser(
         PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')),
         [ PyFromAlias('Punctuated'), PyFromAlias(stream_type_name), PyFromAlias('EOF') ]
     ))
+    if enable_interning:
+        stmts.append(PyImportFromStmt(
+            PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')),
+            [ PyFromAlias('Interner') ]
+        ))
     if not emit_single_file:
         stmts.append(PyImportFromStmt(
             PyRelativePath(1, name='cst'),
@@ -172,6 +188,18 @@ def mage_to_python_parser(
     def get_parse_method_name(rule: MageRule) -> str:
          return f'parse_{rule.name}'
 
+    def make_parse_params() -> list[PyParam]:
+        params: list[PyParam] = [ PyNamedParam(PyNamedPattern('stream'), annotation=PyNamedExpr(stream_type_name)) ]
+        if enable_interning:
+            params.append(PyNamedParam(PyNamedPattern('interner'), annotation=PyConstExpr('Interner | None'), default=PyNamedExpr('None')))
+        return params
+
+    def make_parse_args(stream_name: str) -> list[PyArg]:
+        args: list[PyArg] = [ PyNamedExpr(stream_name) ]
+        if enable_interning:
+            args.append(PyNamedExpr('interner'))
+        return args
+
     def make_init(ty: Type) -> PyExpr:
         if isinstance(ty, ExternType):
             if ty.name == string_rule_type:
@@ -188,12 +216,17 @@ def mage_to_python_parser(
 
     noop: list[PyStmt] = []
 
-    def gen_parse_body(rule: MageRule) -> Generator[PyStmt]:
+    # Maps the id() of an expression to the helper function that parses it
+    helper_names = dict[int, str]()
+
+    def gen_parse_body(rule: MageRule, fragment: MageExpr | None = None) -> Generator[PyStmt]:
 
         inside_token = grammar.is_token_rule(rule)
 
         generate_name = NameGenerator()
         generate_name('stream') # Mark function parameter as being in use
+        if enable_interning:
+            generate_name('interner')
         generate_name('buffer') # Mark buffer as being in use
         generate_name('c') # Start counting from 0
 
@@ -231,7 +264,17 @@ def mage_to_python_parser(
                         (None, reject),
                     ])
 
-            if is_eof(expr):
+            helper_name = helper_names.get(id(expr))
+            if helper_name is not None and expr is not fragment:
+                yield PyAssignStmt(PyNamedPattern(target_name), value=PyCallExpr(PyNamedExpr(helper_name), args=make_parse_args(stream_name)))
+                yield from gen_if_stmt(
+                    PyInfixExpr(PyNamedExpr(target_name), PyIsKeyword(), PyNamedExpr('None')),
+                    accept,
+                    reject,
+                    True
+                )
+
+            elif is_eof(expr):
                 temp = generate_name('c')
                 yield PyAssignStmt(PyNamedPattern(temp), value=PyCallExpr(PyAttrExpr(PyNamedExpr(stream_name), 'peek')))
                 yield from gen_if_stmt(PyInfixExpr(PyNamedExpr(temp), PyEqualsEquals(), PyNamedExpr('EOF')), accept, reject, False)
@@ -283,7 +326,7 @@ def mage_to_python_parser(
 
                 if grammar.is_parse_rule(rule):
                     method_name = get_parse_method_name(rule)
-                    yield PyAssignStmt(PyNamedPattern(target_name), value=PyCallExpr(PyNamedExpr(method_name), args=[ PyNamedExpr(stream_name) ]))
+                    yield PyAssignStmt(PyNamedPattern(target_name), value=PyCallExpr(PyNamedExpr(method_name), args=make_parse_args(stream_name)))
                     yield from gen_if_stmt(
                         PyInfixExpr(PyNamedExpr(target_name), PyIsKeyword(), PyNamedExpr('None')),
                         accept,
@@ -489,17 +532,27 @@ def mage_to_python_parser(
                                 [
                                     PyExprStmt(
                                         PyCallExpr(
-                                            PyAttrExpr(PyNamedExpr(element_name), 'append'),
+                                            PyAttrExpr(PyNamedExpr(target_name), 'append'),
                                             args=[ PyNamedExpr(element_name), PyNamedExpr(separator_name) ]
                                         )
                                     )
                                 ],
-                                reject,
+                                [
+                                    # The last element is not followed by a separator
+                                    PyExprStmt(
+                                        PyCallExpr(
+                                            PyAttrExpr(PyNamedExpr(target_name), 'append_final'),
+                                            args=[ PyNamedExpr(element_name) ]
+                                        )
+                                    ),
+                                    PyBreakStmt(),
+                                ],
                             )),
                             [ PyBreakStmt() ],
                         ),
                     ]
                 )
+                yield from accept
 
             elif isinstance(expr, MageSeqExpr):
                 indices = list[tuple[int, str]]()
@@ -524,8 +577,6 @@ def mage_to_python_parser(
                     head = list(visit_field_internals(element, stream_name, element_name, head, reject))
                 yield from head
 
-                yield from accept
-
             elif isinstance(expr, MageLookaheadExpr):
                 new_stream_name = generate_name('stream')
                 yield PyAssignStmt(PyNamedPattern(new_stream_name), value=PyCallExpr(PyAttrExpr(PyNamedExpr(stream_name), 'fork')))
@@ -547,9 +598,9 @@ def mage_to_python_parser(
                 head = list(visit_field_internals(expr, stream_name, field_name, new_accept, reject))
             yield from head
 
-        if grammar.is_variant_rule(rule):
+        if fragment is not None or grammar.is_variant_rule(rule):
             yield from visit_field_internals(
-                nonnull(rule.expr),
+                fragment or nonnull(rule.expr),
                 'stream',
                 'result',
                 [ PyRetStmt(expr=PyNamedExpr('result')) ],
@@ -566,22 +617,77 @@ def mage_to_python_parser(
             return
 
         fields = list(field for _, field in get_fields(nonnull(rule.expr), grammar=grammar) if field is not None)
-        return_struct: list[PyStmt] = [
-            PyRetStmt(
-                expr=PyCallExpr(
-                    PyNamedExpr(to_py_class_name(rule.name, prefix=prefix)),
-                    args=list(PyKeywordArg(field.name, PyNamedExpr(field.name)) for field in fields)
-                )
-            )
-        ]
+        # The parsed fields already have the right types so the coercions in `__init__` can be skipped
+        make_node = PyCallExpr(
+            PyAttrExpr(PyNamedExpr(to_py_class_name(rule.name, prefix=prefix)), '_make'),
+            args=list(PyKeywordArg(field.name, PyNamedExpr(field.name)) for field in fields)
+        )
+        return_struct: list[PyStmt]
+        if enable_interning:
+            node_name = generate_name('node')
+            return_struct = [
+                PyAssignStmt(PyNamedPattern(node_name), value=make_node),
+                *make_py_cond([
+                    (
+                        PyInfixExpr(PyNamedExpr('interner'), PyIsKeyword(), PyNamedExpr('None')),
+                        [ PyRetStmt(expr=PyNamedExpr(node_name)) ],
+                    ),
+                    (None, [ PyRetStmt(expr=PyCallExpr(PyAttrExpr(PyNamedExpr('interner'), 'intern'), args=[ PyNamedExpr(node_name) ])) ]),
+                ]),
+            ]
+        else:
+            return_struct = [ PyRetStmt(expr=make_node) ]
 
         yield from visit_fields(nonnull(rule.expr), 'stream', return_struct, [ PyRetStmt() ])
 
+    def is_generated(element: MageRule) -> bool:
+        return grammar.is_parse_rule(element) or (not enable_tokens and grammar.is_token_rule(element))
+
+    def can_share(expr: MageExpr) -> bool:
+        if not (isinstance(expr, MageChoiceExpr) or isinstance(expr, MageRepeatExpr) or isinstance(expr, MageListExpr) or isinstance(expr, MageSeqExpr)):
+            return False
+        # The helper returns None when parsing failed, so a successful parse may never result in None
+        ty = infer_type(expr, grammar)
+        return not is_optional_type(ty) and not is_unit_type(ty)
+
+    # Private rules were already inlined in the grammar, so every reference
+    # to them became a copy of their expression. Copies are found by
+    # printing them, which gives the same text for the same parse logic.
+    occurrences = dict[str, list[tuple[MageRule, MageExpr]]]()
+    for element in grammar.elements:
+        # Token rules are skipped because their fields are also appended to a buffer
+        if grammar.is_parse_rule(element) and element.expr is not None:
+            for expr, _ in get_fields(element.expr, grammar=grammar):
+                if can_share(expr):
+                    occurrences.setdefault(mage_emit(expr), []).append((element, expr))
+
+    generate_helper_name = NameGenerator()
+    helpers = list[PyStmt]()
+    for copies in occurrences.values():
+        if len(copies) < 2:
+            continue
+        rule, expr = copies[0]
+        body = list(gen_parse_body(rule, expr))
+        if count_lines(body) <= MAX_LINES_INLINE:
+            continue
+        helper_name = generate_helper_name(f'_parse_{expr.label}' if expr.label is not None else '_parse_fragment')
+        for _, copy in copies:
+            helper_names[id(copy)] = helper_name
+        helpers.append(PyFuncDef(
+            name=helper_name,
+            params=make_parse_params(),
+            return_type=make_py_union([
+                treespec_type_to_py_type(infer_type(expr, grammar), prefix=prefix),
+                PyNamedExpr('None'),
+            ]),
+            body=body,
+        ))
+
     for element in grammar.elements:
-        if grammar.is_parse_rule(element) or (not enable_tokens and grammar.is_token_rule(element)):
+        if is_generated(element):
             stmts.append(PyFuncDef(
                 name=f'parse_{element.name}',
-                params=[ PyNamedParam(PyNamedPattern('stream'), annotation=PyNamedExpr(stream_type_name)) ],
+                params=make_parse_params(),
                 return_type=make_py_union([
                     PyNamedExpr(to_py_class_name(element.name, prefix=prefix)),
                     PyNamedExpr('None'),
@@ -589,4 +695,6 @@ def mage_to_python_parser(
                 body=list(gen_parse_body(element))
             ))
 
+    stmts.extend(helpers)
+
     return PyModule(stmts=stmts)
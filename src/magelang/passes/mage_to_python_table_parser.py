@@ -0,0 +1,292 @@
+from magelang.analysis import analyse_ll1, is_tokenizable
+from magelang.helpers import get_fields, make_py_union, to_py_class_name
+from magelang.lang.mage.ast import *
+from magelang.lang.python.cst import *
+from magelang.logging import warn
+from magelang.manager import declare_pass
+from magelang.runtime import OP_APPEND, OP_CALL, OP_JUMP, OP_LIST, OP_MIN, OP_NODE, OP_NONE, OP_POP, OP_PUNCT, OP_PUNCT_APPEND, OP_PUNCT_FINAL, OP_RET, OP_SWITCH, OP_TOKEN, OP_TUPLE
+from magelang.util import unreachable
+
+from .mage_insert_magic_rules import any_node_rule_name, any_syntax_rule_name
+from .mage_to_python_parser import mage_to_python_parser
+
+# The parser of these rules would have to try every node in the grammar, which is never LL(1)
+_skipped_rule_names = { any_node_rule_name, any_syntax_rule_name }
+
+@declare_pass()
+def mage_to_python_table_parser(
+    grammar: MageGrammar,
+    prefix: str = '',
+    emit_single_file: bool = False,
+    silent: bool = False,
+    enable_structural_eq: bool = False,
+    enable_red_green: bool = False,
+) -> PyModule:
+    """
+    Generate a parser that is driven by tables instead of code.
+
+    The tables are interpreted by `magelang.runtime.TableParser`. Grammars
+    that can't be tokenized or are not LL(1) fall back to the code that is
+    generated by `mage_to_python_parser`.
+    """
+
+    def fallback() -> PyModule:
+        return mage_to_python_parser(grammar, prefix=prefix, emit_single_file=emit_single_file, silent=silent, enable_structural_eq=enable_structural_eq, enable_red_green=enable_red_green)
+
+    if not is_tokenizable(grammar):
+        if not silent:
+            warn('grammar could not be tokenized. Falling back to a recursive descent parser.')
+        return fallback()
+
+    roots = list(rule for rule in grammar.elements if grammar.is_parse_rule(rule) and rule.name not in _skipped_rule_names)
+
+    analysis = analyse_ll1(grammar, roots)
+    if not analysis.is_ll1:
+        if not silent:
+            warn('grammar is not LL(1). Falling back to a recursive descent parser.')
+            for conflict in analysis.conflicts:
+                warn(f"in rule '{conflict.rule.name}': {conflict.message}")
+        return fallback()
+
+    code = list[int]()
+    types = list[str]()
+    type_indices = dict[str, int]()
+    switches = list[list[PyExpr]]()
+    nodes = list[list[PyExpr]]()
+
+    rule_addresses = dict[MageRule, int]()
+    pending_calls = list[tuple[int, MageRule]]()
+    pending_rules = list[MageRule]()
+
+    def emit(op: int, arg: int = 0) -> int:
+        address = len(code)
+        code.append(op)
+        code.append(arg)
+        return address
+
+    def patch(address: int, target: int) -> None:
+        code[address+1] = target
+
+    def get_type_index(name: str) -> int:
+        index = type_indices.get(name)
+        if index is None:
+            index = len(types)
+            types.append(name)
+            type_indices[name] = index
+        return index
+
+    def reserve_switch() -> int:
+        """
+        Emit a switch that is filled in with `fill_switch()` once all addresses are known.
+        """
+        index = len(switches)
+        switches.append([])
+        emit(OP_SWITCH, index)
+        return index
+
+    def fill_switch(index: int, default: int, cases: list[tuple[set[str], int]]) -> None:
+        row: list[PyExpr] = [ PyConstExpr(default) ]
+        seen = set[str]()
+        for tokens, target in cases:
+            for name in sorted(tokens - seen):
+                row.append(PyNamedExpr(to_py_class_name(name, prefix)))
+                row.append(PyConstExpr(target))
+            seen.update(tokens)
+        switches[index] = row
+
+    def emit_call(rule: MageRule) -> None:
+        address = emit(OP_CALL)
+        pending_calls.append((address, rule))
+        if rule not in rule_addresses and rule not in pending_rules:
+            pending_rules.append(rule)
+
+    def compile_expr(expr: MageExpr) -> None:
+        """
+        Emit instructions that leave exactly one value on the stack.
+        """
+
+        if isinstance(expr, MageRefExpr):
+            rule = nonnull(lookup_ref(expr))
+            if grammar.is_token_rule(rule):
+                emit(OP_TOKEN, get_type_index(rule.name))
+            else:
+                emit_call(rule)
+
+        elif isinstance(expr, MageHideExpr):
+            compile_expr(expr.expr)
+
+        elif isinstance(expr, MageSeqExpr):
+            count = 0
+            for element in expr.elements:
+                compile_expr(element)
+                if isinstance(element, MageHideExpr):
+                    emit(OP_POP)
+                else:
+                    count += 1
+            if count != 1:
+                emit(OP_TUPLE, count)
+
+        elif isinstance(expr, MageChoiceExpr):
+            switch = reserve_switch()
+            cases = list[tuple[set[str], int]]()
+            default = -1
+            jumps = list[int]()
+            for element in expr.elements:
+                address = len(code)
+                cases.append((analysis.first(element), address))
+                if analysis.nullable(element):
+                    default = address
+                compile_expr(element)
+                jumps.append(emit(OP_JUMP))
+            end = len(code)
+            for address in jumps:
+                patch(address, end)
+            fill_switch(switch, default, cases)
+
+        elif isinstance(expr, MageRepeatExpr):
+
+            if expr.min == 0 and expr.max == 1:
+                switch = reserve_switch()
+                none_address = emit(OP_NONE)
+                jump = emit(OP_JUMP)
+                some_address = len(code)
+                compile_expr(expr.expr)
+                patch(jump, len(code))
+                fill_switch(switch, none_address, [ (analysis.first(expr.expr), some_address) ])
+                return
+
+            if expr.min == 1 and expr.max == 1:
+                compile_expr(expr.expr)
+                return
+
+            emit(OP_LIST)
+            for _ in range(0, expr.min):
+                compile_expr(expr.expr)
+                emit(OP_APPEND)
+            if expr.max > expr.min:
+                first = analysis.first(expr.expr)
+                if expr.max == POSINF:
+                    head = len(code)
+                    switch = reserve_switch()
+                    body = len(code)
+                    compile_expr(expr.expr)
+                    emit(OP_APPEND)
+                    emit(OP_JUMP, head)
+                    fill_switch(switch, len(code), [ (first, body) ])
+                else:
+                    heads = list[tuple[int, int]]()
+                    for _ in range(expr.min, expr.max):
+                        switch = reserve_switch()
+                        heads.append((switch, len(code)))
+                        compile_expr(expr.expr)
+                        emit(OP_APPEND)
+                    end = len(code)
+                    for switch, body in heads:
+                        fill_switch(switch, end, [ (first, body) ])
+
+        elif isinstance(expr, MageListExpr):
+            # A separator must always be followed by another element
+            element_first = analysis.first(expr.element)
+            emit(OP_PUNCT)
+            start_switch = None
+            if expr.min_count == 0:
+                start_switch = reserve_switch()
+            element_address = len(code)
+            compile_expr(expr.element)
+            element_switch = reserve_switch()
+            separator_address = len(code)
+            compile_expr(expr.separator)
+            emit(OP_PUNCT_APPEND)
+            emit(OP_JUMP, element_address)
+            final_address = emit(OP_PUNCT_FINAL)
+            end = len(code)
+            fill_switch(element_switch, final_address, [ (analysis.first(expr.separator), separator_address) ])
+            if start_switch is not None:
+                fill_switch(start_switch, end, [ (element_first, element_address) ])
+            if expr.min_count > 1:
+                emit(OP_MIN, expr.min_count)
+
+        elif isinstance(expr, MageLitExpr) \
+                or isinstance(expr, MageCharSetExpr) \
+                or isinstance(expr, MageLookaheadExpr):
+            # Already rejected by analyse_ll1()
+            unreachable()
+
+        else:
+            assert_never(expr)
+
+    def compile_rule(rule: MageRule) -> None:
+        rule_addresses[rule] = len(code)
+        expr = nonnull(rule.expr)
+        if not rule.is_public or grammar.is_variant_rule(rule):
+            compile_expr(expr)
+        else:
+            names = list[PyExpr]()
+            for field_expr, field in get_fields(expr, grammar=grammar):
+                compile_expr(field_expr)
+                if field is None:
+                    emit(OP_POP)
+                else:
+                    names.append(PyConstExpr(field.name))
+            emit(OP_NODE, len(nodes))
+            nodes.append([ PyNamedExpr(to_py_class_name(rule.name, prefix)), *names ])
+        emit(OP_RET)
+
+    for rule in roots:
+        compile_rule(rule)
+
+    while pending_rules:
+        rule = pending_rules.pop()
+        if rule not in rule_addresses:
+            compile_rule(rule)
+
+    for address, rule in pending_calls:
+        patch(address, rule_addresses[rule])
+
+    parser_name = '_parser'
+
+    stmts = list[PyStmt]()
+
+    stmts.append(PyImportFromStmt(
+        PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')),
+        [ PyFromAlias('Interner'), PyFromAlias('ParseStream'), PyFromAlias('TableParser') ]
+    ))
+    if not emit_single_file:
+        stmts.append(PyImportFromStmt(
+            PyRelativePath(1, name='cst'),
+            [ PyAsterisk() ]
+        ))
+
+    stmts.append(PyAssignStmt(
+        PyNamedPattern(parser_name),
+        value=PyCallExpr(PyNamedExpr('TableParser'), args=[
+            PyListExpr(elements=list(PyConstExpr(value) for value in code)),
+            PyListExpr(elements=list(PyNamedExpr(to_py_class_name(name, prefix)) for name in types)),
+            PyListExpr(elements=list(PyListExpr(elements=row) for row in switches)),
+            PyListExpr(elements=list(PyListExpr(elements=row) for row in nodes)),
+        ])
+    ))
+
+    for rule in roots:
+        params: list[PyParam] = [ PyNamedParam(PyNamedPattern('stream'), annotation=PyNamedExpr('ParseStream')) ]
+        args: list[PyArg] = [ PyNamedExpr('stream'), PyConstExpr(rule_addresses[rule]) ]
+        if enable_structural_eq or enable_red_green:
+            # Nodes can only be shared when they have structural equality or are converted to green nodes
+            params.append(PyNamedParam(PyNamedPattern('interner'), annotation=PyConstExpr('Interner | None'), default=PyNamedExpr('None')))
+            args.append(PyNamedExpr('interner'))
+        stmts.append(PyFuncDef(
+            name=f'parse_{rule.name}',
+            params=params,
+            return_type=make_py_union([
+                PyNamedExpr(to_py_class_name(rule.name, prefix=prefix)),
+                PyNamedExpr('None'),
+            ]),
+            body=[
+                PyRetStmt(expr=PyCallExpr(
+                    PyAttrExpr(PyNamedExpr(parser_name), 'parse'),
+                    args=args
+                )),
+            ]
+        ))
+
+    return PyModule(stmts=stmts)
@@ -0,0 +1,65 @@
+
+from magelang.lang.python import emit
+from magelang.lang.python.cst import *
+from magelang.manager import declare_pass
+
+@declare_pass()
+def python_merge_modules(modules: dict[str, PyModule]) -> PyModule:
+    """
+    Combine generated modules of the same package into one module.
+
+    Imports are moved to the top of the new module and merged per imported
+    module. Imports of other modules in the package are removed, because
+    their definitions are now part of the same module. Functions and type
+    aliases that are defined more than once with exactly the same code are
+    only kept the first time.
+    """
+
+    future_names = list[str]()
+    imports = list[PyImportStmt]()
+    import_texts = set[str]()
+    from_aliases = dict[str, list[PyFromAlias]]()
+    from_paths = dict[str, PyPath]()
+    defs = set[str]()
+    stmts = list[PyStmt]()
+
+    for module in modules.values():
+        for stmt in module.stmts:
+            if isinstance(stmt, PyImportFromStmt):
+                if isinstance(stmt.path, PyRelativePath):
+                    continue
+                path_text = emit(stmt.path)
+                if path_text == '__future__':
+                    for alias, _ in stmt.aliases:
+                        name = emit(alias)
+                        if name not in future_names:
+                            future_names.append(name)
+                    continue
+                if path_text not in from_aliases:
+                    from_aliases[path_text] = []
+                    from_paths[path_text] = stmt.path
+                aliases = from_aliases[path_text]
+                for alias, _ in stmt.aliases:
+                    if not any(emit(other) == emit(alias) for other in aliases):
+                        aliases.append(alias)
+            elif isinstance(stmt, PyImportStmt):
+                text = emit(stmt)
+                if text not in import_texts:
+                    import_texts.add(text)
+                    imports.append(stmt)
+            elif isinstance(stmt, PyFuncDef) or isinstance(stmt, PyTypeAliasStmt):
+                text = emit(stmt)
+                if text not in defs:
+                    defs.add(text)
+                    stmts.append(stmt)
+            else:
+                stmts.append(stmt)
+
+    header = list[PyStmt]()
+    if future_names:
+        header.append(PyImportFromStmt(PyAbsolutePath('__future__'), aliases=future_names))
+    header.extend(imports)
+    for path_text, aliases in from_aliases.items():
+        header.append(PyImportFromStmt(from_paths[path_text], aliases=aliases))
+
+    return PyModule(stmts=header + stmts)
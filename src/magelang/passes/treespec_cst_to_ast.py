@@ -11,59 +11,72 @@ from magelang.lang.treespec.helpers import flatten_union_types, is_optional_type
 def is_ignored(ty: Type) -> bool:
     return all(isinstance(el_ty, NoneType) or is_unit_type(el_ty) for el_ty in flatten_union_types(ty))
 
+def is_flag_field(field: Field, specs: Specs) -> bool:
+    """
+    Check whether `field` is stored as a bit in the `flags` field of the AST node.
+    """
+    return is_optional_type(field.ty) and is_static_type(unwrap_optional_type(field.ty), specs=specs)
+
+def rewrite_cst_type(ty: Type, specs: Specs) -> Type:
+    """
+    Translate the type of a CST field to the type of the same field in the AST.
+
+    Unlike `cst_type_to_ast_type()`, the result is not normalized.
+    """
+    if isinstance(ty, SpecType):
+        spec = lookup_spec(specs, ty.name)
+        if isinstance(spec, TokenSpec):
+            return make_unit_type() if spec.is_static else ExternType(spec.field_type)
+        return ty
+    if isinstance(ty, NoneType) \
+        or isinstance(ty, NeverType) \
+        or isinstance(ty, ExternType) \
+        or isinstance(ty, AnyType):
+        return ty
+    if isinstance(ty, ListType):
+        new_element_type = rewrite_cst_type(ty.element_type, specs)
+        if is_unit_type(new_element_type):
+            return ExternType(integer_rule_type)
+        return ty.derive(element_type=new_element_type)
+    if isinstance(ty, TupleType):
+        new_element_types = []
+        for ty_2 in ty.element_types:
+            new_ty_2 = rewrite_cst_type(ty_2, specs)
+            if not is_unit_type(new_ty_2):
+                new_element_types.append(new_ty_2)
+        if len(new_element_types) == 1:
+            return new_element_types[0]
+        return ty.derive(element_types=new_element_types)
+    if isinstance(ty, PunctType):
+        new_element_type = rewrite_cst_type(ty.element_type, specs)
+        new_separator_type = rewrite_cst_type(ty.separator_type, specs)
+        if is_unit_type(new_element_type) and is_unit_type(new_separator_type):
+            return ExternType(integer_rule_type)
+        if is_unit_type(new_element_type):
+            return ListType(new_separator_type, ty.required)
+        if is_unit_type(new_separator_type):
+            return ListType(new_element_type, False) # FIXME `required` is incorrectly set
+        return ty.derive(
+            element_type=new_element_type,
+            separator_type=new_separator_type,
+        )
+    if isinstance(ty, UnionType):
+        new_types = []
+        for ty_2 in ty.types:
+            new_ty_2 = rewrite_cst_type(ty_2, specs)
+            if not is_unit_type(new_ty_2):
+                new_types.append(new_ty_2)
+        return ty.derive(types=new_types)
+    assert_never(ty)
+
+def cst_type_to_ast_type(ty: Type, specs: Specs) -> Type:
+    return normalize_type(rewrite_cst_type(ty, specs))
+
 @declare_pass()
 def treespec_cst_to_ast(specs: Specs) -> Specs:
 
     def rewrite_type(ty: Type) -> Type:
-
-        def rewrite(ty: Type) -> Type:
-            if isinstance(ty, SpecType):
-                spec = lookup_spec(specs, ty.name)
-                if isinstance(spec, TokenSpec):
-                    return make_unit_type() if spec.is_static else ExternType(spec.field_type)
-                return ty
-            if isinstance(ty, NoneType) \
-                or isinstance(ty, NeverType) \
-                or isinstance(ty, ExternType) \
-                or isinstance(ty, AnyType):
-                return ty
-            if isinstance(ty, ListType):
-                new_element_type = rewrite(ty.element_type)
-                if is_unit_type(new_element_type):
-                    return ExternType(integer_rule_type)
-                return ty.derive(element_type=new_element_type)
-            if isinstance(ty, TupleType):
-                new_element_types = []
-                for ty_2 in ty.element_types:
-                    new_ty_2 = rewrite(ty_2)
-                    if not is_unit_type(new_ty_2):
-                        new_element_types.append(new_ty_2)
-                if len(new_element_types) == 1:
-                    return new_element_types[0]
-                return ty.derive(element_types=new_element_types)
-            if isinstance(ty, PunctType):
-                new_element_type = rewrite(ty.element_type)
-                new_separator_type = rewrite(ty.separator_type)
-                if is_unit_type(new_element_type) and is_unit_type(new_separator_type):
-                    return ExternType(integer_rule_type)
-                if is_unit_type(new_element_type):
-                    return ListType(new_separator_type, ty.required)
-                if is_unit_type(new_separator_type):
-                    return ListType(new_element_type, False) # FIXME `required` is incorrectly set
-                return ty.derive(
-                    element_type=new_element_type,
-                    separator_type=new_separator_type,
-                )
-            if isinstance(ty, UnionType):
-                new_types = []
-                for ty_2 in ty.types:
-                    new_ty_2 = rewrite(ty_2)
-                    if not is_unit_type(new_ty_2):
-                        new_types.append(new_ty_2)
-                return ty.derive(types=new_types)
-            assert_never(ty)
-
-        return normalize_type(rewrite(ty))
+        return cst_type_to_ast_type(ty, specs)
 
     toplevel = []
 
@@ -85,11 +98,9 @@ def treespec_cst_to_ast(specs: Specs) -> Specs:
             new_fields = []
             mask_elements = []
             for field in spec.fields:
-                if is_optional_type(field.ty):
-                    el_ty = unwrap_optional_type(field.ty)
-                    if is_static_type(el_ty, specs=specs):
-                        mask_elements.append(field.name)
-                        continue
+                if is_flag_field(field, specs):
+                    mask_elements.append(field.name)
+                    continue
                 new_ty = rewrite_type(field.ty)
                 if is_ignored(new_ty):
                     continue
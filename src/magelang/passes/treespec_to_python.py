@@ -3,7 +3,7 @@ from typing import Iterable, assert_never
 
 from magelang.manager import declare_pass
 from magelang.passes.mage_insert_magic_rules import any_node_rule_name, any_token_rule_name, any_syntax_rule_name
-from magelang.helpers import make_py_cond, make_py_or, make_py_union, treespec_type_to_deep_py_test, make_py_coercions, treespec_type_to_py_type, treespec_type_to_shallow_py_test, namespaced, extern_type_to_py_type, to_py_class_name, quote_py_type, make_py_isinstance, PyCondCase, lookup_spec
+from magelang.helpers import make_py_and, make_py_cond, make_py_or, make_py_union, treespec_type_to_deep_py_test, make_py_coercions, treespec_type_to_py_type, treespec_type_to_shallow_py_test, namespaced, extern_type_to_py_type, to_py_class_name, quote_py_type, make_py_isinstance, PyCondCase, lookup_spec
 from magelang.lang.treespec.helpers import contains_type, expand_variant_types, is_self_referential, is_optional_type, is_type_assignable, resolve_type_references, spec_to_type
 from magelang.lang.mage.ast import *
 from magelang.lang.treespec.ast import *
@@ -23,14 +23,28 @@ def treespec_to_python(
     prefix: str = '',
     gen_parent_pointers: bool = True,
     enable_asserts: bool = False,
+    enable_slots: bool = True,
+    enable_shared_tokens: bool = False,
+    enable_red_green: bool = False,
+    enable_structural_eq: bool = False,
+    enable_serializer: bool = False,
+    enable_parent_map: bool = False,
+    enable_fast_import: bool = False,
+    enable_trivia: bool = False,
 ) -> PyModule:
 
+    def make_slots(names: Iterable[str]) -> list[PyStmt]:
+        if not enable_slots:
+            return []
+        return [ PyAssignStmt(PyNamedPattern('__slots__'), value=PyListExpr(elements=list(PyConstExpr(name) for name in names))) ]
+
     def get_base_class_name(name: str) -> str:
         return '_' + to_py_class_name('base_' + name, prefix=prefix)
 
     base_syntax_class_name = get_base_class_name(any_syntax_rule_name)
     base_node_class_name =  get_base_class_name(any_node_rule_name)
     base_token_class_name = get_base_class_name(any_token_rule_name)
+    base_shared_token_class_name = get_base_class_name('shared_' + any_token_rule_name)
 
     parent_nodes = dict[str, set[str]]()
 
@@ -76,6 +90,66 @@ def treespec_to_python(
             for field in spec.fields:
                 add_to_parent_nodes(spec.name, field.ty)
 
+    # With a parent map, parents are looked up instead of stored on every node
+    store_parent_pointers = gen_parent_pointers and not enable_parent_map
+
+    # Only a CST has tokens to take the offsets of nodes from
+    has_tokens = any(isinstance(spec, TokenSpec) for spec in specs.elements)
+
+    # Only worth two extra slots per node when the lexer gives tokens a position
+    cache_offsets = has_tokens and enable_trivia
+
+    def gen_offset(name: str, find_fn_name: str) -> PyStmt:
+        return PyFuncDef(
+            decorators=[ PyDecorator(PyNamedExpr('property')) ],
+            name=name,
+            params=[ PyNamedParam(PyNamedPattern('self')) ],
+            return_type=PyNamedExpr('int'),
+            body=[
+                PyRetStmt(expr=PyCallExpr(PyNamedExpr(find_fn_name), args=[ PyNamedExpr('self') ])),
+            ]
+        )
+
+    def gen_cached_offset(name: str, find_fn_name: str) -> PyStmt:
+        self_cache = PyAttrExpr(PyNamedExpr('self'), '_' + name)
+        return PyFuncDef(
+            decorators=[ PyDecorator(PyNamedExpr('property')) ],
+            name=name,
+            params=[ PyNamedParam(PyNamedPattern('self')) ],
+            return_type=PyNamedExpr('int'),
+            body=[
+                PyTryStmt(
+                    body=[ PyRetStmt(expr=self_cache) ],
+                    handlers=[ PyExceptHandler(PyNamedExpr('AttributeError'), [ PyPassStmt() ]) ],
+                ),
+                PyAssignStmt(PyNamedPattern('offset'), value=PyCallExpr(PyNamedExpr(find_fn_name), args=[ PyNamedExpr('self') ])),
+                PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), '_' + name), value=PyNamedExpr('offset')),
+                PyRetStmt(expr=PyNamedExpr('offset')),
+            ]
+        )
+
+    base_node_body = list[PyStmt]()
+    if cache_offsets:
+        # Computed from the tokens on first use and cleared with `clear_cached_offsets()`
+        base_node_body.extend(make_slots([ '_start_offset', '_end_offset' ]))
+        base_node_body.append(gen_cached_offset('start_offset', 'find_start_offset'))
+        base_node_body.append(gen_cached_offset('end_offset', 'find_end_offset'))
+    else:
+        base_node_body.extend(make_slots([]))
+    if has_tokens and not cache_offsets:
+        base_node_body.append(gen_offset('start_offset', 'find_start_offset'))
+        base_node_body.append(gen_offset('end_offset', 'find_end_offset'))
+    if enable_fast_import:
+        # One `derive()` for all nodes instead of a method and a TypedDict per class
+        base_node_body.append(PyFuncDef(
+            name='derive',
+            params=[ PyNamedParam(PyNamedPattern('self')), PyRestKeywordParam('kwargs', annotation=PyNamedExpr('Any')) ],
+            return_type=PyNamedExpr('Self'),
+            body=[
+                PyRetStmt(expr=PyCallExpr(PyNamedExpr('derive_node'), args=[ PyNamedExpr('self'), PyNamedExpr('kwargs') ])),
+            ]
+        ))
+
     stmts: list[PyStmt] = [
         PyImportFromStmt(PyAbsolutePath('enum'), aliases=[
             'IntEnum',
@@ -96,25 +170,213 @@ def treespec_to_python(
             'BaseSyntax',
             'Punctuated',
             'ImmutablePunct',
+            'PreorderIterator',
+            'PostorderIterator',
             'Span',
+            'lookup_handler',
         ]),
-        PyClassDef(base_syntax_class_name, bases=[ PyClassBaseArg('BaseSyntax') ], body=[
+        PyClassDef(base_syntax_class_name, bases=[ PyClassBaseArg('BaseSyntax') ], body=make_slots([ '_parent' ] if store_parent_pointers else []) or [
             PyPassStmt(),
         ]),
-        PyClassDef(base_node_class_name, bases=[ PyClassBaseArg(base_syntax_class_name) ], body=[
+        PyClassDef(base_node_class_name, bases=[ PyClassBaseArg(base_syntax_class_name) ], body=base_node_body or [
             PyPassStmt(),
         ]),
         PyClassDef(base_token_class_name, bases=[ PyClassBaseArg(base_syntax_class_name) ], body=[
+            # Offsets are stored directly on the token; -1 means there is no position
+            *make_slots([ 'start_offset', 'end_offset' ]),
             PyFuncDef(
                 name='__init__',
                 params=[ PyNamedParam(PyNamedPattern('self')), PyNamedParam(PyNamedPattern('span'), annotation=make_py_optional(PyNamedExpr('Span')), default=PyNamedExpr('None')) ],
-                body=[ PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), 'span'), value=PyNamedExpr('span')) ]
+                body=make_py_cond([
+                    (
+                        PyInfixExpr(PyNamedExpr('span'), PyIsKeyword(), PyNamedExpr('None')),
+                        [
+                            PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), 'start_offset'), value=PyConstExpr(-1)),
+                            PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), 'end_offset'), value=PyConstExpr(-1)),
+                        ]
+                    ),
+                    (
+                        None,
+                        [
+                            PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), 'start_offset'), value=PyAttrExpr(PyNamedExpr('span'), 'start_offset')),
+                            PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), 'end_offset'), value=PyAttrExpr(PyNamedExpr('span'), 'end_offset')),
+                        ]
+                    ),
+                ])
+            ),
+            PyFuncDef(
+                decorators=[ PyDecorator(PyNamedExpr('property')) ],
+                name='span',
+                params=[ PyNamedParam(PyNamedPattern('self')) ],
+                return_type=make_py_optional(PyNamedExpr('Span')),
+                body=[
+                    PyIfStmt(PyIfCase(
+                        PyInfixExpr(PyAttrExpr(PyNamedExpr('self'), 'start_offset'), PyLessThan(), PyConstExpr(0)),
+                        [ PyRetStmt(expr=PyNamedExpr('None')) ],
+                    )),
+                    PyRetStmt(expr=PyCallExpr(PyNamedExpr('Span'), args=[ PyAttrExpr(PyNamedExpr('self'), 'start_offset'), PyAttrExpr(PyNamedExpr('self'), 'end_offset') ])),
+                ]
             ),
         ]),
     ]
 
+    if has_tokens:
+        # Right after the other imports from the runtime
+        stmts.insert(3, PyImportFromStmt(PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')), aliases=[
+            'find_end_offset',
+            'find_start_offset',
+        ]))
+
+    if enable_red_green:
+        # Right after the other imports from the runtime
+        stmts.insert(3, PyImportFromStmt(PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')), aliases=[
+            'GreenBuilder',
+            'GreenInterner',
+            'GreenNode',
+            'GreenToken',
+            'RedNode',
+            'RedToken',
+            'TriviaTable',
+        ]))
+
+    if enable_structural_eq:
+        # Right after the other imports from the runtime
+        stmts.insert(3, PyImportFromStmt(PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')), aliases=[
+            'structural_eq',
+            'structural_hash',
+        ]))
+
+    if enable_serializer:
+        # Right after the other imports from the runtime
+        stmts.insert(3, PyImportFromStmt(PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')), aliases=[
+            'SyntaxSerializer',
+        ]))
+
+    if gen_parent_pointers and enable_parent_map:
+        # Right after the other imports from the runtime
+        stmts.insert(3, PyImportFromStmt(PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')), aliases=[
+            'ParentMap',
+        ]))
+
+    if enable_fast_import:
+        # Right after the other imports from the runtime
+        stmts.insert(3, PyImportFromStmt(PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')), aliases=[
+            'derive_node',
+        ]))
+        stmts.insert(2, PyImportFromStmt(PyAbsolutePath('typing'), aliases=[
+            'TYPE_CHECKING',
+            'Self',
+        ]))
+
+    if enable_shared_tokens:
+        # Static tokens without a span are indistinguishable from one
+        # another, so every class only needs one such instance.
+        stmts.append(PyClassDef(base_shared_token_class_name, bases=[ PyClassBaseArg(base_token_class_name) ], body=[
+            *make_slots([]),
+            PyAssignStmt(PyNamedPattern('_shared'), annotation=PyConstExpr('Any'), value=PyNamedExpr('None')),
+            PyFuncDef(
+                name='__new__',
+                params=[ PyNamedParam(PyNamedPattern('cls')), PyNamedParam(PyNamedPattern('span'), annotation=make_py_optional(PyNamedExpr('Span')), default=PyNamedExpr('None')) ],
+                body=[
+                    PyIfStmt(PyIfCase(
+                        PyInfixExpr(PyNamedExpr('span'), (PyIsKeyword(), PyNotKeyword()), PyNamedExpr('None')),
+                        [ PyRetStmt(expr=PyCallExpr(PyAttrExpr(PyCallExpr(PyNamedExpr('super')), '__new__'), args=[ PyNamedExpr('cls') ])) ],
+                    )),
+                    PyAssignStmt(PyNamedPattern('token'), value=PyCallExpr(PyAttrExpr(PyAttrExpr(PyNamedExpr('cls'), '__dict__'), 'get'), args=[ PyConstExpr('_shared') ])),
+                    PyIfStmt(PyIfCase(
+                        PyInfixExpr(PyNamedExpr('token'), PyIsKeyword(), PyNamedExpr('None')),
+                        [
+                            PyAssignStmt(PyNamedPattern('token'), value=PyCallExpr(PyAttrExpr(PyCallExpr(PyNamedExpr('super')), '__new__'), args=[ PyNamedExpr('cls') ])),
+                            PyAssignStmt(PyAttrPattern(PyNamedPattern('cls'), '_shared'), value=PyNamedExpr('token')),
+                        ]
+                    )),
+                    PyRetStmt(expr=PyNamedExpr('token')),
+                ]
+            ),
+        ]))
+
     defs = {}
 
+    def make_type_is_not(left: PyExpr, right: PyExpr) -> PyExpr:
+        return PyInfixExpr(
+            PyCallExpr(PyNamedExpr('type'), args=[ left ]),
+            (PyIsKeyword(), PyNotKeyword()),
+            PyCallExpr(PyNamedExpr('type'), args=[ right ]),
+        )
+
+    def gen_eq_and_hash(eq_tests: list[PyExpr], hash_elements: list[PyExpr], cache: bool) -> list[PyStmt]:
+        """
+        Generate `__eq__` and `__hash__` that look at the contents of an object instead of its identity.
+        """
+        self = PyNamedExpr('self')
+        other = PyNamedExpr('other')
+        if eq_tests:
+            eq_body: list[PyStmt] = [
+                PyIfStmt(first=PyIfCase(test=PyInfixExpr(self, PyIsKeyword(), other), body=[ PyRetStmt(expr=PyNamedExpr('True')) ])),
+                PyIfStmt(first=PyIfCase(test=make_type_is_not(other, self), body=[ PyRetStmt(expr=PyNamedExpr('False')) ])),
+                PyRetStmt(expr=make_py_and(eq_tests)),
+            ]
+        else:
+            eq_body = [ PyRetStmt(expr=PyInfixExpr(PyCallExpr(PyNamedExpr('type'), args=[ other ]), PyIsKeyword(), PyCallExpr(PyNamedExpr('type'), args=[ self ]))) ]
+        # A tuple with only one element would not be emitted correctly
+        compute_hash = PyCallExpr(PyNamedExpr('hash'), args=[
+            PyCallExpr(PyNamedExpr('tuple'), args=[ PyListExpr(elements=hash_elements) ])
+        ])
+        if cache:
+            hash_body: list[PyStmt] = [
+                PyAssignStmt(PyNamedPattern('h'), value=PyAttrExpr(self, '_hash')),
+                PyIfStmt(first=PyIfCase(
+                    test=PyInfixExpr(PyNamedExpr('h'), PyIsKeyword(), PyNamedExpr('None')),
+                    body=[
+                        PyAssignStmt(PyNamedPattern('h'), value=compute_hash),
+                        PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), '_hash'), value=PyNamedExpr('h')),
+                    ]
+                )),
+                PyRetStmt(expr=PyNamedExpr('h')),
+            ]
+        else:
+            hash_body = [ PyRetStmt(expr=compute_hash) ]
+        return [
+            PyFuncDef(
+                name='__eq__',
+                params=[ PyNamedParam(PyNamedPattern('self')), PyNamedParam(PyNamedPattern('other'), annotation=PyNamedExpr('object')) ],
+                return_type=PyNamedExpr('bool'),
+                body=eq_body,
+            ),
+            PyFuncDef(
+                name='__hash__',
+                params=[ PyNamedParam(PyNamedPattern('self')) ],
+                return_type=PyNamedExpr('int'),
+                body=hash_body,
+            ),
+        ]
+
+    def gen_node_eq_and_hash(spec: NodeSpec) -> list[PyStmt]:
+        # Comparing the cached hashes first makes most unequal nodes cheap to reject
+        eq_tests: list[PyExpr] = [
+            PyInfixExpr(
+                PyCallExpr(PyNamedExpr('hash'), args=[ PyNamedExpr('self') ]),
+                PyEqualsEquals(),
+                PyCallExpr(PyNamedExpr('hash'), args=[ PyNamedExpr('other') ]),
+            )
+        ]
+        hash_elements: list[PyExpr] = [ PyCallExpr(PyNamedExpr('type'), args=[ PyNamedExpr('self') ]) ]
+        for field in spec.fields:
+            eq_tests.append(PyCallExpr(PyNamedExpr('structural_eq'), args=[
+                PyAttrExpr(PyNamedExpr('self'), field.name),
+                PyAttrExpr(PyNamedExpr('other'), field.name),
+            ]))
+            hash_elements.append(PyCallExpr(PyNamedExpr('structural_hash'), args=[ PyAttrExpr(PyNamedExpr('self'), field.name) ]))
+        return gen_eq_and_hash(eq_tests, hash_elements, cache=True)
+
+    def gen_token_eq_and_hash(spec: TokenSpec) -> list[PyStmt]:
+        eq_tests = list[PyExpr]()
+        hash_elements: list[PyExpr] = [ PyCallExpr(PyNamedExpr('type'), args=[ PyNamedExpr('self') ]) ]
+        if not spec.is_static:
+            eq_tests.append(PyInfixExpr(PyAttrExpr(PyNamedExpr('self'), 'value'), PyEqualsEquals(), PyAttrExpr(PyNamedExpr('other'), 'value')))
+            hash_elements.append(PyAttrExpr(PyNamedExpr('self'), 'value'))
+        return gen_eq_and_hash(eq_tests, hash_elements, cache=False)
+
     # Generate token classes
 
     for spec in specs.elements:
@@ -126,10 +388,12 @@ def treespec_to_python(
 
         if spec.is_static:
 
-            body.append(PyPassStmt())
+            body.extend(make_slots([]) or [ PyPassStmt() ])
 
         else:
 
+            body.extend(make_slots([ 'value' ]))
+
             init_body: list[PyStmt] = []
 
             init_body.append(PyExprStmt(expr=PyCallExpr(operator=PyAttrExpr(expr=PyCallExpr(operator=PyNamedExpr('super')), name='__init__'), args=[ (PyKeywordArg(name='span', expr=PyNamedExpr('span')), None) ])))
@@ -150,7 +414,13 @@ def treespec_to_python(
 
             body.append(PyFuncDef(name='__init__', params=init_params, body=init_body))
 
-        stmts.append(PyClassDef(name=to_py_class_name(spec.name, prefix), bases=[ PyClassBaseArg(base_token_class_name) ], body=body))
+        if enable_structural_eq:
+            if len(body) == 1 and isinstance(body[0], PyPassStmt):
+                body = []
+            body.extend(gen_token_eq_and_hash(spec))
+
+        base_class_name = base_shared_token_class_name if enable_shared_tokens and spec.is_static else base_token_class_name
+        stmts.append(PyClassDef(name=to_py_class_name(spec.name, prefix), bases=[ PyClassBaseArg(base_class_name) ], body=body))
 
     # Generate node classes
 
@@ -162,7 +432,13 @@ def treespec_to_python(
         this_class_name = to_py_class_name(spec.name, prefix)
         derive_kwargs_class_name = to_py_class_name(spec.name + '_derive_kwargs', prefix)
 
-        body: list[PyStmt] = []
+        slot_names = list(field.name for field in spec.fields)
+        if enable_structural_eq:
+            slot_names.append('_hash')
+        body: list[PyStmt] = make_slots(slot_names)
+
+        # Used by the traversals in the runtime to find the children of this node
+        body.append(PyAssignStmt(PyNamedPattern('_field_names'), value=PyListExpr(elements=list(PyConstExpr(field.name) for field in spec.fields))))
 
         init_params: list[PyParam] = []
         init_body: list[PyStmt] = []
@@ -231,6 +507,9 @@ def treespec_to_python(
                 )
             ))
 
+        if enable_structural_eq:
+            init_body.append(PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), '_hash'), annotation=PyConstExpr('int | None'), value=PyNamedExpr('None')))
+
         if not spec.fields:
             init_body.append(PyPassStmt())
             derive_kwargs_body.append(PyPassStmt())
@@ -247,24 +526,52 @@ def treespec_to_python(
             body=init_body
         ))
 
-        stmts.append(PyClassDef(
-            name=derive_kwargs_class_name,
-            bases=[ PyClassBaseArg('TypedDict'), PyKeywordBaseArg('total', PyNamedExpr('False')) ],
-            body=derive_kwargs_body
+        # Trusted constructor that skips all coercions. Used by the generated
+        # parser, which always produces fields of the right type.
+        make_params: list[PyParam] = [ PyNamedParam(PyNamedPattern('cls')) ]
+        make_body: list[PyStmt] = [
+            PyAssignStmt(PyNamedPattern('node'), value=PyCallExpr(PyAttrExpr(PyNamedExpr('cls'), '__new__'), args=[ PyNamedExpr('cls') ])),
+        ]
+        for field in spec.fields:
+            make_params.append(PyNamedParam(
+                PyNamedPattern(field.name),
+                annotation=quote_py_type(treespec_type_to_py_type(field.ty, prefix)),
+            ))
+            make_body.append(PyAssignStmt(PyAttrPattern(PyNamedPattern('node'), field.name), value=PyNamedExpr(field.name)))
+        if enable_structural_eq:
+            make_body.append(PyAssignStmt(PyAttrPattern(PyNamedPattern('node'), '_hash'), value=PyNamedExpr('None')))
+        make_body.append(PyRetStmt(expr=PyNamedExpr('node')))
+        body.append(PyFuncDef(
+            decorators=[ PyDecorator(PyNamedExpr('classmethod')) ],
+            name='_make',
+            params=make_params,
+            return_type=PyConstExpr(this_class_name),
+            body=make_body,
         ))
 
-        derive_body.append(PyRetStmt(expr=PyCallExpr(PyNamedExpr(this_class_name), args=derive_args)))
+        if not enable_fast_import:
 
-        derive_decorators = []
-        if not enable_asserts:
-            derive_decorators.append(PyDecorator(PyNamedExpr('no_type_check')))
-        body.append(PyFuncDef(
-             decorators=derive_decorators,
-             name='derive',
-             params=[ PyNamedParam(PyNamedPattern('self')), PyRestKeywordParam('kwargs', annotation=PySubscriptExpr(PyNamedExpr('Unpack'), [ PyNamedExpr(derive_kwargs_class_name) ])) ],
-             return_type=PyConstExpr(this_class_name),
-             body=derive_body,
-         ))
+            stmts.append(PyClassDef(
+                name=derive_kwargs_class_name,
+                bases=[ PyClassBaseArg('TypedDict'), PyKeywordBaseArg('total', PyNamedExpr('False')) ],
+                body=derive_kwargs_body
+            ))
+
+            derive_body.append(PyRetStmt(expr=PyCallExpr(PyNamedExpr(this_class_name), args=derive_args)))
+
+            derive_decorators = []
+            if not enable_asserts:
+                derive_decorators.append(PyDecorator(PyNamedExpr('no_type_check')))
+            body.append(PyFuncDef(
+                 decorators=derive_decorators,
+                 name='derive',
+                 params=[ PyNamedParam(PyNamedPattern('self')), PyRestKeywordParam('kwargs', annotation=PySubscriptExpr(PyNamedExpr('Unpack'), [ PyNamedExpr(derive_kwargs_class_name) ])) ],
+                 return_type=PyConstExpr(this_class_name),
+                 body=derive_body,
+             ))
+
+        if enable_structural_eq:
+            body.extend(gen_node_eq_and_hash(spec))
 
         if gen_parent_pointers:
             parent_type_name = f'{to_py_class_name(spec.name, prefix)}Parent'
@@ -273,15 +580,20 @@ def treespec_to_python(
             parent_type_name = f'{to_py_class_name(spec.name, prefix)}Parent'
             # stmts.append(PyTypeAliasStmt(parent_type_name, gen_py_type(parent_type, prefix)))
             get_parent_body = []
+            get_parent_params: list[PyParam] = [ PyNamedParam(PyNamedPattern('self')) ]
+            if enable_parent_map:
+                get_parent_params.append(PyNamedParam(PyNamedPattern('parents'), annotation=PyNamedExpr('ParentMap')))
             if isinstance(parent_type, NeverType):
                 get_parent_body.append(PyRaiseStmt(PyCallExpr(PyNamedExpr('AssertionError'), args=[ PyConstExpr('trying to access the parent node of a top-level node') ])))
+            elif enable_parent_map:
+                get_parent_body.append(PyRetStmt(expr=PyCallExpr(PyAttrExpr(PyNamedExpr('parents'), 'parent'), args=[ PyNamedExpr('self') ])))
             else:
                 get_parent_body.append(PyCallExpr(PyNamedExpr('assert'), args=[ PyInfixExpr(PyAttrExpr(PyNamedExpr('self'), '_parent'), (PyIsKeyword(), PyNotKeyword()), PyNamedExpr('None')) ]))
                 get_parent_body.append(PyRetStmt(expr=PyAttrExpr(PyNamedExpr('self'), '_parent')))
             body.append(PyFuncDef(
                 #decorators=[ PyDecorator(PyNamedExpr('property')) ],
                 name='parent',
-                params=[ PyNamedParam(PyNamedPattern('self')) ],
+                params=get_parent_params,
                 return_type=PyConstExpr(parent_type_name),
                 body=get_parent_body,
             ))
@@ -350,17 +662,136 @@ def treespec_to_python(
     # Generate type aliases for parent fields
 
     if gen_parent_pointers:
+        parent_aliases = list[PyStmt]()
         for spec in specs.elements:
             if not isinstance(spec, NodeSpec):
                 continue
             parent_type = get_parent_type(spec.name)
             parent_type_name = f'{to_py_class_name(spec.name, prefix)}Parent'
-            stmts.append(PyTypeAliasStmt(parent_type_name, treespec_type_to_py_type(parent_type, prefix)))
+            parent_aliases.append(PyTypeAliasStmt(parent_type_name, treespec_type_to_py_type(parent_type, prefix)))
+        if enable_fast_import and parent_aliases:
+            # Only used in annotations, which are not evaluated
+            stmts.append(PyIfStmt(PyIfCase(PyNamedExpr('TYPE_CHECKING'), parent_aliases)))
+        else:
+            stmts.extend(parent_aliases)
 
     # Add coercers and other generated helpers
 
     stmts.extend(defs.values())
 
+    # Facades over green trees
+
+    def get_red_class_name(name: str) -> str:
+        return to_py_class_name(name + '_red', prefix)
+
+    def to_red_type(ty: Type) -> Type:
+        if isinstance(ty, SpecType):
+            spec = lookup_spec(specs, ty.name)
+            if spec is None or isinstance(spec, ConstEnumSpec) or isinstance(spec, TypeSpec):
+                return ty
+            return SpecType(ty.name + '_red')
+        return rewrite_each_child_type(ty, to_red_type)
+
+    def gen_red_green() -> Generator[PyStmt]:
+
+        # Each row holds the regular class, the facade class and the field names
+        kinds: list[PyExpr] = []
+
+        for spec in specs.elements:
+
+            if isinstance(spec, TokenSpec):
+                red_class_name = get_red_class_name(spec.name)
+                body = make_slots([])
+                if not spec.is_static:
+                    body.append(PyFuncDef(
+                        decorators=[ PyDecorator(PyNamedExpr('property')) ],
+                        name='value',
+                        params=[ PyNamedParam(PyNamedPattern('self')) ],
+                        return_type=extern_type_to_py_type(spec.field_type),
+                        body=[
+                            PyRetStmt(expr=PyCallExpr(extern_type_to_py_type(spec.field_type), args=[ PyAttrExpr(PyAttrExpr(PyNamedExpr('self'), 'green'), 'text') ])),
+                        ]
+                    ))
+                yield PyClassDef(red_class_name, bases=[ PyClassBaseArg('RedToken') ], body=body or [ PyPassStmt() ])
+                kinds.append(PyListExpr(elements=[ PyNamedExpr(to_py_class_name(spec.name, prefix)), PyNamedExpr(red_class_name) ]))
+
+            elif isinstance(spec, NodeSpec):
+                red_class_name = get_red_class_name(spec.name)
+                body = make_slots([])
+                for i, field in enumerate(spec.fields):
+                    body.append(PyFuncDef(
+                        decorators=[ PyDecorator(PyNamedExpr('property')) ],
+                        name=field.name,
+                        params=[ PyNamedParam(PyNamedPattern('self')) ],
+                        return_type=quote_py_type(treespec_type_to_py_type(to_red_type(field.ty), prefix, immutable=True)),
+                        body=[
+                            PyRetStmt(expr=PyCallExpr(
+                                PyAttrExpr(PyNamedExpr('self'), '_get_punct_field' if isinstance(field.ty, PunctType) else '_get_field'),
+                                args=[ PyConstExpr(i) ]
+                            )),
+                        ]
+                    ))
+                parent_type = to_red_type(get_parent_type(spec.name))
+                body.append(PyFuncDef(
+                    name='parent',
+                    params=[ PyNamedParam(PyNamedPattern('self')) ],
+                    return_type=quote_py_type(treespec_type_to_py_type(parent_type, prefix)),
+                    body=[
+                        PyCallExpr(PyNamedExpr('assert'), args=[ PyInfixExpr(PyAttrExpr(PyNamedExpr('self'), '_parent'), (PyIsKeyword(), PyNotKeyword()), PyNamedExpr('None')) ]),
+                        PyRetStmt(expr=PyAttrExpr(PyNamedExpr('self'), '_parent')),
+                    ]
+                ))
+                yield PyClassDef(red_class_name, bases=[ PyClassBaseArg('RedNode') ], body=body)
+                kinds.append(PyListExpr(elements=[
+                    PyNamedExpr(to_py_class_name(spec.name, prefix)),
+                    PyNamedExpr(red_class_name),
+                    *(PyConstExpr(field.name) for field in spec.fields),
+                ]))
+
+            elif isinstance(spec, EnumSpec):
+                yield PyTypeAliasStmt(
+                    get_red_class_name(spec.name),
+                    make_py_union(treespec_type_to_py_type(to_red_type(member.ty), prefix) for member in spec.members)
+                )
+
+        kinds_name = '_' + namespaced('green_kinds', prefix)
+
+        yield PyAssignStmt(PyNamedPattern(kinds_name), value=PyListExpr(elements=kinds))
+
+        def make_builder_params() -> list[PyParam]:
+            return [
+                PyNamedParam(PyNamedPattern('trivia'), annotation=make_py_optional(PyNamedExpr('TriviaTable')), default=PyNamedExpr('None')),
+                PyNamedParam(PyNamedPattern('get_text'), annotation=make_py_optional(PySubscriptExpr(PyNamedExpr('Callable'), slices=[ PyListExpr(elements=[ PyNamedExpr('Any') ]), PyNamedExpr('str') ])), default=PyNamedExpr('None')),
+                PyNamedParam(PyNamedPattern('interner'), annotation=make_py_optional(PyNamedExpr('GreenInterner')), default=PyNamedExpr('None')),
+            ]
+
+        builder_name = namespaced('green_builder', prefix)
+
+        # The builder can also be passed to a parser so that the green tree is built while parsing
+        yield PyFuncDef(
+            name=builder_name,
+            params=make_builder_params(),
+            return_type=PyNamedExpr('GreenBuilder'),
+            body=[
+                PyRetStmt(expr=PyCallExpr(PyNamedExpr('GreenBuilder'), args=[ PyNamedExpr(kinds_name), PyNamedExpr('trivia'), PyNamedExpr('get_text'), PyNamedExpr('interner') ])),
+            ]
+        )
+
+        yield PyFuncDef(
+            name=namespaced('to_green', prefix),
+            params=[
+                PyNamedParam(PyNamedPattern('node'), annotation=PyNamedExpr(base_syntax_class_name)),
+                *make_builder_params(),
+            ],
+            return_type=make_py_union([ PyNamedExpr('GreenNode'), PyNamedExpr('GreenToken') ]),
+            body=[
+                PyRetStmt(expr=PyCallExpr(
+                    PyAttrExpr(PyCallExpr(PyNamedExpr(builder_name), args=[ PyNamedExpr('trivia'), PyNamedExpr('get_text'), PyNamedExpr('interner') ]), 'build'),
+                    args=[ PyNamedExpr('node') ]
+                )),
+            ]
+        )
+
     # Generate visitors
 
     proc_param_name = 'proc'
@@ -406,14 +837,87 @@ def treespec_to_python(
             assert_never(source)
         return visit(source)
 
-    def gen_visitor(main_spec: Spec) -> PyFuncDef:
+    def gen_dispatch(fn_name: str, main_spec: Spec, visit_spec: Spec, cases: list[tuple[Spec, list[PyStmt]]]) -> Generator[PyStmt]:
+        """
+        Generate a visitor that looks up the handler of a node by its exact
+        type instead of testing it against every class that might match.
+
+        Subclasses of generated nodes miss the table and are resolved once
+        by `lookup_handler`. Specs without a body don't get a handler and
+        are silently skipped.
+        """
+
+        handlers_name = f'_{fn_name}_handlers'
+
+        decorators = []
+        if not enable_asserts:
+            # We add `@typing.no_type_check` to drastically improve the performance of the type checker.
+            decorators.append(PyDecorator(PyNamedExpr('no_type_check')))
+
+        proc_type = PySubscriptExpr(expr=PyNamedExpr('Callable'), slices=[ PyListExpr(elements=[ PyNamedExpr(to_py_class_name(visit_spec.name, prefix)) ]), PyNamedExpr('None') ])
+
+        entries = list[PyExpr]()
+        for spec, body in cases:
+            if not body:
+                continue
+            handler_name = f'_{fn_name}_in_{namespaced(spec.name, prefix)}'
+            yield PyFuncDef(
+                decorators=decorators,
+                name=handler_name,
+                params=[
+                    PyNamedParam(PyNamedPattern(node_param_name), annotation=PyNamedExpr(to_py_class_name(spec.name, prefix))),
+                    PyNamedParam(PyNamedPattern(proc_param_name), annotation=proc_type),
+                ],
+                return_type=PyNamedExpr('None'),
+                body=body,
+            )
+            entries.append(PyTupleExpr(elements=[ PyNamedExpr(to_py_class_name(spec.name, prefix)), PyNamedExpr(handler_name) ]))
+
+        yield PyAssignStmt(
+            PyNamedPattern(handlers_name),
+            annotation=PyConstExpr('dict[type, Callable[[Any, Any], None]]'),
+            value=PyCallExpr(PyNamedExpr('dict'), args=[ PyListExpr(elements=entries) ])
+        )
+
+        handler_var_name = 'handler'
+
+        yield PyFuncDef(
+            decorators=decorators,
+            name=fn_name,
+            params=[
+                PyNamedParam(
+                    PyNamedPattern(node_param_name),
+                    annotation=PyNamedExpr(to_py_class_name(main_spec.name, prefix))
+                ),
+                PyNamedParam(PyNamedPattern(proc_param_name), annotation=proc_type),
+            ],
+            return_type=PyNamedExpr('None'),
+            body=[
+                PyAssignStmt(
+                    PyNamedPattern(handler_var_name),
+                    value=PyCallExpr(PyAttrExpr(PyNamedExpr(handlers_name), 'get'), args=[ PyCallExpr(PyNamedExpr('type'), args=[ PyNamedExpr(node_param_name) ]) ])
+                ),
+                PyIfStmt(first=PyIfCase(
+                    test=PyInfixExpr(PyNamedExpr(handler_var_name), PyIsKeyword(), PyNamedExpr('None')),
+                    body=[
+                        PyAssignStmt(
+                            PyNamedPattern(handler_var_name),
+                            value=PyCallExpr(PyNamedExpr('lookup_handler'), args=[ PyNamedExpr(handlers_name), PyCallExpr(PyNamedExpr('type'), args=[ PyNamedExpr(node_param_name) ]) ])
+                        ),
+                    ],
+                )),
+                PyExprStmt(PyCallExpr(PyNamedExpr(handler_var_name), args=[ PyNamedExpr(node_param_name), PyNamedExpr(proc_param_name) ])),
+            ],
+        )
+
+    def gen_visitor(main_spec: Spec) -> Generator[PyStmt]:
 
         generate_temporary = NameGenerator()
-        inner_visit_fn_name = 'visit'
+        fn_name = f'for_each_{namespaced(main_spec.name, prefix)}'
         main_type = expand_variant_types(spec_to_type(main_spec), specs=specs)
         visited = set[str]()
 
-        inner_body: list[PyStmt] = []
+        cases = list[tuple[Spec, list[PyStmt]]]()
 
         def gen_visit_fields(spec: NodeSpec, input: PyExpr) -> Generator[PyStmt]:
             for field in spec.fields:
@@ -447,7 +951,7 @@ def treespec_to_python(
                     return
                 if spec.name in visited:
                     # If we've already reached this spec before, we can recurse
-                    yield PyExprStmt(PyCallExpr(PyNamedExpr(inner_visit_fn_name), args=[ input ]))
+                    yield PyExprStmt(PyCallExpr(PyNamedExpr(fn_name), args=[ input, PyNamedExpr(proc_param_name) ]))
                     return
                 visited.add(spec.name)
                 if isinstance(spec, EnumSpec):
@@ -470,11 +974,14 @@ def treespec_to_python(
                 separator_name = generate_temporary(prefix='separator')
                 for_body = list(gen_visit_type(ty.element_type, PyNamedExpr(element_name)))
                 sep_body = list(gen_visit_type(ty.separator_type, PyNamedExpr(separator_name)))
-                if sep_body:
-                    for_body.append(PyIfStmt(first=PyIfCase(
-                        test=PyInfixExpr(PyNamedExpr(separator_name), (PyIsKeyword(), PyNotKeyword()), PyNamedExpr('None')),
-                        body=sep_body,
-                    )))
+                if not sep_body:
+                    # No need to pair the elements with their separators
+                    yield PyForStmt(pattern=PyNamedPattern(element_name), expr=PyAttrExpr(input, 'elements'), body=for_body)
+                    return
+                for_body.append(PyIfStmt(first=PyIfCase(
+                    test=PyInfixExpr(PyNamedExpr(separator_name), (PyIsKeyword(), PyNotKeyword()), PyNamedExpr('None')),
+                    body=sep_body,
+                )))
                 yield PyForStmt(
                     pattern=PyTuplePattern(
                         elements=[
@@ -497,70 +1004,18 @@ def treespec_to_python(
                 continue
 
             if isinstance(spec, NodeSpec):
-
-                if_body = list(gen_visit_fields(spec, PyNamedExpr(node_param_name)))
-                if_body.append(PyRetStmt())
-                inner_body.append(PyIfStmt(first=PyIfCase(
-                    test=PyCallExpr(
-                        operator=PyNamedExpr('isinstance'),
-                        args=[
-                            PyNamedExpr(node_param_name),
-                            PyNamedExpr(to_py_class_name(spec.name, prefix))
-                        ]
-                    ),
-                    body=if_body
-                )))
+                cases.append((spec, list(gen_visit_fields(spec, PyNamedExpr(node_param_name)))))
 
             elif isinstance(spec, TokenSpec):
+                cases.append((spec, [ PyExprStmt(PyCallExpr(operator=PyNamedExpr(proc_param_name), args=[ PyNamedExpr(node_param_name) ])) ]))
 
-                if_body = []
-                if_body.append(PyExprStmt(PyCallExpr(operator=PyNamedExpr(proc_param_name), args=[ PyNamedExpr(node_param_name) ])))
-                if_body.append(PyRetStmt())
-                inner_body.append(PyIfStmt(first=PyIfCase(
-                    test=make_py_isinstance(
-                        PyNamedExpr(node_param_name),
-                        PyNamedExpr(to_py_class_name(spec.name, prefix))
-                    ),
-                    body=if_body,
-                )))
-
-        decorators = []
-        if not enable_asserts:
-            # We add `@typing.no_type_check` to drastically improve the performance of the type checker.
-            decorators.append(PyDecorator(PyNamedExpr('no_type_check')))
-
-        return PyFuncDef(
-            decorators=decorators,
-            name=f'for_each_{namespaced(main_spec.name, prefix)}',
-            params=[
-                PyNamedParam(
-                    PyNamedPattern(node_param_name),
-                    annotation=PyNamedExpr(to_py_class_name(main_spec.name, prefix))
-                ),
-                PyNamedParam(
-                    PyNamedPattern(proc_param_name),
-                    annotation=PySubscriptExpr(expr=PyNamedExpr('Callable'), slices=[ PyListExpr(elements=[ PyNamedExpr(to_py_class_name(main_spec.name, prefix)) ]), PyNamedExpr('None') ])
-                ),
-            ],
-            body=[
-                PyFuncDef(
-                    name=inner_visit_fn_name,
-                    params=[
-                        PyNamedParam(
-                            PyNamedPattern(node_param_name),
-                            annotation=PyNamedExpr(to_py_class_name(any_syntax_rule_name, prefix))
-                        ),
-                    ],
-                    return_type=PyNamedExpr('None'),
-                    body=inner_body
-                ),
-                PyExprStmt(PyCallExpr(PyNamedExpr(inner_visit_fn_name), args=[ PyNamedExpr(node_param_name) ])),
-            ],
-        )
+        return gen_dispatch(fn_name, main_spec, main_spec, cases)
 
-    stmts.extend(gen_visitor(spec) for spec in specs.elements if isinstance(spec, EnumSpec) and is_self_referential(spec.name, specs=specs))
+    for spec in specs.elements:
+        if isinstance(spec, EnumSpec) and is_self_referential(spec.name, specs=specs):
+            stmts.extend(gen_visitor(spec))
 
-    def gen_member_visitor(main_spec: Spec, visit_spec: Spec) -> PyFuncDef:
+    def gen_member_visitor(main_spec: Spec, visit_spec: Spec) -> Generator[PyStmt]:
 
         generate_temporary = NameGenerator()
 
@@ -569,7 +1024,7 @@ def treespec_to_python(
 
         fn_name = f'for_each_{namespaced(visit_spec.name, prefix)}'
 
-        body: list[PyStmt] = []
+        cases = list[tuple[Spec, list[PyStmt]]]()
 
         def gen_visit_fields(spec: NodeSpec, input: PyExpr) -> Generator[PyStmt]:
             for field in spec.fields:
@@ -652,62 +1107,110 @@ def treespec_to_python(
         for spec in specs.elements:
 
             if isinstance(spec, NodeSpec):
-
-                if_body = []
+                body = list[PyStmt]()
                 for field in spec.fields:
-                    if_body.extend(gen_visit_type(field.ty, PyAttrExpr(expr=PyNamedExpr(node_param_name), name=field.name)))
-                if_body.append(PyRetStmt())
-                body.append(PyIfStmt(first=PyIfCase(
-                    test=PyCallExpr(
-                        operator=PyNamedExpr('isinstance'),
-                        args=[
-                            PyNamedExpr(node_param_name),
-                            PyNamedExpr(to_py_class_name(spec.name, prefix))
-                        ]
-                    ),
-                    body=if_body
-                )))
+                    body.extend(gen_visit_type(field.ty, PyAttrExpr(expr=PyNamedExpr(node_param_name), name=field.name)))
+                cases.append((spec, body))
 
             elif isinstance(spec, TokenSpec):
+                cases.append((spec, [ PyExprStmt(PyCallExpr(operator=PyNamedExpr(proc_param_name), args=[ PyNamedExpr(node_param_name) ])) ]))
 
-                if_body = []
-                if_body.append(PyExprStmt(PyCallExpr(operator=PyNamedExpr(proc_param_name), args=[ PyNamedExpr(node_param_name) ])))
-                if_body.append(PyRetStmt())
-                body.append(PyIfStmt(first=PyIfCase(
-                    test=make_py_isinstance(
-                        PyNamedExpr(node_param_name),
-                        PyNamedExpr(to_py_class_name(spec.name, prefix))
-                    ),
-                    body=if_body,
-                )))
-
-        decorators = []
-        if not enable_asserts:
-            # We add `@typing.no_type_check` to drastically improve the performance of the type checker.
-            decorators.append(PyDecorator(PyNamedExpr('no_type_check')))
-
-        return PyFuncDef(
-            decorators=decorators,
-            name=fn_name,
-            params=[
-                PyNamedParam(
-                    PyNamedPattern(node_param_name),
-                    annotation=PyNamedExpr(to_py_class_name(main_spec.name, prefix))
-                ),
-                PyNamedParam(
-                    PyNamedPattern(proc_param_name),
-                    annotation=PySubscriptExpr(expr=PyNamedExpr('Callable'), slices=[ PyListExpr(elements=[ PyNamedExpr(to_py_class_name(visit_spec.name, prefix)) ]), PyNamedExpr('None') ])
-                ),
-            ],
-            body=body,
-        )
+        return gen_dispatch(fn_name, main_spec, visit_spec, cases)
 
     # NOTE This is disabled right now because we don't actually need it
     # TODO dynamically specify which types of which node to visit
     # tokens_spec = lookup_spec(specs, any_token_rule_name)
     # syntax_spec = lookup_spec(specs, any_syntax_rule_name)
     # if tokens_spec is not None and syntax_spec is not None:
-    #     stmts.append(gen_member_visitor(syntax_spec, tokens_spec))
+    #     stmts.extend(gen_member_visitor(syntax_spec, tokens_spec))
+
+    # Generate traversals
+
+    syntax_param_type = PyNamedExpr(base_syntax_class_name)
+
+    stmts.append(PyFuncDef(
+        name=namespaced('iter_preorder', prefix),
+        params=[ PyNamedParam(PyNamedPattern(node_param_name), annotation=syntax_param_type) ],
+        return_type=PyNamedExpr('PreorderIterator'),
+        body=[ PyRetStmt(expr=PyCallExpr(PyNamedExpr('PreorderIterator'), args=[ PyNamedExpr(node_param_name) ])) ],
+    ))
+
+    stmts.append(PyFuncDef(
+        name=namespaced('iter_postorder', prefix),
+        params=[ PyNamedParam(PyNamedPattern(node_param_name), annotation=syntax_param_type) ],
+        return_type=PyNamedExpr('PostorderIterator'),
+        body=[ PyRetStmt(expr=PyCallExpr(PyNamedExpr('PostorderIterator'), args=[ PyNamedExpr(node_param_name) ])) ],
+    ))
+
+    stmts.append(PyFuncDef(
+        name=namespaced('iter_descendants', prefix),
+        params=[
+            PyNamedParam(PyNamedPattern(node_param_name), annotation=syntax_param_type),
+            PyNamedParam(
+                PyNamedPattern('types'),
+                annotation=PyConstExpr('type | tuple[type, ...] | None'),
+                default=PyNamedExpr('None'),
+            ),
+        ],
+        return_type=PyNamedExpr('PreorderIterator'),
+        body=[
+            PyRetStmt(expr=PyCallExpr(PyNamedExpr('PreorderIterator'), args=[
+                PyNamedExpr(node_param_name),
+                PyNamedExpr('types'),
+                PyKeywordArg('include_self', PyNamedExpr('False')),
+            ])),
+        ],
+    ))
+
+    # Generate serializers
+
+    if enable_serializer:
+
+        serializer_name = '_' + namespaced('serializer', prefix)
+        node_class_names = list[PyExpr]()
+        static_token_class_names = list[PyExpr]()
+        value_token_class_names = list[PyExpr]()
+        enum_class_names = list[PyExpr]()
+        for spec in specs.elements:
+            if isinstance(spec, NodeSpec):
+                node_class_names.append(PyNamedExpr(to_py_class_name(spec.name, prefix)))
+            elif isinstance(spec, TokenSpec):
+                (static_token_class_names if spec.is_static else value_token_class_names).append(PyNamedExpr(to_py_class_name(spec.name, prefix)))
+            elif isinstance(spec, ConstEnumSpec):
+                enum_class_names.append(PyNamedExpr(to_py_class_name(spec.name, prefix)))
+
+        stmts.append(PyAssignStmt(
+            PyNamedPattern(serializer_name),
+            value=PyCallExpr(PyNamedExpr('SyntaxSerializer'), args=[
+                PyListExpr(elements=node_class_names),
+                PyListExpr(elements=static_token_class_names),
+                PyListExpr(elements=value_token_class_names),
+                PyListExpr(elements=enum_class_names),
+            ])
+        ))
+
+        stmts.append(PyFuncDef(
+            name=namespaced('dump', prefix),
+            params=[
+                PyNamedParam(PyNamedPattern(node_param_name), annotation=PyNamedExpr(base_syntax_class_name)),
+                PyNamedParam(PyNamedPattern('fp'), annotation=PyConstExpr('IO[bytes]')),
+            ],
+            return_type=PyNamedExpr('None'),
+            body=[
+                PyExprStmt(PyCallExpr(PyAttrExpr(PyNamedExpr(serializer_name), 'dump'), args=[ PyNamedExpr(node_param_name), PyNamedExpr('fp') ])),
+            ],
+        ))
+
+        stmts.append(PyFuncDef(
+            name=namespaced('load', prefix),
+            params=[
+                PyNamedParam(PyNamedPattern('fp'), annotation=PyConstExpr('IO[bytes]')),
+            ],
+            return_type=PyNamedExpr(base_syntax_class_name),
+            body=[
+                PyRetStmt(expr=PyCallExpr(PyAttrExpr(PyNamedExpr(serializer_name), 'load'), args=[ PyNamedExpr('fp') ])),
+            ],
+        ))
 
     # Generate rewriters
 
@@ -720,33 +1223,36 @@ def treespec_to_python(
 
         main_type = expand_variant_types(spec_to_type(main_spec), specs=specs)
 
-        changed_var_name = f'changed'
-
         body: list[PyStmt] = []
 
+        # Every rewrite below assigns the original object to its output if
+        # nothing changed inside of it. This allows us to test for changes by
+        # identity and only allocate new objects along the path to an edit.
+
+        def make_is_not(left: PyExpr, right: PyExpr) -> PyExpr:
+            return PyInfixExpr(left, (PyIsKeyword(), PyNotKeyword()), right)
+
         def gen_rewrite_fields(spec: NodeSpec, input: PyExpr, assign: Callable[[PyExpr], PyStmt], total: bool) -> Iterable[PyStmt]:
 
             body = []
             new_args = []
-
-            can_be_rewritten = False
-
-            body.append(PyAssignStmt(PyNamedPattern(changed_var_name), value=PyNamedExpr('False')))
+            tests = []
 
             for field in spec.fields:
                 if contains_type(expand_variant_types(field.ty, specs=specs), main_type, specs=specs):
-                    can_be_rewritten = True
                     new_field_name = generate_temporary(f'new_{field.name}')
                     new_args.append(PyKeywordArg(field.name, PyNamedExpr(new_field_name)))
+                    tests.append(make_is_not(PyNamedExpr(new_field_name), PyAttrExpr(input, field.name)))
                     body.extend(gen_rewrite_type(field.ty, PyAttrExpr(input, name=field.name), new_field_name, total)) # FIXME
                 else:
                     new_args.append(PyKeywordArg(field.name, PyAttrExpr(input, field.name)))
 
-            if not can_be_rewritten:
+            if not tests:
                 return [ assign(input) ]
 
             body.extend(make_py_cond([
-                (PyNamedExpr(changed_var_name), [ assign(PyCallExpr(PyNamedExpr(to_py_class_name(spec.name, prefix=prefix)), args=new_args)) ]),
+                # The fields already have the right types, so we can skip the coercions
+                (make_py_or(tests), [ assign(PyCallExpr(PyAttrExpr(PyNamedExpr(to_py_class_name(spec.name, prefix=prefix)), '_make'), args=new_args)) ]),
                 (None, [ assign(input) ])
             ]))
 
@@ -773,10 +1279,6 @@ def treespec_to_python(
             if is_type_assignable(main_type, expand_variant_types(ty, specs=specs),  specs=specs):
                 yield PyAssignStmt(PyNamedPattern(output), value=PyCallExpr(PyNamedExpr(proc_param_name), args=[ input ]))
                 yield PyExprStmt(PyCallExpr(PyNamedExpr('assert'), args=[ treespec_type_to_shallow_py_test(ty, PyNamedExpr(output), prefix=prefix, specs=specs) ] ))
-                yield PyIfStmt(first=PyIfCase(
-                    PyInfixExpr(PyNamedExpr(output), (PyIsKeyword(), PyNotKeyword()), input),
-                    [ PyAssignStmt(PyNamedPattern(changed_var_name), value=PyNamedExpr('True')) ]
-                ))
                 return
 
             if isinstance(ty, NoneType) or isinstance(ty, ExternType):
@@ -809,9 +1311,8 @@ def treespec_to_python(
 
             if isinstance(ty, TupleType):
 
-                new_elements_var_name = generate_temporary('new_elements')
-
-                yield PyAssignStmt(PyNamedPattern(new_elements_var_name), value=PyListExpr())
+                new_element_names = list[str]()
+                tests = list[PyExpr]()
 
                 for i, element_type in enumerate(ty.element_types):
 
@@ -825,63 +1326,91 @@ def treespec_to_python(
 
                     yield from gen_rewrite_type(element_type, PyNamedExpr(old_element_var_name), new_element_var_name, total=True)
 
-                    yield PyExprStmt(PyCallExpr(
-                        PyAttrExpr(PyNamedExpr(new_elements_var_name), 'append'),
-                        args=[ PyNamedExpr(new_element_var_name) ]
-                    ))
+                    new_element_names.append(new_element_var_name)
+                    tests.append(make_is_not(PyNamedExpr(new_element_var_name), PyNamedExpr(old_element_var_name)))
 
-                yield PyAssignStmt(PyNamedPattern(output), value=PyIfExpr(PyCallExpr(PyNamedExpr('tuple'), args=[ PyNamedExpr(new_elements_var_name) ]), PyNamedExpr(changed_var_name), input))
+                yield PyAssignStmt(PyNamedPattern(output), value=PyIfExpr(
+                    PyCallExpr(PyNamedExpr('tuple'), args=[ PyListExpr(elements=list(PyNamedExpr(name) for name in new_element_names)) ]),
+                    make_py_or(tests),
+                    input
+                ))
 
                 return
 
             if isinstance(ty, ListType):
 
+                index_name = generate_temporary('i')
                 element_name = generate_temporary('element')
                 new_element_var_name = generate_temporary('new_element')
 
-                yield PyAssignStmt(PyNamedPattern(output), value=PyListExpr())
-
+                # The list is only copied once one of its elements changed
+                yield PyAssignStmt(PyNamedPattern(output), value=input)
                 yield PyForStmt(
-                    pattern=PyNamedPattern(element_name),
-                    expr=input,
-                    body=list(gen_rewrite_type(ty.element_type, PyNamedExpr(element_name), new_element_var_name, total=True))
+                    pattern=PyTuplePattern(elements=[ PyNamedPattern(index_name), PyNamedPattern(element_name) ]),
+                    expr=PyCallExpr(PyNamedExpr('enumerate'), args=[ input ]),
+                    body=[
+                        *gen_rewrite_type(ty.element_type, PyNamedExpr(element_name), new_element_var_name, total=True),
+                        PyIfStmt(first=PyIfCase(
+                            test=make_is_not(PyNamedExpr(new_element_var_name), PyNamedExpr(element_name)),
+                            body=[
+                                PyIfStmt(first=PyIfCase(
+                                    test=PyInfixExpr(PyNamedExpr(output), PyIsKeyword(), input),
+                                    body=[ PyAssignStmt(PyNamedPattern(output), value=PyCallExpr(PyNamedExpr('list'), args=[ input ])) ],
+                                )),
+                                PyAssignStmt(PySubscriptPattern(PyNamedPattern(output), slices=[ PyNamedPattern(index_name) ]), value=PyNamedExpr(new_element_var_name)),
+                            ]
+                        )),
+                    ]
                 )
 
                 return
 
             if isinstance(ty, PunctType):
 
-                element_name = generate_temporary('element')
-                separator_name = generate_temporary('separator')
-                new_last_var_name = generate_temporary('new_last')
-                new_element_var_name = generate_temporary('new_element')
-                new_separator_var_name = generate_temporary('new_separator')
+                new_elements_var_name = generate_temporary('new_elements')
+                new_separators_var_name = generate_temporary('new_separators')
+
+                yield PyAssignStmt(PyNamedPattern(new_elements_var_name), value=PyAttrExpr(input, 'elements'))
+                yield PyAssignStmt(PyNamedPattern(new_separators_var_name), value=PyAttrExpr(input, 'separators'))
+
+                def gen_rewrite_column(element_type: Type, name: str, new_list_var_name: str) -> Generator[PyStmt]:
+                    if not contains_type(expand_variant_types(element_type, specs=specs), main_type, specs=specs):
+                        # Nothing in this column can change
+                        return
+                    index_name = generate_temporary('i')
+                    element_name = generate_temporary(name)
+                    new_element_var_name = generate_temporary(f'new_{name}')
+                    rewrite = list(gen_rewrite_type(element_type, PyNamedExpr(element_name), new_element_var_name, total=True))
+                    yield PyForStmt(
+                        pattern=PyTuplePattern(elements=[ PyNamedPattern(index_name), PyNamedPattern(element_name) ]),
+                        expr=PyCallExpr(PyNamedExpr('enumerate'), args=[ PyAttrExpr(input, name + 's') ]),
+                        body=[
+                            *rewrite,
+                            PyIfStmt(first=PyIfCase(
+                                test=make_is_not(PyNamedExpr(new_element_var_name), PyNamedExpr(element_name)),
+                                body=[
+                                    # Both columns are copied together so that the new sequence never shares a list with the old one
+                                    PyIfStmt(first=PyIfCase(
+                                        test=PyInfixExpr(PyNamedExpr(new_elements_var_name), PyIsKeyword(), PyAttrExpr(input, 'elements')),
+                                        body=[
+                                            PyAssignStmt(PyNamedPattern(new_elements_var_name), value=PyCallExpr(PyNamedExpr('list'), args=[ PyAttrExpr(input, 'elements') ])),
+                                            PyAssignStmt(PyNamedPattern(new_separators_var_name), value=PyCallExpr(PyNamedExpr('list'), args=[ PyAttrExpr(input, 'separators') ])),
+                                        ],
+                                    )),
+                                    PyAssignStmt(PySubscriptPattern(PyNamedPattern(new_list_var_name), slices=[ PyNamedPattern(index_name) ]), value=PyNamedExpr(new_element_var_name)),
+                                ]
+                            )),
+                        ]
+                    )
 
-                yield PyAssignStmt(
-                    PyNamedPattern(output),
-                    value=PyCallExpr(PyNamedExpr('Punctuated'))
-                )
+                yield from gen_rewrite_column(ty.element_type, 'element', new_elements_var_name)
+                yield from gen_rewrite_column(ty.separator_type, 'separator', new_separators_var_name)
 
-                yield PyForStmt(
-                    pattern=PyTuplePattern(
-                        elements=[
-                            PyNamedPattern(element_name),
-                            PyNamedPattern(separator_name)
-                        ],
-                    ),
-                    expr=PyAttrExpr(input, 'delimited'),
-                    body=[
-                        *gen_rewrite_type(ty.element_type, PyNamedExpr(element_name), new_element_var_name, total=True),
-                        *gen_rewrite_type(ty.separator_type, PyNamedExpr(separator_name), new_separator_var_name, total=True),
-                        PyExprStmt(PyCallExpr(PyAttrExpr(PyNamedExpr(output), 'append'), args=[
-                            PyNamedExpr(new_element_var_name),
-                            PyNamedExpr(new_separator_var_name),
-                        ]))
-                    ]
-                )
-
-                yield from gen_rewrite_type(ty.element_type, PyAttrExpr(input, 'last'), new_last_var_name, total=True)
-                yield PyExprStmt(PyCallExpr(PyAttrExpr(PyNamedExpr(output), 'append_final'), args=[ PyNamedExpr(new_last_var_name) ]))
+                yield PyAssignStmt(PyNamedPattern(output), value=PyIfExpr(
+                    PyCallExpr(PyAttrExpr(PyNamedExpr('Punctuated'), 'from_lists'), args=[ PyNamedExpr(new_elements_var_name), PyNamedExpr(new_separators_var_name) ]),
+                    make_is_not(PyNamedExpr(new_elements_var_name), PyAttrExpr(input, 'elements')),
+                    input,
+                ))
 
                 return
 
@@ -918,10 +1447,12 @@ def treespec_to_python(
                         PyNamedExpr(to_py_class_name(spec.name, prefix))
                     ),
                     body=[
-                        PyRetStmt(),
+                        PyRetStmt(expr=PyNamedExpr(node_param_name)),
                     ],
                 )))
 
+        body.append(PyRetStmt(expr=PyNamedExpr(node_param_name)))
+
         decorators = []
         if not enable_asserts:
             # We add `@typing.no_type_check` to drastically improve the performance of the type checker.
@@ -946,5 +1477,14 @@ def treespec_to_python(
 
     stmts.extend(gen_rewriter(spec) for spec in specs.elements if isinstance(spec, EnumSpec) and is_self_referential(spec.name, specs=specs))
 
+    # Generate facades over green trees
+
+    if enable_red_green:
+        stmts.extend(gen_red_green())
+
+    if enable_fast_import:
+        # Annotations are kept as strings instead of being evaluated on import
+        stmts.insert(0, PyImportFromStmt(PyAbsolutePath('__future__'), aliases=[ 'annotations' ]))
+
     return PyModule(stmts=stmts)
 
@@ -0,0 +1,303 @@
+from typing import Generator, assert_never
+
+from magelang.helpers import PyCondCase, lookup_spec, make_py_cond, namespaced, to_py_class_name, treespec_type_to_shallow_py_test
+from magelang.lang.mage.constants import string_rule_type
+from magelang.lang.python.cst import *
+from magelang.lang.python.emitter import emit
+from magelang.lang.treespec.ast import *
+from magelang.lang.treespec.helpers import is_static_type, is_unit_type, resolve_type_references
+from magelang.manager import declare_pass
+from magelang.util import NameGenerator, unreachable
+
+from .mage_insert_magic_rules import any_node_rule_name, any_syntax_rule_name, any_token_rule_name
+from .treespec_cst_to_ast import cst_type_to_ast_type, is_flag_field, is_ignored, rewrite_cst_type
+
+@declare_pass()
+def treespec_to_python_lazy_ast(
+    specs: Specs,
+    prefix: str = '',
+    enable_slots: bool = True,
+    enable_structural_eq: bool = False,
+    gen_parent_pointers: bool = True,
+    enable_parent_map: bool = False,
+    ast_prefix: str = '',
+) -> PyModule:
+    """
+    Generate AST classes that wrap a CST node and only compute a field when it
+    is first accessed.
+
+    `specs` are the specs of the CST. Every field is projected from the CST
+    following the same rules that `treespec_cst_to_ast` uses to translate the
+    types, after which the result is cached on the lazy node.
+
+    The fields of the AST class are never assigned by a lazy node, so its
+    constructor is not called. Instead, the lazy node initialises the rest
+    of the state of the AST node itself, and lazy children point to the
+    node that created them.
+
+    The AST classes are imported from the `ast` module of the package,
+    unless `ast_prefix` is set. In that case they are expected to be defined
+    in the same module with `ast_prefix` as their prefix.
+    """
+
+    store_parent_pointers = gen_parent_pointers and not enable_parent_map
+
+    ast_module_name = '_ast'
+
+    def ast_class_name(name: str) -> PyExpr:
+        if ast_prefix:
+            return PyNamedExpr(to_py_class_name(name, ast_prefix))
+        return PyAttrExpr(PyNamedExpr(ast_module_name), to_py_class_name(name, prefix))
+
+    def lazy_class_name(name: str) -> str:
+        return to_py_class_name('lazy_' + name, prefix)
+
+    def is_unit(ty: Type) -> bool:
+        return is_unit_type(rewrite_cst_type(ty, specs))
+
+    generate_temporary = NameGenerator()
+
+    def gen_project(ty: Type, input: PyExpr, target: str) -> Generator[PyStmt]:
+        """
+        Generate statements that assign the AST value of the CST value `input` to `target`.
+        """
+
+        def assign(value: PyExpr) -> PyStmt:
+            return PyAssignStmt(PyNamedPattern(target), value=value)
+
+        def gen_project_list(element_ty: Type, iterable: PyExpr) -> Generator[PyStmt]:
+            element_name = generate_temporary(prefix='element')
+            value_name = generate_temporary(prefix='value')
+            yield assign(PyListExpr())
+            yield PyForStmt(
+                pattern=PyNamedPattern(element_name),
+                expr=iterable,
+                body=[
+                    *gen_project(element_ty, PyNamedExpr(element_name), value_name),
+                    PyExprStmt(PyCallExpr(PyAttrExpr(PyNamedExpr(target), 'append'), args=[ PyNamedExpr(value_name) ])),
+                ]
+            )
+
+        ty = resolve_type_references(ty, specs=specs)
+
+        if isinstance(ty, SpecType):
+            spec = lookup_spec(specs, ty.name)
+            if spec is None or isinstance(spec, ConstEnumSpec):
+                yield assign(input)
+                return
+            if isinstance(spec, TokenSpec):
+                yield assign(PyNamedExpr('None') if spec.is_static else PyAttrExpr(input, 'value'))
+                return
+            if isinstance(spec, NodeSpec):
+                yield assign(PyCallExpr(PyNamedExpr(lazy_class_name(spec.name)), args=[ input ]))
+                if store_parent_pointers:
+                    yield PyAssignStmt(PyAttrPattern(PyNamedPattern(target), '_parent'), value=PyNamedExpr('self'))
+                return
+            if isinstance(spec, EnumSpec):
+                if all(is_static_type(member.ty, specs=specs) for member in spec.members):
+                    # The AST stores the member that was matched as a constant
+                    cases = list[PyCondCase]()
+                    for member in spec.members:
+                        cases.append((
+                            treespec_type_to_shallow_py_test(member.ty, input, prefix=prefix, specs=specs),
+                            [ assign(PyAttrExpr(ast_class_name(spec.name), member.name)) ],
+                        ))
+                    yield from make_py_cond(cases[:-1] + [ (None, cases[-1][1]) ])
+                    return
+                yield from gen_project(UnionType(list(member.ty for member in spec.members)), input, target)
+                return
+            if isinstance(spec, TypeSpec):
+                # Already resolved by resolve_type_references()
+                unreachable()
+            assert_never(spec)
+
+        if isinstance(ty, NoneType) or isinstance(ty, NeverType):
+            yield assign(PyNamedExpr('None'))
+            return
+
+        if isinstance(ty, ExternType) or isinstance(ty, AnyType):
+            yield assign(input)
+            return
+
+        if isinstance(ty, ListType):
+            if is_unit(ty.element_type):
+                yield assign(PyCallExpr(PyNamedExpr('len'), args=[ input ]))
+                return
+            yield from gen_project_list(ty.element_type, input)
+            ast_ty = cst_type_to_ast_type(ty, specs)
+            if isinstance(ast_ty, ExternType) and ast_ty.name == string_rule_type:
+                yield assign(PyCallExpr(PyAttrExpr(PyConstExpr(''), 'join'), args=[ PyNamedExpr(target) ]))
+            return
+
+        if isinstance(ty, TupleType):
+            kept = list((i, element_ty) for i, element_ty in enumerate(ty.element_types) if not is_unit(element_ty))
+            if len(kept) == 1:
+                i, element_ty = kept[0]
+                yield from gen_project(element_ty, PySubscriptExpr(input, slices=[ PyConstExpr(i) ]), target)
+                return
+            value_names = list[str]()
+            for i, element_ty in kept:
+                value_name = generate_temporary(prefix='value')
+                yield from gen_project(element_ty, PySubscriptExpr(input, slices=[ PyConstExpr(i) ]), value_name)
+                value_names.append(value_name)
+            yield assign(PyCallExpr(PyNamedExpr('tuple'), args=[ PyListExpr(elements=list(PyNamedExpr(name) for name in value_names)) ]))
+            return
+
+        if isinstance(ty, PunctType):
+            element_is_unit = is_unit(ty.element_type)
+            separator_is_unit = is_unit(ty.separator_type)
+            if element_is_unit and separator_is_unit:
+                yield assign(PyCallExpr(PyNamedExpr('len'), args=[ input ]))
+                return
+            if element_is_unit:
+                yield from gen_project_list(ty.separator_type, PyAttrExpr(input, 'separators'))
+                return
+            if separator_is_unit:
+                yield from gen_project_list(ty.element_type, PyAttrExpr(input, 'elements'))
+                return
+            elements_name = generate_temporary(prefix='elements')
+            separators_name = generate_temporary(prefix='separators')
+            yield from gen_project(ListType(ty.element_type), PyAttrExpr(input, 'elements'), elements_name)
+            yield from gen_project(ListType(ty.separator_type), PyAttrExpr(input, 'separators'), separators_name)
+            yield assign(PyCallExpr(PyAttrExpr(PyNamedExpr('Punctuated'), 'from_lists'), args=[ PyNamedExpr(elements_name), PyNamedExpr(separators_name) ]))
+            return
+
+        if isinstance(ty, UnionType):
+            cases = list[PyCondCase]()
+            for element_ty in ty.types:
+                body = [ assign(PyNamedExpr('None')) ] if is_unit(element_ty) else list(gen_project(element_ty, input, target))
+                cases.append((treespec_type_to_shallow_py_test(element_ty, input, prefix=prefix, specs=specs), body))
+            if cases:
+                # The CST guarantees that one of the members matches
+                yield from make_py_cond(cases[:-1] + [ (None, cases[-1][1]) ])
+            else:
+                yield assign(PyNamedExpr('None'))
+            return
+
+        assert_never(ty)
+
+    def gen_lazy_field(name: str, body: list[PyStmt], value_name: str) -> Generator[PyStmt]:
+        cache_name = '_lazy_' + name
+        yield PyFuncDef(
+            decorators=[ PyDecorator(PyNamedExpr('property')) ],
+            name=name,
+            params=[ PyNamedParam(PyNamedPattern('self')) ],
+            body=[
+                PyTryStmt(
+                    body=[ PyRetStmt(expr=PyAttrExpr(PyNamedExpr('self'), cache_name)) ],
+                    handlers=[ PyExceptHandler(PyNamedExpr('AttributeError'), [ PyPassStmt() ]) ],
+                ),
+                *body,
+                PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), cache_name), value=PyNamedExpr(value_name)),
+                PyRetStmt(expr=PyNamedExpr(value_name)),
+            ]
+        )
+        yield PyFuncDef(
+            decorators=[ PyDecorator(PyAttrExpr(PyNamedExpr(name), 'setter')) ],
+            name=name,
+            params=[ PyNamedParam(PyNamedPattern('self')), PyNamedParam(PyNamedPattern('value')) ],
+            return_type=PyNamedExpr('None'),
+            body=[
+                PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), cache_name), value=PyNamedExpr('value')),
+            ]
+        )
+
+    stmts = list[PyStmt]()
+
+    stmts.append(PyImportFromStmt(
+        PyAbsolutePath(PyQualName(modules=[ 'magelang' ], name='runtime')),
+        [ PyFromAlias('Punctuated') ]
+    ))
+    stmts.append(PyImportFromStmt(
+        PyRelativePath(1, name='cst'),
+        [ PyAsterisk() ]
+    ))
+    if not ast_prefix:
+        stmts.append(PyImportFromStmt(
+            PyRelativePath(1),
+            [ PyFromAlias('ast', asname=ast_module_name) ]
+        ))
+
+    lazy_classes = list[tuple[str, str]]()
+
+    for spec in specs.elements:
+
+        if not isinstance(spec, NodeSpec) or spec.name in [ any_token_rule_name, any_syntax_rule_name ]:
+            continue
+
+        self_cst = PyAttrExpr(PyNamedExpr('self'), '_cst')
+        body = list[PyStmt]()
+        cache_names = list[str]()
+        flag_names = list[str]()
+
+        for field in spec.fields:
+            if is_flag_field(field, specs):
+                flag_names.append(field.name)
+                continue
+            if is_ignored(cst_type_to_ast_type(field.ty, specs)):
+                continue
+            cache_names.append('_lazy_' + field.name)
+            value_name = generate_temporary(prefix='value')
+            body.extend(gen_lazy_field(field.name, list(gen_project(field.ty, PyAttrExpr(self_cst, field.name), value_name)), value_name))
+
+        if flag_names:
+            flags_class = ast_class_name(spec.name + '_flags')
+            value_name = generate_temporary(prefix='value')
+            flags_body: list[PyStmt] = [ PyAssignStmt(PyNamedPattern(value_name), value=PyConstExpr(0)) ]
+            for name in flag_names:
+                flags_body.append(PyIfStmt(first=PyIfCase(
+                    test=PyInfixExpr(PyAttrExpr(self_cst, name), (PyIsKeyword(), PyNotKeyword()), PyNamedExpr('None')),
+                    body=[ PyAugAssignStmt(PyNamedPattern(value_name), PyVerticalBar(), PyAttrExpr(flags_class, name)) ],
+                )))
+            cache_names.append('_lazy_flags')
+            body.extend(gen_lazy_field('flags', flags_body, value_name))
+
+        init_body: list[PyStmt] = [
+            PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), '_cst'), value=PyNamedExpr('cst')),
+        ]
+        if store_parent_pointers:
+            init_body.append(PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), '_parent'), value=PyNamedExpr('None')))
+        if enable_structural_eq:
+            init_body.append(PyAssignStmt(PyAttrPattern(PyNamedPattern('self'), '_hash'), value=PyNamedExpr('None')))
+
+        class_body = list[PyStmt]()
+        if enable_slots:
+            class_body.append(PyAssignStmt(PyNamedPattern('__slots__'), value=PyListExpr(elements=list(PyConstExpr(name) for name in [ '_cst', *cache_names ]))))
+        class_body.append(PyFuncDef(
+            name='__init__',
+            params=[ PyNamedParam(PyNamedPattern('self')), PyNamedParam(PyNamedPattern('cst'), annotation=PyNamedExpr(to_py_class_name(spec.name, prefix))) ],
+            return_type=PyNamedExpr('None'),
+            body=init_body,
+        ))
+        class_body.extend(body)
+
+        class_name = lazy_class_name(spec.name)
+        stmts.append(PyClassDef(
+            name=class_name,
+            bases=[ PyClassBaseArg(emit(ast_class_name(spec.name))) ],
+            body=class_body,
+        ))
+        lazy_classes.append((to_py_class_name(spec.name, prefix), class_name))
+
+    lazy_classes_name = '_' + namespaced('lazy_classes', prefix)
+
+    stmts.append(PyAssignStmt(
+        PyNamedPattern(lazy_classes_name),
+        value=PyCallExpr(PyNamedExpr('dict'), args=[
+            PyListExpr(elements=list(PyTupleExpr(elements=[ PyNamedExpr(cst_name), PyNamedExpr(lazy_name) ]) for cst_name, lazy_name in lazy_classes))
+        ])
+    ))
+
+    stmts.append(PyFuncDef(
+        name=namespaced('to_lazy_ast', prefix),
+        params=[ PyNamedParam(PyNamedPattern('node'), annotation=PyNamedExpr(to_py_class_name(any_node_rule_name, prefix))) ],
+        return_type=PyConstExpr(emit(ast_class_name(any_node_rule_name))),
+        body=[
+            PyRetStmt(expr=PyCallExpr(
+                PySubscriptExpr(PyNamedExpr(lazy_classes_name), slices=[ PyCallExpr(PyNamedExpr('type'), args=[ PyNamedExpr('node') ]) ]),
+                args=[ PyNamedExpr('node') ]
+            )),
+        ]
+    ))
+
+    return PyModule(stmts=stmts)
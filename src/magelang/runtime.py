@@ -1,11 +1,14 @@
 
 from abc import ABCMeta, abstractmethod
+from array import array
+from bisect import bisect_left
 from collections import deque
 from dataclasses import dataclass
+from itertools import chain, zip_longest
+import struct
+import sys
 from collections.abc import Collection, Reversible, Sequence
-from typing import Any, Iterable, Iterator, Protocol, SupportsIndex, TypeVar, assert_never, cast, overload
-
-from magelang.util import DropProxy, MapProxy
+from typing import IO, Any, Callable, Iterable, Iterator, Protocol, SupportsIndex, TextIO, TypeVar, assert_never, cast, overload
 
 
 EOF = '\uFFFF'
@@ -13,6 +16,8 @@ EOF = '\uFFFF'
 
 class TextPos:
 
+    __slots__ = ('offset', 'line', 'column')
+
     def __init__(self, offset: int, line: int, column: int) -> None:
         self.offset = offset
         self.line = line
@@ -21,6 +26,8 @@ class TextPos:
 
 class Span:
 
+    __slots__ = ('start_offset', 'end_offset')
+
     def __init__(self, start_offset: int, end_offset: int) -> None:
         self.start_offset = start_offset
         self.end_offset = end_offset
@@ -31,22 +38,43 @@ class Span:
 
 class BaseSyntax:
 
-    def __init__(self) -> None:
-        self._parent = None
+    # Subclasses decide whether they store a pointer to their parent
+    __slots__ = ()
+
+    # Names of the fields that may contain other nodes or tokens, in source order
+    _field_names: Sequence[str] = ()
 
     def has_parent(self) -> bool:
-        return self._parent is not None
+        return getattr(self, '_parent', None) is not None
 
 
 class BaseNode(BaseSyntax):
-    pass
+
+    __slots__ = ('_parent',)
+
+    def __init__(self) -> None:
+        self._parent = None
 
 
 class BaseToken(BaseSyntax):
 
+    # Offsets are stored directly on the token; -1 means there is no position
+    __slots__ = ('_parent', 'start_offset', 'end_offset')
+
     def __init__(self, span: Span | None = None) -> None:
-        super().__init__()
-        self.span = span
+        self._parent = None
+        if span is None:
+            self.start_offset = -1
+            self.end_offset = -1
+        else:
+            self.start_offset = span.start_offset
+            self.end_offset = span.end_offset
+
+    @property
+    def span(self) -> Span | None:
+        if self.start_offset < 0:
+            return None
+        return Span(self.start_offset, self.end_offset)
 
 
 _Element_cov = TypeVar('_Element_cov', covariant=True)
@@ -76,6 +104,8 @@ class SequenceLike(Reversible[_T_co], Collection[_T_co], Protocol[_T_co]):
 
 class ImmutablePunct(Reversible[tuple[_Element_cov, _Separator_cov | None]], Iterable[tuple[_Element_cov, _Separator_cov | None]], metaclass=ABCMeta):
 
+    __slots__ = ()
+
     def __len__(self) -> int: ...
 
     def __contains__(self, value: object, /) -> bool: ...
@@ -95,6 +125,9 @@ class ImmutablePunct(Reversible[tuple[_Element_cov, _Separator_cov | None]], Ite
     @property
     def elements(self) -> 'Sequence[_Element_cov]': ...
 
+    @property
+    def separators(self) -> 'Sequence[_Separator_cov]': ...
+
     @property
     def delimited(self) -> 'Sequence[tuple[_Element_cov, _Separator_cov]]': ...
 
@@ -105,76 +138,873 @@ class ImmutablePunct(Reversible[tuple[_Element_cov, _Separator_cov | None]], Ite
 _Element = TypeVar('_Element')
 _Separator = TypeVar('_Separator')
 
+class _DelimitedView(Sequence[tuple[_Element, _Separator]]):
+    """
+    A read-only view over the elements of a `Punctuated` that are followed by a separator.
+    """
+
+    __slots__ = ('_elements', '_separators')
+
+    def __init__(self, elements: list[_Element], separators: list[_Separator]) -> None:
+        self._elements = elements
+        self._separators = separators
+
+    def __len__(self) -> int:
+        return len(self._separators)
+
+    def __iter__(self) -> Iterator[tuple[_Element, _Separator]]:
+        return zip(self._elements, self._separators)
+
+    @overload
+    def __getitem__(self, key: int) -> tuple[_Element, _Separator]: ...
+
+    @overload
+    def __getitem__(self, key: slice) -> list[tuple[_Element, _Separator]]: ...
+
+    def __getitem__(self, key: int | slice) -> tuple[_Element, _Separator] | list[tuple[_Element, _Separator]]:
+        if isinstance(key, slice):
+            return list(zip(self._elements[key], self._separators[key]))
+        separator = self._separators[key]
+        if key < 0:
+            key += len(self._separators)
+        return self._elements[key], separator
+
+
 class Punctuated(ImmutablePunct[_Element, _Separator]):
+    """
+    A sequence of elements that are separated by some punctuation.
+
+    Elements and separators are stored in two parallel lists. Every element
+    except the last one is followed by a separator. The last element only has
+    a separator if the sequence has a trailing separator.
+    """
+
+    __slots__ = ('_elements', '_separators', '_trailing')
 
     def __init__(self, value: Iterable[tuple[_Element, _Separator | None]] | None = None) -> None:
         super().__init__()
-        self._storage = list(value) if value is not None else []
+        self._elements = list[_Element]()
+        self._separators = list[_Separator]()
+        self._trailing = False
+        if value is not None:
+            self.extend_pairs(value)
+
+    @classmethod
+    def from_lists(cls, elements: list[_Element], separators: list[_Separator]) -> 'Punctuated[_Element, _Separator]':
+        """
+        Create a new sequence that takes ownership of the given lists without copying them.
+
+        `separators` must either have one entry less than `elements` or, in the
+        case of a trailing separator, the same number of entries.
+        """
+        if len(separators) != len(elements) and len(separators) + 1 != len(elements):
+            raise ValueError(f'cannot create a punctuated sequence with {len(elements)} elements and {len(separators)} separators')
+        punct = cls.__new__(cls)
+        punct._elements = elements
+        punct._separators = separators
+        punct._trailing = len(separators) > 0 and len(separators) == len(elements)
+        return punct
+
+    def _check_open(self) -> None:
+        if len(self._separators) != len(self._elements):
+            raise ValueError('cannot add more elements after the last element')
 
     def append(self, element: _Element, separator: _Separator) -> None:
-        self._storage.append((element, separator))
+        self._check_open()
+        self._elements.append(element)
+        self._separators.append(separator)
+        self._trailing = True
 
     def append_final(self, element: _Element, separator: _Separator | None = None) -> None:
-        self._storage.append((element, separator))
+        self._check_open()
+        self._elements.append(element)
+        if separator is None:
+            self._trailing = False
+        else:
+            self._separators.append(separator)
+            self._trailing = True
+
+    def extend(self, elements: Iterable[_Element], separators: Iterable[_Separator]) -> None:
+        """
+        Append elements that are each followed by the corresponding separator.
+
+        The result always has a trailing separator. Use `append_final()`
+        afterwards to close the sequence.
+        """
+        self._check_open()
+        count = len(self._elements)
+        self._elements.extend(elements)
+        self._separators.extend(separators)
+        if len(self._separators) != len(self._elements):
+            del self._elements[count:]
+            del self._separators[count:]
+            raise ValueError('the number of elements and separators must be the same')
+        self._trailing = len(self._separators) > 0
+
+    def extend_pairs(self, pairs: Iterable[tuple[_Element, _Separator | None]]) -> None:
+        """
+        Append `(element, separator)` pairs, as produced by iterating over a `Punctuated`.
+
+        Only the last pair may have `None` as its separator.
+        """
+        for element, separator in pairs:
+            if separator is None:
+                self.append_final(element)
+            else:
+                self.append(element, separator)
 
     def __len__(self) -> int:
-        return len(self._storage)
+        return len(self._elements)
 
     def __contains__(self, value: object) -> bool:
-        return value in self._storage
+        return any(pair == value for pair in self)
+
+    def _to_list(self) -> list[tuple[_Element, _Separator | None]]:
+        return list(self)
 
     def __gt__(self, value: object, /) -> bool:
         if not isinstance(value, Punctuated):
             raise TypeError()
-        return self._storage > value._storage
+        return self._to_list() > value._to_list()
 
     def __ge__(self, value: object, /) -> bool:
         if not isinstance(value, Punctuated):
             raise TypeError()
-        return self._storage >= value._storage
+        return self._to_list() >= value._to_list()
 
     def __lt__(self, value: object, /) -> bool:
         if not isinstance(value, Punctuated):
             raise TypeError()
-        return self._storage < value._storage
+        return self._to_list() < value._to_list()
 
     def __le__(self, value: object, /) -> bool:
         if not isinstance(value, Punctuated):
             raise TypeError()
-        return self._storage <= value._storage
+        return self._to_list() <= value._to_list()
 
     def __reversed__(self) -> Iterator[tuple[_Element, _Separator | None]]:
-        return reversed(self._storage)
+        if self._elements and not self._trailing:
+            yield self._elements[-1], None
+        yield from zip(reversed(self._elements[:len(self._separators)]), reversed(self._separators))
 
     def __iter__(self) -> Iterator[tuple[_Element, _Separator | None]]:
-        return iter(self._storage)
+        return zip_longest(self._elements, self._separators)
+
+    @overload
+    def __getitem__(self, key: int) -> tuple[_Element, _Separator | None]: ...
+
+    @overload
+    def __getitem__(self, key: slice) -> list[tuple[_Element, _Separator | None]]: ...
 
     def __getitem__(self, key: int | slice) -> tuple[_Element, _Separator | None] | list[tuple[_Element, _Separator | None]]:
-        return self._storage[key]
+        if isinstance(key, slice):
+            return self._to_list()[key]
+        element = self._elements[key]
+        if key < 0:
+            key += len(self._elements)
+        return element, self._separators[key] if key < len(self._separators) else None
 
     @property
     def elements(self) -> Sequence[_Element]:
-        return MapProxy(self._storage, lambda pair: pair[0])
+        return self._elements
+
+    @property
+    def separators(self) -> Sequence[_Separator]:
+        return self._separators
 
     @property
     def delimited(self) -> Sequence[tuple[_Element, _Separator]]:
-        return DropProxy(cast(list[tuple[_Element, _Separator]], self._storage), 1) \
-            if self and self.last_delimiter is None \
-            else cast(list[tuple[_Element, _Separator]], self._storage)
+        return _DelimitedView(self._elements, self._separators)
+
+    @property
+    def has_trailing_separator(self) -> bool:
+        return self._trailing
 
     @property
     def last(self) -> _Element | None:
-        return self._storage[-1][0] if self else None
+        return self._elements[-1] if self._elements else None
 
     @property
     def last_delimiter(self) -> _Separator | None:
-        return self._storage[-1][1] if self else None
+        return self._separators[-1] if self._trailing else None
 
 
 
 ImmutablePunct.register(Punctuated) # type: ignore
 
 
+def _collect_syntax(value: Any, out: list[BaseSyntax]) -> None:
+    if isinstance(value, BaseSyntax):
+        out.append(value)
+    elif isinstance(value, Punctuated):
+        for element, separator in value:
+            _collect_syntax(element, out)
+            if separator is not None:
+                _collect_syntax(separator, out)
+    elif isinstance(value, list) or isinstance(value, tuple):
+        for element in value:
+            _collect_syntax(element, out)
+
+
+def get_children(node: BaseSyntax) -> list[BaseSyntax]:
+    """
+    Get the nodes and tokens that are directly contained in `node`, in source order.
+    """
+    children = list[BaseSyntax]()
+    for name in node._field_names:
+        _collect_syntax(getattr(node, name), children)
+    return children
+
+
+def derive_node[T: BaseSyntax](node: T, changes: dict[str, Any]) -> T:
+    """
+    Create a copy of `node` where the fields in `changes` have a new value.
+
+    The new values are coerced by the constructor of the node's class.
+    """
+    for name in node._field_names:
+        if name not in changes:
+            changes[name] = getattr(node, name)
+    return type(node)(**changes)
+
+
+def _skip_node(node: Any, proc: Any) -> None:
+    pass
+
+
+def lookup_handler(handlers: dict[type, Callable[[Any, Any], None]], cls: type) -> Callable[[Any, Any], None]:
+    """
+    Find the handler of the nearest base class of `cls` in `handlers`.
+
+    Generated visitors look up their handler by exact type and call this
+    function on a miss, so that subclasses of generated nodes are visited
+    as well. The result is stored in `handlers` so the next lookup of
+    `cls` is a single dictionary access. Classes without a handler are
+    skipped.
+    """
+    for base in cls.__mro__:
+        handler = handlers.get(base)
+        if handler is not None:
+            break
+    else:
+        handler = _skip_node
+    handlers[cls] = handler
+    return handler
+
+
+def find_start_offset(node: BaseSyntax) -> int:
+    """
+    Get the start offset of the first token inside `node` that has a position.
+
+    Nodes that already computed their offset are not walked into again.
+    Returns -1 if none of the tokens have a position.
+    """
+    stack = get_children(node)[::-1]
+    while stack:
+        child = stack.pop()
+        if child._field_names:
+            offset = getattr(child, '_start_offset', None)
+            if offset is None:
+                stack.extend(reversed(get_children(child)))
+                continue
+        else:
+            offset = getattr(child, 'start_offset', -1)
+        if offset >= 0:
+            return offset
+    return -1
+
+
+def find_end_offset(node: BaseSyntax) -> int:
+    """
+    Get the end offset of the last token inside `node` that has a position.
+
+    This is the mirror image of `find_start_offset()`.
+    """
+    stack = get_children(node)
+    while stack:
+        child = stack.pop()
+        if child._field_names:
+            offset = getattr(child, '_end_offset', None)
+            if offset is None:
+                stack.extend(get_children(child))
+                continue
+        else:
+            offset = getattr(child, 'end_offset', -1)
+        if offset >= 0:
+            return offset
+    return -1
+
+
+def clear_cached_offsets(node: BaseSyntax, parents: 'ParentMap | None' = None) -> None:
+    """
+    Forget the offsets that `node` and its ancestors have cached.
+
+    Assigning a field does not clear the cache by itself, so call this
+    function after a node or a list in it was changed in place. Nodes that
+    were created by `derive()` or by a rewriter have not cached anything yet.
+
+    The ancestors are found with `parents` if it is given. Otherwise the
+    parent pointers of the nodes are followed, which generated parsers
+    don't set, so pass a `ParentMap` when the tree was parsed.
+    """
+    ancestors = parents.iter_ancestors(node) if parents is not None else _iter_parent_pointers(node)
+    for node in chain([ node ], ancestors):
+        for name in ('_start_offset', '_end_offset'):
+            try:
+                delattr(node, name)
+            except AttributeError:
+                pass
+
+
+def _iter_parent_pointers(node: BaseSyntax) -> Iterator[BaseSyntax]:
+    parent = getattr(node, '_parent', None)
+    while parent is not None:
+        yield parent
+        parent = getattr(parent, '_parent', None)
+
+
+class PreorderIterator(Iterator[BaseSyntax]):
+    """
+    Lazily walks over a tree, visiting parents before their children.
+
+    The walk uses an explicit stack, so it works on trees of any depth. Call
+    `prune()` to skip the children of the node that was returned last.
+
+    When `types` is given, only nodes that are an instance of one of these
+    types are returned, though their children are still visited.
+    """
+
+    __slots__ = ('_stack', '_last', '_types')
+
+    def __init__(self, node: BaseSyntax, types: type | tuple[type, ...] | None = None, include_self: bool = True) -> None:
+        self._stack = [ node ] if include_self else get_children(node)[::-1]
+        self._last: BaseSyntax | None = None
+        self._types = types
+
+    def __iter__(self) -> 'PreorderIterator':
+        return self
+
+    def __next__(self) -> BaseSyntax:
+        stack = self._stack
+        if self._last is not None:
+            stack.extend(reversed(get_children(self._last)))
+            self._last = None
+        types = self._types
+        while stack:
+            node = stack.pop()
+            if types is None or isinstance(node, types):
+                self._last = node
+                return node
+            stack.extend(reversed(get_children(node)))
+        raise StopIteration
+
+    def prune(self) -> None:
+        """
+        Do not visit the children of the node that was returned last.
+        """
+        self._last = None
+
+
+class PostorderIterator(Iterator[BaseSyntax]):
+    """
+    Lazily walks over a tree, visiting children before their parents.
+
+    Like `PreorderIterator`, this iterator uses an explicit stack.
+    """
+
+    __slots__ = ('_stack',)
+
+    def __init__(self, node: BaseSyntax) -> None:
+        self._stack: list[tuple[BaseSyntax, bool]] = [ (node, False) ]
+
+    def __iter__(self) -> 'PostorderIterator':
+        return self
+
+    def __next__(self) -> BaseSyntax:
+        stack = self._stack
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                return node
+            stack.append((node, True))
+            for child in reversed(get_children(node)):
+                stack.append((child, False))
+        raise StopIteration
+
+
+class KindIndex:
+    """
+    Maps every class of node and token in a tree to its instances, in document order.
+
+    The index is built with a single walk over the tree when it is first
+    queried, after which a query only costs as much as the size of its result.
+    Modifying the tree afterwards does not update the index.
+
+    Each instance is indexed together with the offset at which it starts,
+    which is taken from the first token inside it that has a position. Nodes
+    without any tokens start where the next token starts.
+    """
+
+    __slots__ = ('_root', '_nodes', '_offsets')
+
+    def __init__(self, root: BaseSyntax) -> None:
+        self._root = root
+        self._nodes: dict[type, list[BaseSyntax]] | None = None
+        self._offsets = dict[type, list[int]]()
+
+    def _build(self) -> dict[type, list[BaseSyntax]]:
+        nodes = dict[type, list[BaseSyntax]]()
+        offsets = self._offsets
+        # Entries whose offset will be the start of the next token with a span
+        pending = list[tuple[list[int], int]]()
+        end_offset = 0
+        stack: list[BaseSyntax] = [ self._root ]
+        while stack:
+            node = stack.pop()
+            cls = type(node)
+            node_list = nodes.get(cls)
+            if node_list is None:
+                node_list = nodes[cls] = []
+                offsets[cls] = []
+            node_list.append(node)
+            offset_list = offsets[cls]
+            start_offset = -1 if node._field_names else getattr(node, 'start_offset', -1)
+            if start_offset < 0:
+                pending.append((offset_list, len(offset_list)))
+                offset_list.append(-1)
+                stack.extend(reversed(get_children(node)))
+                continue
+            offset_list.append(start_offset)
+            for pending_list, i in pending:
+                pending_list[i] = start_offset
+            pending.clear()
+            end_offset = getattr(node, 'end_offset')
+        for pending_list, i in pending:
+            pending_list[i] = end_offset
+        self._nodes = nodes
+        return nodes
+
+    def _get_nodes(self, cls: type) -> list[Any]:
+        nodes = self._nodes
+        if nodes is None:
+            nodes = self._build()
+        return nodes.get(cls, [])
+
+    def find_all[T: BaseSyntax](self, cls: type[T]) -> Sequence[T]:
+        """
+        Get all nodes or tokens that are exactly of type `cls`, in document order.
+
+        The returned sequence belongs to the index and must not be modified.
+        """
+        return self._get_nodes(cls)
+
+    def find_in_range[T: BaseSyntax](self, cls: type[T], start_offset: int, end_offset: int) -> Sequence[T]:
+        """
+        Get the nodes or tokens of type `cls` that start at an offset in the
+        range from `start_offset` up to but not including `end_offset`.
+        """
+        nodes = self._get_nodes(cls)
+        if not nodes:
+            return []
+        offsets = self._offsets[cls]
+        lo = bisect_left(offsets, start_offset)
+        hi = bisect_left(offsets, end_offset, lo)
+        return nodes[lo:hi]
+
+    def count(self, cls: type) -> int:
+        """
+        Count the nodes or tokens that are exactly of type `cls`.
+        """
+        return len(self._get_nodes(cls))
+
+
+class ParentMap:
+    """
+    Finds the node that directly contains a node or token, without requiring
+    every node to store a pointer to its parent.
+
+    The map is built with a single walk over the tree when it is first
+    queried, after which each lookup takes constant time. Changes that are
+    made to the tree afterwards must be recorded with `set_parent()`.
+    Generated rewriters do not update the map. After a rewrite, call
+    `invalidate()` or create a new map for the tree that was returned.
+
+    Nodes are looked up by identity. A node that occurs more than once in the
+    tree, such as a shared token, is only recorded with the last parent it was
+    found in. The map keeps a reference to every node in it, so the identity
+    of a node that was removed from the tree can't be reused by a new one.
+    """
+
+    __slots__ = ('_root', '_parents')
+
+    def __init__(self, root: BaseSyntax) -> None:
+        self._root = root
+        self._parents: dict[int, tuple[BaseSyntax, BaseSyntax]] | None = None
+
+    def _build(self) -> dict[int, tuple[BaseSyntax, BaseSyntax]]:
+        parents = dict[int, tuple[BaseSyntax, BaseSyntax]]()
+        stack: list[BaseSyntax] = [ self._root ]
+        while stack:
+            node = stack.pop()
+            for child in get_children(node):
+                parents[id(child)] = (child, node)
+                stack.append(child)
+        self._parents = parents
+        return parents
+
+    def invalidate(self) -> None:
+        """
+        Forget all parents so that the map is built again on the next lookup.
+        """
+        self._parents = None
+
+    def get_parent(self, node: BaseSyntax) -> Any:
+        """
+        Get the node that contains `node` or `None` if `node` is the root of the tree.
+        """
+        parents = self._parents
+        if parents is None:
+            parents = self._build()
+        entry = parents.get(id(node))
+        if entry is None or entry[0] is not node:
+            return None
+        return entry[1]
+
+    def parent(self, node: BaseSyntax) -> Any:
+        """
+        Get the node that contains `node`, failing if `node` is not inside the tree.
+        """
+        parent = self.get_parent(node)
+        if parent is None:
+            raise ValueError('node does not have a parent in this tree')
+        return parent
+
+    def set_parent(self, node: BaseSyntax, parent: BaseSyntax) -> None:
+        parents = self._parents
+        if parents is None:
+            parents = self._build()
+        parents[id(node)] = (node, parent)
+
+    def iter_ancestors(self, node: BaseSyntax) -> Iterator[BaseSyntax]:
+        """
+        Walk from the parent of `node` up to the root of the tree.
+        """
+        parent = self.get_parent(node)
+        while parent is not None:
+            yield parent
+            parent = self.get_parent(parent)
+
+
+def _has_structural_eq(value: Any) -> bool:
+    # Only nodes that were generated with structural equality have a cached hash
+    return isinstance(value, BaseSyntax) and bool(value._field_names) and hasattr(value, '_hash')
+
+
+def structural_eq(left: Any, right: Any) -> bool:
+    """
+    Compare two field values of a node by their contents.
+
+    Lists, tuples and punctuated sequences are compared element by element.
+    Nodes with structural equality are compared field by field. Everything
+    else is compared with `==`.
+
+    Uses an explicit stack, so it works on trees of any depth.
+    """
+    stack = [ (left, right) ]
+    while stack:
+        left, right = stack.pop()
+        if left is right:
+            continue
+        if isinstance(left, Punctuated):
+            if not isinstance(right, Punctuated):
+                return False
+            stack.append((left._separators, right._separators))
+            stack.append((left._elements, right._elements))
+        elif isinstance(left, list) or isinstance(left, tuple):
+            if not (isinstance(right, list) or isinstance(right, tuple)) or len(left) != len(right):
+                return False
+            stack.extend(reversed(list(zip(left, right))))
+        elif _has_structural_eq(left):
+            if type(left) is not type(right) or hash(left) != hash(right):
+                return False
+            stack.extend((getattr(left, name), getattr(right, name)) for name in reversed(left._field_names))
+        elif left != right:
+            return False
+    return True
+
+
+def _prime_hashes(value: Any) -> None:
+    """
+    Compute the hashes of the nodes inside `value` from the bottom up.
+
+    Each node caches its hash, so afterwards hashing `value` never has to
+    recurse into a subtree.
+    """
+    stack = [ value ]
+    pending = list[BaseSyntax]()
+    while stack:
+        value = stack.pop()
+        if isinstance(value, BaseSyntax):
+            if getattr(value, '_hash', 0) is None:
+                pending.append(value)
+                stack.extend(getattr(value, name) for name in value._field_names)
+        elif isinstance(value, Punctuated):
+            stack.extend(value._elements)
+            stack.extend(value._separators)
+        elif isinstance(value, list) or isinstance(value, tuple):
+            stack.extend(value)
+    # Every node comes after its parent, so children are hashed first
+    for node in reversed(pending):
+        hash(node)
+
+
+def structural_hash(value: Any) -> int:
+    """
+    Hash a field value of a node by its contents.
+
+    Unlike `hash()`, this also works on lists and punctuated sequences.
+    """
+    _prime_hashes(value)
+    return _shallow_hash(value)
+
+
+def _shallow_hash(value: Any) -> int:
+    if isinstance(value, Punctuated):
+        return hash((_shallow_hash(value._elements), _shallow_hash(value._separators)))
+    if isinstance(value, list) or isinstance(value, tuple):
+        return hash(tuple(_shallow_hash(element) for element in value))
+    return hash(value)
+
+
+class Interner(Protocol):
+    """
+    Something that a generated parser can hand each new token and node to.
+
+    The returned value is stored in place of the original one.
+    """
+
+    def intern(self, value: Any) -> Any: ...
+
+
+class SyntaxInterner:
+    """
+    Deduplicates nodes and tokens that are structurally equal.
+
+    Only works with trees that were generated with structural equality
+    enabled. Interned nodes may be shared between different parents, so
+    parent pointers can't be relied upon. An interned node must never be
+    mutated.
+
+    Structural equality ignores the positions of tokens, so by default equal
+    tokens and nodes are shared even when they were lexed at different
+    positions. The shared copy then reports the offsets of whichever one was
+    interned first. Use a red-green tree, whose offsets are computed from the
+    widths of the shared green nodes, to get both sharing and positions.
+    Pass `keep_positions=True` to only share tokens without a position and
+    nodes that only contain such tokens, which keeps all offsets but shares
+    little of a parsed tree.
+    """
+
+    __slots__ = ('_table', '_keep_positions')
+
+    def __init__(self, keep_positions: bool = False) -> None:
+        self._table = dict[BaseSyntax, BaseSyntax]()
+        self._keep_positions = keep_positions
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def intern(self, node: _T) -> _T:
+        """
+        Return the node that was interned earlier and is equal to `node`, or
+        intern `node` itself.
+
+        Children should be interned before their parents so that equal
+        subtrees end up being shared.
+        """
+        if self._keep_positions and self._has_position(node):
+            return node
+        return self._table.setdefault(node, node) # type: ignore
+
+    def _has_position(self, node: Any) -> bool:
+        if not isinstance(node, BaseSyntax):
+            return False
+        if not node._field_names:
+            return getattr(node, 'start_offset', -1) >= 0
+        # Children were interned first, so a child with a position is a child that was not shared
+        table = self._table
+        for child in get_children(node):
+            if child._field_names:
+                if table.get(child) is not child:
+                    return True
+            elif getattr(child, 'start_offset', -1) >= 0:
+                return True
+        return False
+
+
+class TriviaTable:
+    """
+    Records where each token of a source text starts and ends.
+
+    Trivia such as whitespace and comments is not stored on the tokens.
+    Instead, the trivia in front of a token is the text between the end of
+    the previous token and the start of this one. Offsets are kept in two
+    compact arrays in the order in which the tokens were lexed.
+    """
+
+    __slots__ = ('text', '_starts', '_ends')
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self._starts = array('q')
+        self._ends = array('q')
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def add(self, start_offset: int, end_offset: int) -> None:
+        """
+        Record a token that was lexed at the given offsets.
+        """
+        ends = self._ends
+        # A lexer that backtracks may lex the same token more than once
+        if ends and start_offset < ends[-1]:
+            return
+        self._starts.append(start_offset)
+        ends.append(end_offset)
+
+    def index_of(self, token: Any) -> int:
+        """
+        Get the position of `token` in the table or -1 if it was not lexed from this text.
+        """
+        start_offset = getattr(token, 'start_offset', -1)
+        if start_offset < 0:
+            return -1
+        starts = self._starts
+        i = bisect_left(starts, start_offset)
+        if i == len(starts) or starts[i] != start_offset or self._ends[i] != token.end_offset:
+            return -1
+        return i
+
+    def leading_trivia(self, index: int) -> str:
+        """
+        Get the text between the token at `index` and the one before it.
+        """
+        return self.text[self._ends[index-1] if index > 0 else 0:self._starts[index]]
+
+    def trailing_trivia(self, index: int) -> str:
+        """
+        Get the text between the token at `index` and the one after it.
+        """
+        return self.text[self._ends[index]:self._starts[index+1] if index+1 < len(self._starts) else len(self.text)]
+
+
+# Markers for subtrees that can't be copied from the source text as a single slice
+_NO_TOKENS = (-1, -1)
+_EDITED = (-2, -2)
+_MIXED = (-3, -3)
+
+
+def _get_original_ranges(root: BaseSyntax, trivia: TriviaTable) -> dict[int, tuple[int, int]]:
+    """
+    Map each node and token to the range of token indices in `trivia` it covers.
+
+    Only subtrees whose tokens are recorded one after another get a range.
+    The others get one of the markers above.
+    """
+    ranges = dict[int, tuple[int, int]]()
+    stack: list[tuple[BaseSyntax, bool]] = [ (root, False) ]
+    while stack:
+        node, visited = stack.pop()
+        if not node._field_names:
+            i = trivia.index_of(node)
+            ranges[id(node)] = (i, i) if i >= 0 else _EDITED
+            continue
+        children = get_children(node)
+        if not visited:
+            stack.append((node, True))
+            for child in children:
+                stack.append((child, False))
+            continue
+        result = _NO_TOKENS
+        for child in children:
+            child_range = ranges[id(child)]
+            if child_range is _NO_TOKENS:
+                continue
+            if result is _NO_TOKENS:
+                result = child_range
+            elif result[0] >= 0 and child_range[0] == result[1] + 1:
+                result = (result[0], child_range[1])
+            elif result is _EDITED and child_range is _EDITED:
+                pass
+            else:
+                result = _MIXED
+                break
+        ranges[id(node)] = result
+    return ranges
+
+
+def emit_lossless(
+    node: BaseSyntax,
+    trivia: TriviaTable,
+    emit_node: Callable[[Any], str],
+    emit_token: Callable[[Any], str],
+    default_trivia: str = ' ',
+) -> str:
+    """
+    Print `node` while keeping the formatting of the text it was parsed from.
+
+    Subtrees whose tokens were all recorded in `trivia`, in the same order,
+    are copied from the source text as a single slice. Only subtrees that
+    were created after parsing are printed with `emit_node()` or
+    `emit_token()`. The trivia around such a subtree is taken from its
+    neighbouring tokens in the source text, or is `default_trivia` if
+    neither of them was lexed from it.
+
+    The result starts with the trivia in front of the first token that was
+    copied and ends with the trivia after the last one. For the root of the
+    tree, this includes whatever follows the last token of the text.
+
+    Each call walks the whole tree to find out which subtrees are
+    unchanged, looking up every token in `trivia` with a binary search.
+    This costs O(n log n) for a tree with n tokens before any text is
+    copied, so call it once on the root rather than on many subtrees.
+    """
+    text = trivia.text
+    starts = trivia._starts
+    ends = trivia._ends
+    ranges = _get_original_ranges(node, trivia)
+    out = list[str]()
+    # Index of the last token that was copied or -1 if something new was printed
+    prev = -1
+    # Index of the last token that was copied, even if something new was printed after it
+    last_copied = -1
+    stack: list[BaseSyntax] = [ node ]
+    while stack:
+        node = stack.pop()
+        first, last = ranges[id(node)]
+        if first >= 0:
+            out.append(trivia.leading_trivia(first))
+            out.append(text[starts[first]:ends[last]])
+            prev = last
+            last_copied = last
+            continue
+        if first == _MIXED[0]:
+            stack.extend(reversed(get_children(node)))
+            continue
+        if first == _EDITED[0]:
+            if prev >= 0:
+                out.append(trivia.trailing_trivia(prev))
+            elif out:
+                out.append(default_trivia)
+            out.append(emit_node(node) if node._field_names else emit_token(node))
+            prev = -1
+    if last_copied >= 0:
+        # Keep whatever follows the last token, such as a final newline
+        out.append(trivia.trailing_trivia(last_copied))
+    return ''.join(out)
+
+
 class ScanError(RuntimeError):
     pass
 
@@ -192,6 +1022,21 @@ class AbstractLexer:
         self._text = text
         self._curr_offset = start_offset
         self._curr_pos = LineColumn(start_line, start_column)
+        self._trivia: TriviaTable | None = None
+
+    @property
+    def trivia(self) -> TriviaTable:
+        """
+        The positions of the tokens that were lexed so far.
+
+        Only lexers that were generated with trivia enabled record their
+        tokens, so the table is created on first use.
+        """
+        trivia = self._trivia
+        if trivia is None:
+            trivia = TriviaTable(self._text)
+            self._trivia = trivia
+        return trivia
 
     def _char_at(self, offset: int) -> str:
         return self._text[offset] if offset < len(self._text) else EOF
@@ -207,6 +1052,21 @@ class AbstractLexer:
         self._curr_offset = other._curr_offset
         self._curr_pos = other._curr_pos
 
+    def _record[T](self, token: T, start_offset: int, end_offset: int) -> T:
+        """
+        Give `token` its position and record it in the trivia table.
+
+        A token that is shared between all positions is replaced by a new
+        token of the same class.
+        """
+        if getattr(type(token), '_shared', None) is token:
+            token = type(token)(Span(start_offset, end_offset)) # type: ignore
+        else:
+            token.start_offset = start_offset # type: ignore
+            token.end_offset = end_offset # type: ignore
+        self.trivia.add(start_offset, end_offset)
+        return token
+
     def at_eof(self) -> bool:
         self.skip()
         return self._curr_offset >= len(self._text)
@@ -281,9 +1141,671 @@ ParseStream = Stream[BaseToken]
 
 CharStream = Stream[str]
 
+## -- Designed for the table-driven parser
+
+# Every instruction is exactly two integers wide: an opcode and an argument.
+OP_TOKEN = 0        # Consume a token of type `types[arg]` and push it
+OP_CALL = 1         # Save the return address and jump to `arg`
+OP_RET = 2          # Return to the last saved address or finish when there is none
+OP_SWITCH = 3       # Jump according to the type of the next token using `switches[arg]`
+OP_JUMP = 4         # Jump to `arg`
+OP_NONE = 5         # Push `None`
+OP_TUPLE = 6        # Pop `arg` values and push them as a tuple
+OP_LIST = 7         # Push an empty list
+OP_APPEND = 8       # Pop a value and append it to the list on top of the stack
+OP_PUNCT = 9        # Push an empty `Punctuated`
+OP_PUNCT_APPEND = 10 # Pop a separator and an element and append them to the `Punctuated` on top of the stack
+OP_PUNCT_FINAL = 11 # Pop an element and append it without separator to the `Punctuated` on top of the stack
+OP_MIN = 12         # Fail if the collection on top of the stack holds less than `arg` elements
+OP_NODE = 13        # Pop the fields of `nodes[arg]` and push a node that is created with its trusted constructor
+OP_POP = 14         # Discard the value on top of the stack
+
+
+class TableParser:
+    """
+    Interpreter for the parse tables that are generated for LL(1) grammars.
+
+    `code` is a flat list of instructions. `types` holds the token classes
+    that `OP_TOKEN` refers to. Each row in `switches` starts with the address
+    to jump to when no token matched, followed by pairs of a token class and
+    the address to jump to when the next token is of that class. Each row in
+    `nodes` holds a node class followed by the names of its fields.
+
+    The interpreter does not recurse and never backtracks, so no streams
+    need to be forked except for one fork per call to `parse()`.
+    """
+
+    def __init__(self, code: list[int], types: list[type], switches: list[list[Any]], nodes: list[list[Any]]) -> None:
+        self._code = code
+        self._types = types
+        self._switches = list((row[0], dict(zip(row[1::2], row[2::2]))) for row in switches)
+        self._nodes = list((row[0], tuple(row[1:])) for row in nodes)
+
+    def parse(self, stream: ParseStream, pc: int, interner: Interner | None = None) -> Any:
+        """
+        Run the program starting at address `pc` and return the resulting value.
+
+        Returns `None` when the tokens did not match. The stream is only
+        advanced when parsing succeeded.
+
+        When `interner` is given, every token and node is interned as soon as
+        it is created, so equal subtrees are only stored once.
+        """
+        code = self._code
+        types = self._types
+        switches = self._switches
+        nodes = self._nodes
+        forked = stream.fork()
+        values = list[Any]()
+        frames = list[int]()
+        while True:
+            op = code[pc]
+            arg = code[pc+1]
+            pc += 2
+            if op == OP_TOKEN:
+                if type(forked.peek()) is not types[arg]:
+                    return None
+                token = forked.get()
+                if interner is not None:
+                    token = interner.intern(token)
+                values.append(token)
+            elif op == OP_SWITCH:
+                default, targets = switches[arg]
+                pc = targets.get(type(forked.peek()), default)
+                if pc < 0:
+                    return None
+            elif op == OP_CALL:
+                frames.append(pc)
+                pc = arg
+            elif op == OP_RET:
+                if not frames:
+                    break
+                pc = frames.pop()
+            elif op == OP_JUMP:
+                pc = arg
+            elif op == OP_NODE:
+                cls, names = nodes[arg]
+                n = len(names)
+                if n == 0:
+                    node = cls._make()
+                else:
+                    fields = values[-n:]
+                    del values[-n:]
+                    node = cls._make(**dict(zip(names, fields)))
+                if interner is not None:
+                    node = interner.intern(node)
+                values.append(node)
+            elif op == OP_APPEND:
+                value = values.pop()
+                values[-1].append(value)
+            elif op == OP_POP:
+                values.pop()
+            elif op == OP_NONE:
+                values.append(None)
+            elif op == OP_TUPLE:
+                if arg == 0:
+                    values.append(())
+                else:
+                    elements = tuple(values[-arg:])
+                    del values[-arg:]
+                    values.append(elements)
+            elif op == OP_LIST:
+                values.append([])
+            elif op == OP_PUNCT:
+                values.append(Punctuated())
+            elif op == OP_PUNCT_APPEND:
+                separator = values.pop()
+                element = values.pop()
+                values[-1].append(element, separator)
+            elif op == OP_PUNCT_FINAL:
+                element = values.pop()
+                values[-1].append_final(element)
+            elif op == OP_MIN:
+                if len(values[-1]) < arg:
+                    return None
+            else:
+                raise RuntimeError(f'invalid opcode {op} at address {pc-2}')
+        stream.join_to(forked)
+        return values.pop()
+
+## -- Designed for caching parsed trees on disk
+
+# Every value in a dump starts with one of these tags
+_TAG_NONE = 0
+_TAG_NODE = 1
+_TAG_TOKEN = 2
+_TAG_LIST = 3
+_TAG_TUPLE = 4
+_TAG_PUNCT = 5
+_TAG_STR = 6
+_TAG_INT = 7
+_TAG_FLOAT = 8
+_TAG_TRUE = 9
+_TAG_FALSE = 10
+_TAG_ENUM = 11
+
+_DUMP_MAGIC = b'MAGE\x01'
+
+_float_struct = struct.Struct('<d')
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_bytes(out: bytearray, data: bytes) -> None:
+    _write_varint(out, len(data))
+    out += data
+
+
+def _zigzag(value: int) -> int:
+    # Zig-zag encoding keeps small negative numbers small
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def _unzigzag(n: int) -> int:
+    return (n >> 1) if not (n & 1) else -((n + 1) >> 1)
+
+
+class SyntaxSerializer:
+    """
+    Writes trees to a compact binary format and reads them back without parsing.
+
+    A dump starts with a table of the names of all node and token classes
+    that occur in the tree, followed by a table of all distinct strings.
+    The tree itself is written in pre-order and refers to these tables by
+    index. Integers are written as variable-length integers, so most spans
+    only take a few bytes.
+
+    `nodes`, `static_tokens` and `value_tokens` list the classes that may
+    occur in a tree, and `enums` the integer enumerations that fields may
+    hold. Dumps can only be loaded by a serializer that knows about every
+    class in the dump.
+
+    Both directions use an explicit stack, so trees of any depth can be
+    written and read.
+    """
+
+    def __init__(self, nodes: Iterable[type], static_tokens: Iterable[type], value_tokens: Iterable[type], enums: Iterable[type] = ()) -> None:
+        self._nodes = set(nodes)
+        self._static_tokens = set(static_tokens)
+        self._value_tokens = set(value_tokens)
+        self._enums = set(enums)
+        self._by_name = dict[str, type]()
+        for cls in (*self._nodes, *self._static_tokens, *self._value_tokens, *self._enums):
+            self._by_name[cls.__name__] = cls
+
+    def dump(self, node: BaseSyntax, fp: IO[bytes]) -> None:
+        """
+        Write `node` and everything below it to the binary file `fp`.
+        """
+
+        kinds = dict[type, int]()
+        strings = dict[str, int]()
+        body = bytearray()
+        nodes = self._nodes
+        value_tokens = self._value_tokens
+        static_tokens = self._static_tokens
+        enums = self._enums
+
+        def get_kind(cls: type) -> int:
+            index = kinds.get(cls)
+            if index is None:
+                index = len(kinds)
+                kinds[cls] = index
+            return index
+
+        # Values are written in pre-order, so children are pushed in reverse
+        stack: list[Any] = [ node ]
+        while stack:
+            value = stack.pop()
+            if value is None:
+                body.append(_TAG_NONE)
+                continue
+            cls = type(value)
+            if cls in nodes:
+                body.append(_TAG_NODE)
+                _write_varint(body, get_kind(cls))
+                for name in reversed(cls._field_names):
+                    stack.append(getattr(value, name))
+            elif cls in value_tokens or cls in static_tokens:
+                body.append(_TAG_TOKEN)
+                _write_varint(body, get_kind(cls))
+                start_offset = value.start_offset
+                if start_offset < 0:
+                    _write_varint(body, 0)
+                else:
+                    _write_varint(body, start_offset + 1)
+                    _write_varint(body, value.end_offset - start_offset)
+                if cls in value_tokens:
+                    stack.append(value.value)
+            elif cls is list or cls is tuple:
+                body.append(_TAG_LIST if cls is list else _TAG_TUPLE)
+                _write_varint(body, len(value))
+                stack.extend(reversed(value))
+            elif cls is Punctuated:
+                body.append(_TAG_PUNCT)
+                _write_varint(body, len(value._elements))
+                _write_varint(body, len(value._separators))
+                stack.extend(reversed(value._separators))
+                stack.extend(reversed(value._elements))
+            elif cls is str:
+                index = strings.get(value)
+                if index is None:
+                    index = len(strings)
+                    strings[value] = index
+                body.append(_TAG_STR)
+                _write_varint(body, index)
+            elif cls is bool:
+                body.append(_TAG_TRUE if value else _TAG_FALSE)
+            elif cls is int:
+                body.append(_TAG_INT)
+                _write_varint(body, _zigzag(value))
+            elif cls is float:
+                body.append(_TAG_FLOAT)
+                body.extend(_float_struct.pack(value))
+            elif cls in enums:
+                body.append(_TAG_ENUM)
+                _write_varint(body, get_kind(cls))
+                _write_varint(body, _zigzag(int(value)))
+            else:
+                raise ValueError(f'cannot serialize a value of type {cls.__name__}')
+
+        header = bytearray(_DUMP_MAGIC)
+        _write_varint(header, len(kinds))
+        for cls in kinds:
+            _write_bytes(header, cls.__name__.encode('utf-8'))
+        _write_varint(header, len(strings))
+        for text in strings:
+            _write_bytes(header, text.encode('utf-8'))
+
+        fp.write(header)
+        fp.write(body)
+
+    def load(self, fp: IO[bytes]) -> BaseSyntax:
+        """
+        Read a tree that was written with `dump()` from the binary file `fp`.
+        """
+
+        data = fp.read()
+        if data[:len(_DUMP_MAGIC)] != _DUMP_MAGIC:
+            raise ValueError('not a dump of a syntax tree or written by an incompatible version')
+        offset = len(_DUMP_MAGIC)
+
+        def read_varint() -> int:
+            nonlocal offset
+            result = 0
+            shift = 0
+            while True:
+                byte = data[offset]
+                offset += 1
+                result |= (byte & 0x7F) << shift
+                if byte < 0x80:
+                    return result
+                shift += 7
+
+        def read_text() -> str:
+            nonlocal offset
+            n = read_varint()
+            text = data[offset:offset+n].decode('utf-8')
+            offset += n
+            return text
+
+        kinds = list[type]()
+        for _ in range(read_varint()):
+            name = read_text()
+            cls = self._by_name.get(name)
+            if cls is None:
+                raise ValueError(f"dump contains unknown class '{name}'")
+            kinds.append(cls)
+
+        strings = list(read_text() for _ in range(read_varint()))
+
+        value_tokens = self._value_tokens
+
+        # Each frame is a value that is still missing some of its children.
+        # It holds the tag, extra data needed to build the value, the number
+        # of children and the children that were read so far.
+        frames = list[tuple[int, Any, int, list[Any]]]()
+
+        while True:
+
+            tag = data[offset]
+            offset += 1
+
+            if tag == _TAG_NONE:
+                value = None
+            elif tag == _TAG_NODE:
+                cls = kinds[read_varint()]
+                n = len(cls._field_names)
+                if n > 0:
+                    frames.append((tag, cls, n, []))
+                    continue
+                value = cls._make()
+            elif tag == _TAG_TOKEN:
+                cls = kinds[read_varint()]
+                start = read_varint()
+                span = None
+                if start > 0:
+                    start -= 1
+                    span = Span(start, start + read_varint())
+                if cls in value_tokens:
+                    frames.append((tag, (cls, span), 1, []))
+                    continue
+                value = cls(span=span)
+            elif tag == _TAG_LIST or tag == _TAG_TUPLE:
+                n = read_varint()
+                if n > 0:
+                    frames.append((tag, None, n, []))
+                    continue
+                value = [] if tag == _TAG_LIST else ()
+            elif tag == _TAG_PUNCT:
+                element_count = read_varint()
+                n = element_count + read_varint()
+                if n > 0:
+                    frames.append((tag, element_count, n, []))
+                    continue
+                value = Punctuated()
+            elif tag == _TAG_STR:
+                value = strings[read_varint()]
+            elif tag == _TAG_INT:
+                value = _unzigzag(read_varint())
+            elif tag == _TAG_FLOAT:
+                value, = _float_struct.unpack_from(data, offset)
+                offset += _float_struct.size
+            elif tag == _TAG_TRUE:
+                value = True
+            elif tag == _TAG_FALSE:
+                value = False
+            elif tag == _TAG_ENUM:
+                cls = kinds[read_varint()]
+                value = cls(_unzigzag(read_varint()))
+            else:
+                raise ValueError(f'invalid tag {tag} at offset {offset-1}')
+
+            # Hand the value to its parent and finish every parent that is now complete
+            while frames:
+                tag, extra, n, children = frames[-1]
+                children.append(value)
+                if len(children) < n:
+                    break
+                frames.pop()
+                if tag == _TAG_NODE:
+                    value = extra._make(*children)
+                elif tag == _TAG_TOKEN:
+                    cls, span = extra
+                    value = cls(children[0], span=span)
+                elif tag == _TAG_LIST:
+                    value = children
+                elif tag == _TAG_TUPLE:
+                    value = tuple(children)
+                else:
+                    value = Punctuated.from_lists(children[:extra], children[extra:])
+            else:
+                return value
+
+
+## -- Designed for red/green trees
+
+type GreenElement = GreenNode | GreenToken
+
+# What a green node stores for a single field: an element, a tuple of entries
+# for lists, tuples and punctuated sequences, or a plain value such as `None`
+type GreenEntry = GreenElement | tuple[GreenEntry, ...] | Any
+
+
+class GreenToken:
+    """
+    An immutable token that only knows its kind, its text and the trivia in front of it.
+
+    `kind` is the facade class that is used to expose this token. The width
+    of a token includes its leading trivia, so that the widths of all
+    tokens add up to the length of the source text.
+    """
+
+    __slots__ = ('kind', 'text', 'leading', 'width')
+
+    def __init__(self, kind: type, text: str, leading: str = '') -> None:
+        self.kind = kind
+        self.text = text
+        self.leading = leading
+        self.width = len(leading) + len(text)
+
+
+class GreenNode:
+    """
+    An immutable node that only knows its kind, its width and its children.
+
+    Green nodes do not know their position nor their parent, so identical
+    subtrees can be shared, even across different versions of a document.
+
+    `kind` is the facade class that is used to expose this node. `children`
+    holds one entry per field.
+    """
+
+    __slots__ = ('kind', 'children', 'width')
+
+    def __init__(self, kind: type, children: tuple[GreenEntry, ...]) -> None:
+        self.kind = kind
+        self.children = children
+        self.width = _get_green_width(children)
+
+
+def _get_green_width(entry: GreenEntry) -> int:
+    if isinstance(entry, GreenNode) or isinstance(entry, GreenToken):
+        return entry.width
+    if isinstance(entry, tuple):
+        return sum(_get_green_width(element) for element in entry)
+    return 0
+
+
+def _get_leading_width(entry: GreenEntry) -> int:
+    """
+    Get the width of the trivia in front of the first token inside `entry`.
+    """
+    while True:
+        if isinstance(entry, GreenToken):
+            return len(entry.leading)
+        if isinstance(entry, GreenNode):
+            entries = entry.children
+        elif isinstance(entry, tuple):
+            entries = entry
+        else:
+            return 0
+        for child in entries:
+            if _get_green_width(child) > 0:
+                entry = child
+                break
+        else:
+            return 0
+
+
+class GreenInterner:
+    """
+    Makes sure that there is only one green element for each distinct kind and contents.
+
+    Children are interned before their parents, so comparing them by
+    identity is enough to find out whether two subtrees are equal.
+    """
+
+    def __init__(self) -> None:
+        self._tokens = dict[tuple[type, str, str], GreenToken]()
+        self._nodes = dict[tuple[type, tuple[GreenEntry, ...]], GreenNode]()
+
+    def token(self, kind: type, text: str, leading: str = '') -> GreenToken:
+        key = (kind, text, leading)
+        token = self._tokens.get(key)
+        if token is None:
+            token = GreenToken(kind, text, leading)
+            self._tokens[key] = token
+        return token
+
+    def node(self, kind: type, children: tuple[GreenEntry, ...]) -> GreenNode:
+        key = (kind, children)
+        node = self._nodes.get(key)
+        if node is None:
+            node = GreenNode(kind, children)
+            self._nodes[key] = node
+        return node
+
+
+class GreenBuilder:
+    """
+    Converts a tree made out of regular nodes and tokens into a green tree.
+
+    Each row in `kinds` holds the class of a regular node or token, the
+    facade class that should be used as its kind, and, for nodes, the names
+    of the fields in the order they should be stored.
+
+    The text of a token and the trivia in front of it are taken from
+    `trivia` when the token was recorded there by the lexer. Otherwise,
+    `get_text` should return the text of the token, for example by emitting
+    it, and the token gets no trivia.
+
+    A builder can be given to a generated parser as its interner. Each node
+    is then turned into a green node as soon as it has been parsed, so the
+    regular tree is never built as a whole.
+    """
+
+    def __init__(self, kinds: list[list[Any]], trivia: 'TriviaTable | None' = None, get_text: Callable[[Any], str] | None = None, interner: GreenInterner | None = None) -> None:
+        self._kinds = dict((row[0], (row[1], tuple(row[2:]))) for row in kinds)
+        self._trivia = trivia
+        self._get_text = get_text
+        self._interner = interner if interner is not None else GreenInterner()
+
+    def intern(self, value: Any) -> Any:
+        """
+        Convert a node whose children may already be green into a green node.
+        """
+        return self.build(value) if isinstance(value, BaseSyntax) else value
+
+    def build(self, value: BaseSyntax) -> GreenElement:
+        kind, field_names = self._kinds[type(value)]
+        if issubclass(kind, RedToken):
+            return self._build_token(kind, value)
+        return self._interner.node(kind, tuple(self._build_entry(getattr(value, name)) for name in field_names))
+
+    def _build_token(self, kind: type, token: Any) -> GreenToken:
+        trivia = self._trivia
+        if trivia is not None:
+            i = trivia.index_of(token)
+            if i >= 0:
+                return self._interner.token(kind, trivia.text[token.start_offset:token.end_offset], trivia.leading_trivia(i))
+        if self._get_text is None:
+            raise ValueError(f'no text is known for token {token!r}')
+        return self._interner.token(kind, self._get_text(token))
+
+    def _build_entry(self, value: Any) -> GreenEntry:
+        if isinstance(value, BaseSyntax):
+            return self.build(value)
+        if isinstance(value, Punctuated):
+            return tuple((self._build_entry(element), self._build_entry(separator)) for element, separator in value)
+        if isinstance(value, list) or isinstance(value, tuple):
+            return tuple(self._build_entry(element) for element in value)
+        return value
+
+
+class RedSyntax:
+    """
+    A thin facade over a green element that knows its parent and absolute offset.
+
+    Facades are created on demand while the tree is traversed and may be
+    thrown away at any time.
+    """
+
+    __slots__ = ('green', '_parent', 'offset')
+
+    def __init__(self, green: Any, parent: 'RedNode | None' = None, offset: int = 0) -> None:
+        self.green = green
+        self._parent = parent
+        self.offset = offset
+
+    @property
+    def start_offset(self) -> int:
+        """
+        The offset of the first character after the leading trivia.
+        """
+        return self.offset + _get_leading_width(self.green)
+
+    @property
+    def end_offset(self) -> int:
+        return self.offset + self.green.width
+
+    def has_parent(self) -> bool:
+        return self._parent is not None
+
+    def parent(self) -> 'RedNode':
+        assert(self._parent is not None)
+        return self._parent
+
+
+class RedToken(RedSyntax):
+
+    __slots__ = ()
+
+    @property
+    def text(self) -> str:
+        return self.green.text
+
+    @property
+    def leading_trivia(self) -> str:
+        return self.green.leading
+
+
+class RedNode(RedSyntax):
+
+    __slots__ = ('_fields',)
+
+    def __init__(self, green: GreenNode, parent: 'RedNode | None' = None, offset: int = 0) -> None:
+        super().__init__(green, parent, offset)
+        self._fields: list[Any] | None = None
+
+    def _get_field(self, index: int) -> Any:
+        """
+        Get the facade of the field at the given index, creating all facades of this node when needed.
+        """
+        fields = self._fields
+        if fields is None:
+            fields = []
+            offset = self.offset
+            for entry in self.green.children:
+                fields.append(self._to_red(entry, offset))
+                offset += _get_green_width(entry)
+            self._fields = fields
+        return fields[index]
+
+    def _get_punct_field(self, index: int) -> 'Punctuated[Any, Any]':
+        return Punctuated(self._get_field(index))
+
+    def _to_red(self, entry: GreenEntry, offset: int) -> Any:
+        if isinstance(entry, GreenNode) or isinstance(entry, GreenToken):
+            return entry.kind(entry, self, offset)
+        if isinstance(entry, tuple):
+            elements = []
+            for element in entry:
+                elements.append(self._to_red(element, offset))
+                offset += _get_green_width(element)
+            return tuple(elements)
+        return entry
+
+
+def to_red(green: GreenElement) -> Any:
+    """
+    Create the facade of the root of a green tree.
+    """
+    return green.kind(green, None, 0)
+
+
 ## -- Designed for the emitter
 
-type Doc = ConsDoc | EmptyDoc | TextDoc
+# Documents are laid out with the algorithm from Wadler's "A prettier printer",
+# in the strict variant by Lindig: a group is printed on a single line if its
+# flat contents fit in the remaining width, and is broken up otherwise.
+
+type Doc = ConsDoc | EmptyDoc | TextDoc | LineDoc | NestDoc | GroupDoc
 
 @dataclass
 class DocBase:
@@ -305,6 +1827,34 @@ class TextDoc(DocBase):
     text: str
 
 
+@dataclass
+class LineDoc(DocBase):
+    """
+    A line break, which is replaced with `flat` when its group fits on one line.
+
+    A hard line break is never replaced.
+    """
+    flat: str
+    hard: bool = False
+
+
+@dataclass
+class NestDoc(DocBase):
+    """
+    Indents every line break inside `doc` by another `indent` spaces.
+    """
+    indent: int
+    doc: Doc
+
+
+@dataclass
+class GroupDoc(DocBase):
+    """
+    Lays out `doc` on a single line if it fits, and breaks all of its line breaks otherwise.
+    """
+    doc: Doc
+
+
 def empty() -> Doc:
     return EmptyDoc()
 
@@ -318,11 +1868,127 @@ def seq(elements: Sequence[Doc]) -> Doc:
 def text(contents: str) -> TextDoc:
     return TextDoc(contents)
 
-def generate(doc: Doc) -> str:
-    if isinstance(doc, EmptyDoc):
-        return ''
-    if isinstance(doc, ConsDoc):
-        return generate(doc.head) + generate(doc.tail)
-    if isinstance(doc, TextDoc):
-        return doc.text
-    assert_never(doc)
+def line() -> LineDoc:
+    """
+    A line break that becomes a space when it is not needed.
+    """
+    return LineDoc(' ')
+
+def softline() -> LineDoc:
+    """
+    A line break that disappears when it is not needed.
+    """
+    return LineDoc('')
+
+def hardline() -> LineDoc:
+    return LineDoc('', hard=True)
+
+def nest(indent: int, doc: Doc) -> NestDoc:
+    return NestDoc(indent, doc)
+
+def group(doc: Doc) -> GroupDoc:
+    return GroupDoc(doc)
+
+
+# Wider than any line, so that a group with a hard line break never fits
+_INFINITE_WIDTH = sys.maxsize // 2
+
+def _measure_flat(root: Doc, widths: dict[int, int]) -> int:
+    """
+    Compute the width of `root` when laid out on a single line.
+
+    The width of every group that is encountered is stored in `widths`, so
+    that each part of a document is measured only once.
+    """
+    stack: list[tuple[Doc, bool]] = [ (root, False) ]
+    results = list[int]()
+    while stack:
+        doc, expanded = stack.pop()
+        if isinstance(doc, TextDoc):
+            results.append(len(doc.text))
+        elif isinstance(doc, EmptyDoc):
+            results.append(0)
+        elif isinstance(doc, LineDoc):
+            results.append(_INFINITE_WIDTH if doc.hard else len(doc.flat))
+        elif isinstance(doc, ConsDoc):
+            if expanded:
+                tail = results.pop()
+                head = results.pop()
+                results.append(min(head + tail, _INFINITE_WIDTH))
+            else:
+                stack.append((doc, True))
+                stack.append((doc.tail, False))
+                stack.append((doc.head, False))
+        elif isinstance(doc, NestDoc):
+            stack.append((doc.doc, False))
+        elif isinstance(doc, GroupDoc):
+            width = widths.get(id(doc))
+            if width is not None:
+                results.append(width)
+            elif expanded:
+                widths[id(doc)] = results[-1]
+            else:
+                stack.append((doc, True))
+                stack.append((doc.doc, False))
+        else:
+            assert_never(doc)
+    return results[-1]
+
+def render(doc: Doc, out: TextIO | list[str], width: int = 80) -> None:
+    """
+    Lay out `doc` within `width` columns and write the result to `out`.
+
+    `out` is either a file-like object or a list that receives the chunks of
+    text. The document is rendered without recursion, and every group is
+    measured only once, so the cost is linear in the size of the document.
+    """
+    write = out.append if isinstance(out, list) else out.write
+    widths = dict[int, int]()
+    column = 0
+    # Indentation is only written when text follows, so that blank lines stay empty
+    pending_indent = 0
+    stack: list[tuple[int, bool, Doc]] = [ (0, False, doc) ]
+    while stack:
+        indent, flat, doc = stack.pop()
+        if isinstance(doc, TextDoc):
+            if not doc.text:
+                continue
+            if pending_indent:
+                write(' ' * pending_indent)
+                pending_indent = 0
+            write(doc.text)
+            i = doc.text.rfind('\n')
+            column = column + len(doc.text) if i < 0 else len(doc.text) - i - 1
+        elif isinstance(doc, EmptyDoc):
+            pass
+        elif isinstance(doc, ConsDoc):
+            stack.append((indent, flat, doc.tail))
+            stack.append((indent, flat, doc.head))
+        elif isinstance(doc, LineDoc):
+            if flat and not doc.hard:
+                if doc.flat:
+                    if pending_indent:
+                        write(' ' * pending_indent)
+                        pending_indent = 0
+                    write(doc.flat)
+                    column += len(doc.flat)
+            else:
+                write('\n')
+                pending_indent = indent
+                column = indent
+        elif isinstance(doc, NestDoc):
+            stack.append((indent + doc.indent, flat, doc.doc))
+        elif isinstance(doc, GroupDoc):
+            if not flat:
+                group_width = widths.get(id(doc))
+                if group_width is None:
+                    group_width = _measure_flat(doc, widths)
+                flat = column + group_width <= width
+            stack.append((indent, flat, doc.doc))
+        else:
+            assert_never(doc)
+
+def generate(doc: Doc, width: int = 80) -> str:
+    chunks = list[str]()
+    render(doc, chunks, width)
+    return ''.join(chunks)
@@ -0,0 +1,130 @@
+from dataclasses import dataclass
+from typing import Sequence
+
+from magelang.lang.python.cst import *
+from magelang.passes.mage_to_python_parser import count_lines
+
+
+@dataclass
+class CodeStats:
+    """
+    Measurements of a piece of generated code.
+
+    Backtracking points are places where the generated code saves a position
+    it may have to return to: a forked parse stream or a saved lexer offset.
+    """
+    name: str
+    stmts: int = 0
+    max_depth: int = 0
+    forks: int = 0
+    joins: int = 0
+    backtracks: int = 0
+
+
+def _lift_body(body: PyStmt | list[PyStmt]) -> list[PyStmt]:
+    return body if isinstance(body, list) else [ body ]
+
+
+def _get_method_name(expr: PyExpr | None) -> str | None:
+    if isinstance(expr, PyCallExpr) and isinstance(expr.operator, PyAttrExpr):
+        return expr.operator.name.value
+    return None
+
+
+def _get_assigned_names(stmt: PyStmt) -> tuple[str, str] | None:
+    if isinstance(stmt, PyAssignStmt) \
+            and isinstance(stmt.pattern, PyNamedPattern) \
+            and stmt.value is not None \
+            and isinstance(stmt.value[1], PyNamedExpr):
+        return stmt.pattern.name.value, stmt.value[1].name.value
+    return None
+
+
+def _is_save(stmt: PyStmt) -> bool:
+    names = _get_assigned_names(stmt)
+    return names is not None and names[0].startswith('keep')
+
+
+def _is_restore(stmt: PyStmt) -> bool:
+    names = _get_assigned_names(stmt)
+    return names is not None and names[1].startswith('keep')
+
+
+def collect_code_stats(name: str, body: Sequence[PyStmt]) -> CodeStats:
+    """
+    Measure the given statements, including the ones nested inside them.
+    """
+    stats = CodeStats(name, stmts=count_lines(body))
+    stack = list((stmt, 1) for stmt in body)
+    while stack:
+        stmt, depth = stack.pop()
+        stats.max_depth = max(stats.max_depth, depth)
+        if isinstance(stmt, PyAssignStmt):
+            method_name = _get_method_name(stmt.value[1] if stmt.value is not None else None)
+        elif isinstance(stmt, PyExprStmt):
+            method_name = _get_method_name(stmt.expr)
+        else:
+            method_name = None
+        if method_name == 'fork':
+            stats.forks += 1
+            stats.backtracks += 1
+        elif method_name == 'join_to':
+            stats.joins += 1
+        elif _is_restore(stmt):
+            stats.backtracks += 1
+        for_each_py_stmt(stmt, lambda child: stack.append((child, depth + 1)))
+    return stats
+
+
+def _get_token_name(stmts: Sequence[PyStmt]) -> str | None:
+    name = None
+    stack = list(reversed(stmts))
+    while stack:
+        stmt = stack.pop()
+        if isinstance(stmt, PyRetStmt) and stmt.expr is not None:
+            expr = stmt.expr
+            # Tokens may be wrapped in a call to `self._record()`
+            if _get_method_name(expr) == '_record':
+                assert(isinstance(expr, PyCallExpr))
+                expr = expr.args[0][0]
+            if isinstance(expr, PyCallExpr) and isinstance(expr.operator, PyNamedExpr):
+                name = expr.operator.name.value
+        children = list[PyStmt]()
+        for_each_py_stmt(stmt, children.append)
+        stack.extend(reversed(children))
+    return name
+
+
+def collect_module_stats(module: PyModule) -> list[CodeStats]:
+    """
+    Measure each top-level function of a generated parser or lexer.
+
+    The body of `lex()` contains the code of every token. It is split up
+    where the generated lexer saves and restores its offset, so that each
+    token is measured separately.
+    """
+    out = list[CodeStats]()
+    for stmt in module.stmts:
+        if isinstance(stmt, PyFuncDef):
+            out.append(collect_code_stats(stmt.name.value, _lift_body(stmt.body)))
+        elif isinstance(stmt, PyClassDef):
+            for element in _lift_body(stmt.body):
+                if not isinstance(element, PyFuncDef):
+                    continue
+                if element.name.value != 'lex':
+                    out.append(collect_code_stats(f'{stmt.name.value}.{element.name.value}', _lift_body(element.body)))
+                    continue
+                segment = list[PyStmt]()
+                rest = list[PyStmt]()
+                for child in _lift_body(element.body):
+                    if _is_save(child):
+                        segment = [ child ]
+                    elif segment:
+                        segment.append(child)
+                        if _is_restore(child):
+                            out.append(collect_code_stats(_get_token_name(segment) or 'lex', segment))
+                            segment = []
+                    else:
+                        rest.append(child)
+                out.append(collect_code_stats('lex', rest + segment))
+    return out
@@ -1,5 +1,5 @@
 
-from magelang.analysis import get_lexer_modes, envelops, is_subset
+from magelang.analysis import analyse_ll1, get_lexer_modes, envelops, is_subset
 from magelang.lang.mage.ast import *
 
 
@@ -97,3 +97,53 @@ def test_overlapping_tokens_str_repeat_charset():
     assert(modes['bar'] == modes['foo'])
     assert(modes['bar'] == modes['bla'])
     assert(modes['bar'] != modes['bax'])
+
+
+def _make_ll1_grammar(*rules: MageRule) -> MageGrammar:
+    grammar = MageGrammar(elements=[
+        MageRule('ident', MageRepeatExpr(MageCharSetExpr([ ('a', 'z') ]), 1, POSINF), flags=PUBLIC | FORCE_TOKEN),
+        MageRule('comma', MageLitExpr(','), flags=PUBLIC | FORCE_TOKEN),
+        MageRule('semi', MageLitExpr(';'), flags=PUBLIC | FORCE_TOKEN),
+        *rules,
+    ])
+    set_parents(grammar)
+    return grammar
+
+
+def test_analyse_ll1_list():
+    grammar = _make_ll1_grammar(
+        MageRule('names', MageSeqExpr([ MageListExpr(MageRefExpr('ident'), MageRefExpr('comma'), 0), MageRefExpr('semi') ]), flags=PUBLIC),
+    )
+    analysis = analyse_ll1(grammar)
+    assert(analysis.is_ll1)
+    names = nonnull(grammar.lookup('names'))
+    assert(analysis.first(nonnull(names.expr)) == { 'ident', 'semi' })
+    assert(not analysis.nullable(nonnull(names.expr)))
+
+
+def test_analyse_ll1_choice_conflict():
+    grammar = _make_ll1_grammar(
+        MageRule('a', MageSeqExpr([ MageRefExpr('ident'), MageRefExpr('comma') ]), flags=PUBLIC),
+        MageRule('b', MageSeqExpr([ MageRefExpr('ident'), MageRefExpr('semi') ]), flags=PUBLIC),
+        MageRule('c', MageChoiceExpr([ MageRefExpr('a'), MageRefExpr('b') ]), flags=PUBLIC),
+    )
+    analysis = analyse_ll1(grammar)
+    assert(not analysis.is_ll1)
+    assert(len(analysis.conflicts) == 1)
+    assert(analysis.conflicts[0].rule.name == 'c')
+
+
+def test_analyse_ll1_repeat_follow_conflict():
+    grammar = _make_ll1_grammar(
+        MageRule('a', MageSeqExpr([ MageRepeatExpr(MageRefExpr('ident'), 0, 1), MageRefExpr('ident') ]), flags=PUBLIC),
+    )
+    analysis = analyse_ll1(grammar)
+    assert(not analysis.is_ll1)
+
+
+def test_analyse_ll1_left_recursion():
+    grammar = _make_ll1_grammar(
+        MageRule('a', MageSeqExpr([ MageRefExpr('a'), MageRefExpr('comma') ]), flags=PUBLIC),
+    )
+    analysis = analyse_ll1(grammar)
+    assert(any(conflict.message == 'rule is left-recursive' for conflict in analysis.conflicts))
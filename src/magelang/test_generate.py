@@ -0,0 +1,455 @@
+import importlib
+import io
+import sys
+from pathlib import Path
+from types import ModuleType
+from typing import Any
+
+import pytest
+
+from magelang import generate_files, write_files
+from magelang.main import generate
+from magelang.runtime import GreenInterner, GreenNode, ParentMap, ParseStream, Punctuated, Span, SyntaxInterner, clear_cached_offsets, to_red
+
+
+_grammar = """
+@skip
+__ = [\\n\\r\\t ]*
+
+pub token integer -> Integer
+  = [0-9]+
+
+pub token ident
+  = [a-z]+
+
+pub call_expr
+  = name:ident '(' args:(expr % ',') ')'
+
+pub list_expr
+  = '[' elements:(expr %% ',') ']'
+
+pub lit_expr
+  = integer
+
+pub ref_expr
+  = ident '!'?
+
+pub expr
+  = call_expr
+  | list_expr
+  | lit_expr
+
+pub module
+  = exprs:(expr ';')*
+"""
+
+
+def _generate(tmp_path: Path, grammar: str = _grammar, name: str = 'gen', **opts: Any) -> str:
+    """
+    Generate Python code for `grammar` into a new package and return the name of that package.
+    """
+    package_name = f'{tmp_path.name}_{name}'
+    grammar_path = tmp_path / f'{name}.mage'
+    grammar_path.write_text(grammar)
+    files = generate_files(grammar_path, 'python', prefix='ll', silent=True, **opts)
+    assert(isinstance(files, dict))
+    write_files(files, tmp_path / package_name)
+    if str(tmp_path) not in sys.path:
+        sys.path.insert(0, str(tmp_path))
+    return package_name
+
+
+def _load(package_name: str, module_name: str) -> ModuleType:
+    return importlib.import_module(f'{package_name}.{module_name}')
+
+
+def _lex(lexer: ModuleType, text: str) -> list[Any]:
+    scanner = lexer.LlLexer(text)
+    tokens = []
+    while not scanner.at_eof():
+        tokens.append(scanner.lex())
+    return tokens
+
+
+def test_slots(tmp_path: Path):
+    cst = _load(_generate(tmp_path), 'cst')
+    node = cst.LlLitExpr(cst.LlInteger(1))
+    assert(not hasattr(node, '__dict__'))
+    assert(not hasattr(node.integer, '__dict__'))
+    pytest.raises(AttributeError, lambda: setattr(node, 'foo', 1))
+    cst = _load(_generate(tmp_path, name='no_slots', enable_slots=False), 'cst')
+    node = cst.LlLitExpr(cst.LlInteger(1))
+    node.foo = 1
+    assert(node.foo == 1)
+
+
+def test_fast_import(tmp_path: Path):
+    package_name = _generate(tmp_path, enable_fast_import=True)
+    cst = _load(package_name, 'cst')
+    assert(not any(name.endswith('DeriveKwargs') for name in vars(cst)))
+    assert('\nif TYPE_CHECKING:\n' in (tmp_path / package_name / 'cst.py').read_text())
+    args = [ cst.LlLitExpr(cst.LlInteger(1)) ]
+    call = cst.LlCallExpr('f', args=args)
+    derived = call.derive(name='g')
+    assert(type(derived) is cst.LlCallExpr)
+    assert(isinstance(derived.name, cst.LlIdent))
+    assert(derived.name.value == 'g')
+    assert(call.name.value == 'f')
+    assert(derived.args.elements == call.args.elements)
+    derived = call.derive(args=[ cst.LlLitExpr(cst.LlInteger(2)) ])
+    assert(isinstance(derived.args, Punctuated))
+    assert(derived.args.elements[0].integer.value == 2)
+    assert(derived.name is call.name)
+
+
+def test_shared_tokens(tmp_path: Path):
+    package_name = _generate(tmp_path, enable_shared_tokens=True, enable_trivia=True)
+    cst = _load(package_name, 'cst')
+    lexer = _load(package_name, 'lexer')
+    assert(cst.LlComma() is cst.LlComma())
+    assert(cst.LlComma().span is None)
+    token = cst.LlComma(Span(3, 4))
+    assert(token is not cst.LlComma())
+    assert(token.start_offset == 3 and token.end_offset == 4)
+    commas = list(token for token in _lex(lexer, 'f(1,2,3);') if isinstance(token, cst.LlComma))
+    assert(len(commas) == 2)
+    assert(commas[0] is not commas[1])
+    assert((commas[0].start_offset, commas[0].end_offset) == (3, 4))
+    assert((commas[1].start_offset, commas[1].end_offset) == (5, 6))
+    assert(cst.LlComma().span is None)
+
+
+def test_lazy_trivia(tmp_path: Path):
+    lexer = _load(_generate(tmp_path), 'lexer')
+    scanner = lexer.LlLexer('f(1);')
+    while not scanner.at_eof():
+        scanner.lex()
+    assert(scanner._trivia is None)
+    lexer = _load(_generate(tmp_path, name='trivia', enable_trivia=True), 'lexer')
+    scanner = lexer.LlLexer('f(1);')
+    while not scanner.at_eof():
+        scanner.lex()
+    assert(scanner._trivia is not None)
+    assert(scanner.trivia.leading_trivia(0) == '')
+
+
+
+@pytest.mark.parametrize('parser_backend', [ 'recursive', 'table' ])
+def test_red_green(tmp_path: Path, parser_backend: str):
+    package_name = _generate(tmp_path, name=parser_backend, parser_backend=parser_backend, enable_red_green=True, enable_trivia=True)
+    cst = _load(package_name, 'cst')
+    lexer = _load(package_name, 'lexer')
+    parser = _load(package_name, 'parser')
+    text = 'f(1, [ 2,3 ]);\n  g( );'
+    scanner = lexer.LlLexer(text)
+    tokens = []
+    while not scanner.at_eof():
+        tokens.append(scanner.lex())
+    interner = GreenInterner()
+    green = parser.parse_module(ParseStream(tokens, None), interner=cst.ll_green_builder(scanner.trivia, interner=interner))
+    assert(isinstance(green, GreenNode))
+    assert(green.width == len(text))
+    root = to_red(green)
+    f = root.exprs[0][0]
+    assert(isinstance(f, cst.LlCallExprRed))
+    assert(f.parent() is root)
+    assert(f.name.text == 'f')
+    assert((f.start_offset, f.end_offset) == (0, 13))
+    elements = f.args[1][0].elements
+    assert(elements[0][0].parent() is f.args[1][0])
+    assert(elements[1][0].integer.start_offset == text.index('3'))
+    g = root.exprs[1][0]
+    assert(g.name.leading_trivia == '\n  ')
+    assert(g.start_offset == text.index('g'))
+    assert(g.end_offset == len(text) - 1)
+    # Converting a regular tree afterwards results in the same green tree
+    regular = parser.parse_module(ParseStream(tokens, None))
+    assert(cst.ll_to_green(regular, scanner.trivia, interner=interner) is green)
+
+
+def test_visitor_subclass(tmp_path: Path):
+    cst = _load(_generate(tmp_path), 'cst')
+
+    class MyCallExpr(cst.LlCallExpr):
+        __slots__ = ()
+
+    class MyLitExpr(cst.LlLitExpr):
+        __slots__ = ()
+
+    args = [ cst.LlLitExpr(cst.LlInteger(1)), MyLitExpr(cst.LlInteger(2)) ]
+    visited = []
+    cst.for_each_ll_expr(MyCallExpr(cst.LlIdent('f'), args=args), visited.append)
+    assert(visited == args)
+    assert(cst._for_each_ll_expr_handlers[MyCallExpr] is cst._for_each_ll_expr_handlers[cst.LlCallExpr])
+    visited = []
+    cst.for_each_ll_expr(args[1], visited.append)
+    assert(visited == [])
+
+
+def test_rewriter_copy_on_write(tmp_path: Path):
+    cst = _load(_generate(tmp_path), 'cst')
+    one = cst.LlLitExpr(cst.LlInteger(1))
+    two = cst.LlLitExpr(cst.LlInteger(2))
+    inner = cst.LlListExpr(elements=[ two ])
+    call = cst.LlCallExpr(cst.LlIdent('f'), args=[ one, inner ])
+    # Nothing changed so no copy is made
+    assert(cst.rewrite_each_ll_expr(call, lambda node: node) is call)
+    assert(cst.rewrite_each_ll_expr(inner, lambda node: node) is inner)
+    assert(cst.rewrite_each_ll_expr(one, lambda node: cst.LlLitExpr(cst.LlInteger(3))) is one)
+    # Only the changed child is replaced
+    three = cst.LlLitExpr(cst.LlInteger(3))
+    new_call = cst.rewrite_each_ll_expr(call, lambda node: three if node is one else node)
+    assert(new_call is not call)
+    assert(list(new_call.args.elements) == [ three, inner ])
+    assert(new_call.args.elements[1] is inner)
+    assert(new_call.name is call.name)
+    assert(new_call.open_paren is call.open_paren)
+    assert(list(call.args.elements) == [ one, inner ])
+    assert(len(new_call.args.separators) == len(call.args.separators))
+
+
+def test_structural_eq(tmp_path: Path):
+    package_name = _generate(tmp_path, enable_structural_eq=True, enable_trivia=True)
+    cst = _load(package_name, 'cst')
+    lexer = _load(package_name, 'lexer')
+    parser = _load(package_name, 'parser')
+
+    def make_call(value: int) -> Any:
+        return cst.LlCallExpr(cst.LlIdent('f'), args=[ cst.LlLitExpr(cst.LlInteger(value)) ])
+
+    assert(make_call(1) == make_call(1))
+    assert(hash(make_call(1)) == hash(make_call(1)))
+    assert(make_call(1) != make_call(2))
+    assert(cst.LlLitExpr(cst.LlInteger(1)) != cst.LlRefExpr(cst.LlIdent('a')))
+    assert(cst.LlComma(Span(1, 2)) == cst.LlComma(Span(5, 6)))
+    assert(cst.LlInteger(1, Span(1, 2)) != cst.LlInteger(2, Span(1, 2)))
+
+    # Deep trees are compared and hashed without recursion
+    left = cst.LlLitExpr(cst.LlInteger(1))
+    right = cst.LlLitExpr(cst.LlInteger(1))
+    for _ in range(5000):
+        left = cst.LlListExpr(elements=[ left ])
+        right = cst.LlListExpr(elements=[ right ])
+    assert(hash(left) == hash(right))
+    assert(left == right)
+
+    # Tokens at different positions are shared unless their positions must be kept
+    tokens = _lex(lexer, 'f(1,1);')
+    module = parser.parse_module(ParseStream(tokens, None), interner=SyntaxInterner())
+    first, second = module.exprs[0][0].args.elements
+    assert(first is second)
+    assert(second.integer.start_offset == 2)
+    module = parser.parse_module(ParseStream(tokens, None), interner=SyntaxInterner(keep_positions=True))
+    first, second = module.exprs[0][0].args.elements
+    assert(first == second and first is not second)
+    assert(first.integer.start_offset == 2 and second.integer.start_offset == 4)
+
+
+def test_serializer(tmp_path: Path):
+    package_name = _generate(tmp_path, enable_serializer=True, enable_trivia=True)
+    cst = _load(package_name, 'cst')
+    lexer = _load(package_name, 'lexer')
+    parser = _load(package_name, 'parser')
+    module = parser.parse_module(ParseStream(_lex(lexer, 'f(1, [ 2 ]);'), None))
+    # The parser is recursive, so a deep tree is built by hand
+    deep = cst.LlListExpr(elements=[])
+    for _ in range(4999):
+        deep = cst.LlListExpr(elements=[ deep ])
+    module.exprs.append((deep, cst.LlSemicolon()))
+    buffer = io.BytesIO()
+    cst.ll_dump(module, buffer)
+    buffer.seek(0)
+    loaded = cst.ll_load(buffer)
+    call = loaded.exprs[0][0]
+    assert(call.name.value == 'f')
+    assert(call.args.elements[1].elements.elements[0].integer.value == 2)
+    assert(call.args.elements[1].open_bracket.start_offset == 5)
+    depth = 0
+    node = loaded.exprs[1][0]
+    while node.elements:
+        node = node.elements.elements[0]
+        depth += 1
+    assert(depth == 4999)
+
+
+def test_lazy_ast(tmp_path: Path):
+    package_name = _generate(tmp_path, enable_lazy_ast=True)
+    ast = _load(package_name, 'ast')
+    lazy_ast = _load(package_name, 'lazy_ast')
+    lexer = _load(package_name, 'lexer')
+    parser = _load(package_name, 'parser')
+    module = parser.parse_module(ParseStream(_lex(lexer, 'f(1, [ 2, 3 ]);'), None))
+    root = lazy_ast.ll_to_lazy_ast(module)
+    assert(isinstance(root, ast.LlModule))
+    assert(not root.has_parent())
+    call = root.exprs[0]
+    assert(root.exprs[0] is call)
+    assert(isinstance(call, ast.LlCallExpr))
+    assert(call.parent() is root)
+    assert(call.name == 'f')
+    one, inner = call.args
+    assert(one.integer == 1)
+    assert(inner.parent() is call)
+    assert(list(element.integer for element in inner.elements) == [ 2, 3 ])
+    # Visitors generated for the eager classes also work on lazy nodes
+    visited = []
+    ast.for_each_ll_expr(call, visited.append)
+    assert(visited == [ one, inner ])
+    visited = []
+    ast.for_each_ll_expr(inner, visited.append)
+    assert(list(element.integer for element in visited) == [ 2, 3 ])
+    # Assigning a field replaces the projected value
+    call.name = 'g'
+    assert(call.name == 'g')
+    assert(module.exprs[0][0].name.value == 'f')
+
+
+def test_cached_offsets(tmp_path: Path):
+    cst = _load(_generate(tmp_path), 'cst')
+    assert('_start_offset' not in cst._LlBaseNode.__slots__)
+    node = cst.LlLitExpr(cst.LlInteger(1, Span(2, 3)))
+    assert((node.start_offset, node.end_offset) == (2, 3))
+    package_name = _generate(tmp_path, name='trivia', enable_trivia=True)
+    cst = _load(package_name, 'cst')
+    lexer = _load(package_name, 'lexer')
+    parser = _load(package_name, 'parser')
+    module = parser.parse_module(ParseStream(_lex(lexer, 'f(1, 2);'), None))
+    call = module.exprs[0][0]
+    lit = call.args.elements[1]
+    assert((module.start_offset, module.end_offset) == (0, 8))
+    assert((call.start_offset, call.end_offset) == (0, 7))
+    assert((lit.start_offset, lit.end_offset) == (5, 6))
+    lit.integer = cst.LlInteger(20, Span(5, 7))
+    assert(lit.end_offset == 6)
+    clear_cached_offsets(lit)
+    assert(lit.end_offset == 7)
+    parents = ParentMap(module)
+    call.name = cst.LlIdent('f', Span(1, 2))
+    clear_cached_offsets(call, parents)
+    assert(call.start_offset == 1)
+    assert(module.start_offset == 1)
+
+
+_private_grammar = """
+@skip
+__ = [\\n\\r\\t ]*
+
+pub token integer -> Integer
+  = [0-9]+
+
+pub token ident
+  = [a-z]+
+
+_sign = '+' | '-'
+
+pub lit_expr
+  = sign:_sign? integer
+
+pub ref_expr
+  = ident
+
+pub neg_expr
+  = '!' expr
+
+pub expr
+  = lit_expr
+  | ref_expr
+  | neg_expr
+
+pub module
+  = exprs:(expr ';')*
+"""
+
+
+def test_emitter(tmp_path: Path):
+    package_name = _generate(tmp_path, _private_grammar)
+    lexer = _load(package_name, 'lexer')
+    parser = _load(package_name, 'parser')
+    emitter = _load(package_name, 'emitter')
+    module = parser.parse_module(ParseStream(_lex(lexer, '-1; a; !+2; 3;'), None))
+    text = emitter.ll_emit(module)
+    reparsed = parser.parse_module(ParseStream(_lex(lexer, text), None))
+    assert(emitter.ll_emit(reparsed) == text)
+    assert(list(type(element[0]).__name__ for element in reparsed.exprs) == [ 'LlLitExpr', 'LlRefExpr', 'LlNegExpr', 'LlLitExpr' ])
+    assert(type(reparsed.exprs[0][0].sign).__name__ == 'LlHyphen')
+    assert(type(reparsed.exprs[2][0].expr.sign).__name__ == 'LlPlus')
+    assert(reparsed.exprs[3][0].sign is None)
+    out = io.StringIO()
+    emitter.ll_write(module, out)
+    assert(out.getvalue() == text)
+
+
+_fields_grammar = """
+@skip
+__ = [\\n\\r\\t ]*
+
+pub token integer -> Integer
+  = [0-9]+
+
+@keyword
+pub token ident
+  = [a-z]+
+
+_fields = (ident ':' integer ',')*
+
+pub struct_def
+  = 'struct' name:ident '{' fields:_fields '}'
+
+pub enum_def
+  = 'enum' name:ident '{' fields:_fields '}'
+
+pub module
+  = defs:(struct_def | enum_def)*
+"""
+
+
+@pytest.mark.parametrize('enable_structural_eq', [ False, True ])
+def test_shared_helper(tmp_path: Path, enable_structural_eq: bool):
+    package_name = _generate(tmp_path, _fields_grammar, name=f'eq_{enable_structural_eq}'.lower(), enable_structural_eq=enable_structural_eq)
+    lexer = _load(package_name, 'lexer')
+    parser = _load(package_name, 'parser')
+    assert(hasattr(parser, '_parse_fields'))
+    assert(not hasattr(_load(_generate(tmp_path), 'parser'), '_parse_fragment'))
+    args = [ SyntaxInterner() ] if enable_structural_eq else []
+    module = parser.parse_module(ParseStream(_lex(lexer, 'struct a { x: 1, y: 2, } enum b { z: 3, }'), None), *args)
+    assert(list(type(element).__name__ for element in module.defs) == [ 'LlStructDef', 'LlEnumDef' ])
+    assert(list((field[0].value, field[2].value) for field in module.defs[0].fields) == [ ('x', 1), ('y', 2) ])
+    assert(list((field[0].value, field[2].value) for field in module.defs[1].fields) == [ ('z', 3) ])
+    assert(parser.parse_module(ParseStream(_lex(lexer, 'struct a { x: 1 }'), None), *args).defs == [])
+
+
+def test_single_file(tmp_path: Path):
+    grammar_path = tmp_path / 'single.mage'
+    grammar_path.write_text(_grammar)
+    package_name = f'{tmp_path.name}_single'
+    assert(generate('python', str(grammar_path), out_dir=tmp_path / package_name, prefix='ll', emit_single_file=True, enable_lazy_ast=True, silent=True) == 0)
+    text = (tmp_path / package_name / '__init__.py').read_text()
+    assert(text.count('def _coerce_extern_integer_to_extern_integer(') == 1)
+    if str(tmp_path) not in sys.path:
+        sys.path.insert(0, str(tmp_path))
+    module = importlib.import_module(package_name)
+    assert(module.LlModule is not module.LlAstModule)
+    scanner = module.LlLexer('f(1, [ 2 ]);')
+    tokens = []
+    while not scanner.at_eof():
+        tokens.append(scanner.lex())
+    cst = module.parse_module(ParseStream(tokens, None))
+    assert(isinstance(cst, module.LlModule))
+    ast = module.ll_to_lazy_ast(cst)
+    assert(isinstance(ast, module.LlAstModule))
+    call = ast.exprs[0]
+    assert(isinstance(call, module.LlAstCallExpr))
+    assert(call.name == 'f')
+    assert(call.args[0].integer == 1)
+    assert(generate('python', str(grammar_path), out_dir=tmp_path / 'no_ast', prefix='ll', emit_single_file=True, enable_ast=False, silent=True) == 0)
+    assert('class LlModule(' in (tmp_path / 'no_ast' / '__init__.py').read_text())
+
+
+def test_jobs(tmp_path: Path):
+    grammar_path = tmp_path / 'jobs.mage'
+    grammar_path.write_text(_grammar)
+    files = generate_files(grammar_path, 'python', prefix='ll', silent=True, enable_lazy_ast=True)
+    assert(isinstance(files, dict))
+    parallel_files = generate_files(grammar_path, 'python', prefix='ll', silent=True, enable_lazy_ast=True, jobs=4)
+    assert(isinstance(parallel_files, dict))
+    assert(list(parallel_files.items()) == list(files.items()))
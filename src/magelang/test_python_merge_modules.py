@@ -0,0 +1,32 @@
+from magelang.lang.python import emit
+from magelang.lang.python.cst import *
+from magelang.passes.python_merge_modules import python_merge_modules
+
+
+def _make_coerce() -> PyFuncDef:
+    return PyFuncDef(name='_coerce_foo', params=[ PyNamedParam(PyNamedPattern('value')) ], body=[ PyRetStmt(expr=PyNamedExpr('value')) ])
+
+
+def test_merge_modules():
+    cst = PyModule(stmts=[
+        PyImportFromStmt(PyAbsolutePath('__future__'), aliases=[ 'annotations' ]),
+        PyImportFromStmt(PyAbsolutePath('typing'), aliases=[ 'Any' ]),
+        PyClassDef('Foo', body=[ PyPassStmt() ]),
+        _make_coerce(),
+    ])
+    parser = PyModule(stmts=[
+        PyImportFromStmt(PyAbsolutePath('typing'), aliases=[ 'Any', 'Callable' ]),
+        PyImportFromStmt(PyRelativePath(1, name='cst'), aliases=[ PyAsterisk() ]),
+        PyImportFromStmt(PyAbsolutePath('__future__'), aliases=[ 'annotations' ]),
+        _make_coerce(),
+        PyFuncDef(name='parse_foo', params=[], body=[ PyRetStmt() ]),
+    ])
+    merged = python_merge_modules({ 'cst.py': cst, 'parser.py': parser })
+    names = list(emit(stmt).splitlines()[0] for stmt in merged.stmts)
+    assert(names == [
+        'from __future__ import annotations',
+        'from typing import Any, Callable',
+        'class Foo:',
+        'def _coerce_foo(value):',
+        'def parse_foo():',
+    ])
@@ -1,6 +1,9 @@
 
+import io
+from enum import IntEnum
+from typing import Any
 import pytest
-from magelang.runtime import Punctuated
+from magelang.runtime import BaseNode, BaseToken, GreenInterner, KindIndex, ParentMap, derive_node, find_end_offset, find_start_offset, generate, group, hardline, line, nest, seq, softline, text, PostorderIterator, PreorderIterator, Punctuated, RedNode, RedToken, Span, SyntaxInterner, SyntaxSerializer, structural_eq, structural_hash, to_red, TriviaTable, emit_lossless
 
 
 def test_punct_elements():
@@ -45,3 +48,323 @@ def test_punct_delimited():
     assert(p3.delimited[2][0] == 3)
     assert(p3.delimited[2][1] == 'c')
     pytest.raises(IndexError, lambda: p3.delimited[3])
+
+def test_punct_iter_pairs():
+    p1 = Punctuated([ ( 1, 'a' ), ( 2, 'b' ), ( 3, None ) ])
+    assert(list(p1) == [ ( 1, 'a' ), ( 2, 'b' ), ( 3, None ) ])
+    assert(list(reversed(p1)) == [ ( 3, None ), ( 2, 'b' ), ( 1, 'a' ) ])
+    assert(p1[-1] == ( 3, None ))
+    assert(not p1.has_trailing_separator)
+    p2 = Punctuated([ ( 1, 'a' ), ( 2, 'b' ) ])
+    assert(list(reversed(p2)) == [ ( 2, 'b' ), ( 1, 'a' ) ])
+    assert(p2.has_trailing_separator)
+    pytest.raises(ValueError, lambda: p1.append(4, 'd'))
+
+def test_punct_extend():
+    p1 = Punctuated()
+    p1.extend([ 1, 2 ], [ 'a', 'b' ])
+    p1.append_final(3)
+    assert(p1.elements == [ 1, 2, 3 ])
+    assert(p1.separators == [ 'a', 'b' ])
+    pytest.raises(ValueError, lambda: Punctuated().extend([ 1, 2 ], [ 'a' ]))
+    p2 = Punctuated.from_lists([ 1, 2 ], [ 'a' ])
+    assert(list(p2.delimited) == [ ( 1, 'a' ) ])
+    assert(p2.last == 2)
+    pytest.raises(ValueError, lambda: Punctuated.from_lists([ 1 ], [ 'a', 'b' ]))
+
+def test_punct_slots():
+    p = Punctuated.from_lists([ 1, 2 ], [ 'a' ])
+    assert(not hasattr(p, '__dict__'))
+    pytest.raises(AttributeError, lambda: setattr(p, 'foo', 1))
+
+
+class _Leaf(BaseToken):
+    pass
+
+class _Branch(BaseNode):
+
+    _field_names = [ 'left', 'right' ]
+
+    def __init__(self, left, right) -> None:
+        super().__init__()
+        self.left = left
+        self.right = right
+
+def test_traversal_order():
+    a = _Leaf()
+    b = _Leaf()
+    c = _Leaf()
+    inner = _Branch(Punctuated([ ( a, b ) ]), None)
+    root = _Branch([ inner ], c)
+    assert(list(PreorderIterator(root)) == [ root, inner, a, b, c ])
+    assert(list(PostorderIterator(root)) == [ a, b, inner, c, root ])
+    assert(list(PreorderIterator(root, _Leaf, include_self=False)) == [ a, b, c ])
+
+def test_derive_node():
+    a = _Leaf()
+    b = _Leaf()
+    root = _Branch(a, None)
+    derived = derive_node(root, { 'right': b })
+    assert(isinstance(derived, _Branch))
+    assert(derived is not root)
+    assert(derived.left is a)
+    assert(derived.right is b)
+    assert(root.right is None)
+
+def test_preorder_prune():
+    a = _Leaf()
+    inner = _Branch(a, None)
+    b = _Leaf()
+    root = _Branch(inner, b)
+    visited = []
+    it = PreorderIterator(root)
+    for node in it:
+        visited.append(node)
+        if node is inner:
+            it.prune()
+    assert(visited == [ root, inner, b ])
+
+def test_traversal_deep_tree():
+    node = _Leaf()
+    for _ in range(100000):
+        node = _Branch(node, None)
+    assert(sum(1 for _ in PreorderIterator(node)) == 100001)
+    assert(sum(1 for _ in PostorderIterator(node)) == 100001)
+
+def test_kind_index():
+    a = _Word('a', Span(0, 1))
+    b = _Word('b', Span(2, 3))
+    c = _Word('c', Span(4, 5))
+    inner = _Branch(b, c)
+    empty = _Branch(None, None)
+    root = _Branch([ a, inner ], empty)
+    index = KindIndex(root)
+    assert(list(index.find_all(_Word)) == [ a, b, c ])
+    assert(list(index.find_all(_Branch)) == [ root, inner, empty ])
+    assert(index.count(_Leaf) == 0)
+    assert(list(index.find_in_range(_Word, 1, 5)) == [ b, c ])
+    assert(list(index.find_in_range(_Branch, 1, 3)) == [ inner ])
+    assert(list(index.find_in_range(_Branch, 0, 1)) == [ root ])
+    # A node without tokens is placed at the end of the last token before it
+    assert(list(index.find_in_range(_Branch, 5, 6)) == [ empty ])
+
+def test_find_offsets():
+    a = _Word('a', Span(2, 3))
+    b = _Word('b', Span(4, 6))
+    inner = _Branch(a, _Leaf())
+    root = _Branch([ _Leaf(), inner ], [ b, _Leaf() ])
+    assert(find_start_offset(root) == 2)
+    assert(find_end_offset(root) == 6)
+    assert(find_start_offset(_Branch(None, _Leaf())) == -1)
+    assert(a.start_offset == 2 and a.end_offset == 3)
+    assert(a.span.start_offset == 2 and a.span.end_offset == 3)
+    assert(_Leaf().span is None)
+
+def test_parent_map():
+    a = _Leaf()
+    b = _Leaf()
+    inner = _Branch(Punctuated([ ( a, b ) ]), None)
+    root = _Branch([ inner ], None)
+    parents = ParentMap(root)
+    assert(parents.get_parent(root) is None)
+    assert(parents.parent(inner) is root)
+    assert(parents.parent(a) is inner)
+    assert(parents.parent(b) is inner)
+    assert(list(parents.iter_ancestors(a)) == [ inner, root ])
+    pytest.raises(ValueError, lambda: parents.parent(root))
+    c = _Leaf()
+    inner.right = c
+    parents.set_parent(c, inner)
+    assert(parents.parent(c) is inner)
+    # Nodes that are no longer in the tree are kept alive, so their ids can't be reused
+    inner.left = Punctuated()
+    del a
+    d = _Leaf()
+    assert(parents.get_parent(d) is None)
+    parents.invalidate()
+    assert(parents.get_parent(b) is None)
+    assert(parents.parent(c) is inner)
+
+
+def test_emit_lossless():
+    source = ' a  b ,\nc\n'
+    trivia = TriviaTable(source)
+    words = list[_Word]()
+    for value, start in [ ( 'a', 1 ), ( 'b', 4 ), ( ',', 6 ), ( 'c', 8 ) ]:
+        trivia.add(start, start + 1)
+        words.append(_Word(value, Span(start, start + 1)))
+    assert(len(trivia) == 4)
+    assert(trivia.leading_trivia(1) == '  ')
+    assert(trivia.trailing_trivia(3) == '\n')
+    assert(trivia.index_of(_Word('x')) == -1)
+    def emit(node) -> str:
+        return emit_lossless(node, trivia, lambda node: '<node>', lambda token: token.value)
+    pair = _Branch(words[0], words[1])
+    root = _Branch([ pair, words[2] ], words[3])
+    assert(emit(root) == source)
+    # A subtree keeps the trivia around it but not the end of the text
+    assert(emit(pair) == ' a  b ')
+    assert(emit(words[2]) == ' ,\n')
+    # Only the new token is printed; everything else keeps its trivia
+    pair.right = _Word('d')
+    assert(emit(root) == ' a  d ,\nc\n')
+    root.right = _Branch(None, None)
+    assert(emit(root) == ' a  d ,\n')
+    root.left.append(_Branch(_Word('e'), None))
+    assert(emit(root) == ' a  d ,\n<node>\n')
+
+
+def test_structural_eq_and_hash():
+    p1 = Punctuated([ ( 1, 'a' ), ( 2, None ) ])
+    p2 = Punctuated([ ( 1, 'a' ), ( 2, None ) ])
+    p3 = Punctuated([ ( 1, 'a' ), ( 2, 'b' ) ])
+    assert(structural_eq(p1, p2))
+    assert(not structural_eq(p1, p3))
+    assert(structural_hash(p1) == structural_hash(p2))
+    assert(structural_eq([ p1, ( 1, 2 ) ], [ p2, ( 1, 2 ) ]))
+    assert(not structural_eq([ 1 ], [ 1, 2 ]))
+    assert(structural_hash([ 1, [ 2 ] ]) == structural_hash([ 1, [ 2 ] ]))
+
+def test_syntax_interner():
+    interner = SyntaxInterner()
+    x = tuple([ 1, 2 ])
+    y = tuple([ 1, 2 ])
+    assert(x is not y)
+    a = interner.intern(x)
+    b = interner.intern(y)
+    c = interner.intern((1, 3))
+    assert(a is x)
+    assert(b is x)
+    assert(a is not c)
+    assert(len(interner) == 2)
+
+
+class _Word(BaseToken):
+
+    def __init__(self, value, span=None) -> None:
+        super().__init__(span)
+        self.value = value
+
+class _Group(BaseNode):
+
+    _field_names = [ 'words', 'rest' ]
+
+    @classmethod
+    def _make(cls, words, rest):
+        node = cls.__new__(cls)
+        node.words = words
+        node.rest = rest
+        return node
+
+def test_serializer_roundtrip():
+    serializer = SyntaxSerializer([ _Group ], [ _Leaf ], [ _Word ])
+    inner = _Group._make([ _Word(-42), _Word(1.5) ], None)
+    root = _Group._make(Punctuated([ ( _Word('foo', Span(0, 3)), _Leaf() ), ( inner, None ) ]), ( _Word('foo'), True ))
+    buffer = io.BytesIO()
+    serializer.dump(root, buffer)
+    buffer.seek(0)
+    loaded = serializer.load(buffer)
+    first, separator = loaded.words[0]
+    assert(first.value == 'foo')
+    assert(first.span.start_offset == 0 and first.span.end_offset == 3)
+    assert(isinstance(separator, _Leaf) and separator.span is None)
+    last, separator = loaded.words[1]
+    assert(separator is None)
+    assert(last.words[0].value == -42)
+    assert(last.words[1].value == 1.5)
+    assert(last.rest is None)
+    assert(loaded.rest[0].value == 'foo')
+    assert(loaded.rest[1] is True)
+    buffer = io.BytesIO(b'garbage')
+    pytest.raises(ValueError, lambda: serializer.load(buffer))
+
+class _Flags(IntEnum):
+    a = 1
+    b = 2
+
+def test_serializer_enums_and_deep_trees():
+    serializer = SyntaxSerializer([ _Group ], [ _Leaf ], [ _Word ], [ _Flags ])
+    root = _Group._make([ _Word(_Flags.b) ], None)
+    for _ in range(5000):
+        root = _Group._make([], root)
+    buffer = io.BytesIO()
+    serializer.dump(root, buffer)
+    buffer.seek(0)
+    loaded = serializer.load(buffer)
+    depth = 0
+    while loaded.rest is not None:
+        assert(loaded.words == [])
+        loaded = loaded.rest
+        depth += 1
+    assert(depth == 5000)
+    assert(loaded.words[0].value is _Flags.b)
+    buffer = io.BytesIO()
+    pytest.raises(ValueError, lambda: SyntaxSerializer([ _Group ], [], [ _Word ]).dump(_Group._make([ _Word(_Flags.a) ], None), buffer))
+
+
+class _Name(RedToken):
+    pass
+
+class _Pair(RedNode):
+
+    __slots__ = ()
+
+    @property
+    def left(self) -> Any:
+        return self._get_field(0)
+
+    @property
+    def right(self) -> Any:
+        return self._get_field(1)
+
+def test_green_interner_shares_subtrees():
+    interner = GreenInterner()
+    a1 = interner.node(_Pair, (interner.token(_Name, 'foo'), interner.token(_Name, 'ab')))
+    a2 = interner.node(_Pair, (interner.token(_Name, 'foo'), interner.token(_Name, 'ab')))
+    b = interner.node(_Pair, (interner.token(_Name, 'foo'), interner.token(_Name, 'abc')))
+    assert(a1 is a2)
+    assert(a1 is not b)
+    assert(a1.width == 5)
+    assert(b.width == 6)
+
+def test_red_offsets_and_parents():
+    # Source text: 'def a  bc'
+    interner = GreenInterner()
+    inner = interner.node(_Pair, (interner.token(_Name, 'a', ' '), interner.token(_Name, 'bc', '  ')))
+    outer = interner.node(_Pair, ((interner.token(_Name, 'def'), None), inner))
+    assert(outer.width == 9)
+    root = to_red(outer)
+    assert(not root.has_parent())
+    names = root.left
+    assert(names[0].text == 'def')
+    assert(names[1] is None)
+    child = root.right
+    assert(child is root.right)
+    assert(child.parent() is root)
+    assert(child.offset == 3)
+    assert(child.start_offset == 4)
+    assert(child.end_offset == 9)
+    assert(child.left.leading_trivia == ' ')
+    assert(child.right.start_offset == 7)
+    assert(child.right.text == 'bc')
+
+
+def test_doc_layout():
+    call = group(seq([
+        text('f('),
+        nest(4, seq([ softline(), text('a,'), line(), text('b') ])),
+        softline(),
+        text(')'),
+    ]))
+    assert(generate(call) == 'f(a, b)')
+    assert(generate(call, width=6) == 'f(\n    a,\n    b\n)')
+    assert(generate(seq([ text('x = '), call ]), width=8) == 'x = f(\n    a,\n    b\n)')
+    assert(generate(group(seq([ text('a'), line(), text('b'), hardline(), text('c') ]))) == 'a\nb\nc')
+    # Indentation is not written on empty lines
+    assert(generate(nest(2, seq([ text('a'), hardline(), hardline(), text('b') ]))) == 'a\n\n  b')
+
+def test_doc_layout_deep():
+    doc = text('x')
+    for _ in range(100000):
+        doc = group(nest(1, seq([ softline(), doc ])))
+    assert(generate(doc, width=200000) == 'x')
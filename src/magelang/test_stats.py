@@ -0,0 +1,36 @@
+from magelang.lang.python.cst import *
+from magelang.stats import collect_code_stats, collect_module_stats
+
+
+def test_collect_code_stats():
+    fork = PyAssignStmt(PyNamedPattern('stream_1'), value=PyCallExpr(PyAttrExpr(PyNamedExpr('stream'), 'fork')))
+    join = PyExprStmt(PyCallExpr(PyAttrExpr(PyNamedExpr('stream'), 'join_to'), args=[ PyNamedExpr('stream_1') ]))
+    body: list[PyStmt] = [
+        fork,
+        PyIfStmt(first=PyIfCase(test=PyNamedExpr('x'), body=[ join, PyRetStmt() ])),
+    ]
+    stats = collect_code_stats('parse_foo', body)
+    assert(stats.stmts == 4)
+    assert(stats.max_depth == 2)
+    assert(stats.forks == 1)
+    assert(stats.joins == 1)
+    assert(stats.backtracks == 1)
+
+
+def test_collect_module_stats_splits_lexer():
+    def token(name: str, n: int) -> list[PyStmt]:
+        return [
+            PyAssignStmt(PyNamedPattern(f'keep_{n}'), value=PyNamedExpr('i')),
+            PyIfStmt(first=PyIfCase(test=PyNamedExpr('ch'), body=[ PyRetStmt(expr=PyCallExpr(PyNamedExpr(name))) ])),
+            PyAssignStmt(PyNamedPattern('i'), value=PyNamedExpr(f'keep_{n}')),
+        ]
+    lex = PyFuncDef('lex', body=[
+        PyAssignStmt(PyNamedPattern('i'), value=PyConstExpr(0)),
+        *token('Comma', 1),
+        *token('Dot', 2),
+        PyRaiseStmt(expr=PyCallExpr(PyNamedExpr('ScanError'))),
+    ])
+    stats = collect_module_stats(PyModule(stmts=[ PyClassDef('Lexer', body=[ lex ]) ]))
+    assert([ s.name for s in stats ] == [ 'Comma', 'Dot', 'lex' ])
+    assert(stats[0].stmts == 4 and stats[0].backtracks == 1)
+    assert(stats[2].stmts == 2)
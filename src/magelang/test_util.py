@@ -1,6 +1,7 @@
 
 import pytest
-from magelang.util import DropProxy
+import io
+from magelang.util import DropProxy, IndentWriter
 
 
 def test_drop_none():
@@ -44,3 +45,22 @@ def test_drop_many():
     assert(d1[1] == 4)
     assert(d1[0] == 5)
 
+
+
+def test_indent_writer():
+    chunks = []
+    out = IndentWriter(chunks, indentation='  ')
+    out.write('a:')
+    out.indent()
+    out.write('\nb\n\n  c')
+    out.dedent()
+    out.write('\n')
+    out.write(' \t')
+    out.writeln('d')
+    out.ensure_trailing_lines(3)
+    assert(''.join(chunks) == 'a:\n  b\n\n    c\n \td\n\n\n')
+    string = io.StringIO()
+    out = IndentWriter(string)
+    out.indent()
+    out.writeln('e')
+    assert(string.getvalue() == '  e\n')
@@ -129,16 +129,24 @@ def get_common_suffix(names: Sequence[MiniSeq[_Comparable]]) -> MiniSeq[_Compara
     return name[len(name) - i:]
 
 class IndentWriter:
+    """
+    Writes text while indenting every line that is not blank.
+
+    Text is written in whole fragments; only the line boundaries inside a
+    fragment are inspected. `out` may either be a file-like object or a list
+    that receives the chunks, which can then be joined once at the end.
+    """
 
-    def __init__(self, out: TextIO | None = None, indentation='  '):
+    def __init__(self, out: TextIO | list[str] | None = None, indentation='  '):
         if out is None:
             out = io.StringIO()
         self.output = out
+        self._write = out.append if isinstance(out, list) else out.write
         self.at_blank_line = True
         self.newline_count = 0
         self.indent_level = 0
         self.indentation = indentation
-        self._re_whitespace = re.compile('[\n\r\t ]')
+        self._re_non_whitespace = re.compile('[^\n\r\t ]')
 
     def indent(self):
         self.indent_level += 1
@@ -149,16 +157,40 @@ class IndentWriter:
     def ensure_trailing_lines(self, count):
         self.write('\n' * max(0, count - self.newline_count))
 
+    def _write_line(self, text: str, start: int, end: int) -> None:
+        if start == end:
+            return
+        if self.at_blank_line:
+            # Whitespace at the start of a line does not trigger indentation
+            match = self._re_non_whitespace.search(text, start, end)
+            if match is None:
+                self._write(text[start:end])
+                return
+            i = match.start()
+            if i > start:
+                self._write(text[start:i])
+            self._write(self.indentation * self.indent_level)
+            self.newline_count = 0
+            self.at_blank_line = False
+            start = i
+        self._write(text[start:end] if start > 0 or end < len(text) else text)
+
     def write(self, text: str) -> None:
-        for ch in text:
-            if ch == '\n':
-                self.newline_count = self.newline_count + 1 if self.at_blank_line else 1
-                self.at_blank_line = True
-            elif self.at_blank_line and not self._re_whitespace.match(ch):
-                self.newline_count = 0
-                self.output.write(self.indentation * self.indent_level)
-                self.at_blank_line = False
-            self.output.write(ch)
+        if not self.at_blank_line and '\n' not in text:
+            # Most fragments are written in the middle of a line
+            self._write(text)
+            return
+        start = 0
+        while True:
+            i = text.find('\n', start)
+            if i < 0:
+                self._write_line(text, start, len(text))
+                return
+            self._write_line(text, start, i)
+            self.newline_count = self.newline_count + 1 if self.at_blank_line else 1
+            self.at_blank_line = True
+            self._write('\n')
+            start = i + 1
 
     def writeln(self, text: str = '') -> None:
         self.write(text)